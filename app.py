@@ -1,12 +1,34 @@
-import pandas as pd
+import os
 import streamlit as st
 import time
+from datetime import datetime
 from streamlit.components.v1 import html
 from utils import (
-    get_first_working_url, return_privacy_url, extract_email, display_df,
-    display_random_logos, read_json, compose_df, compose_logo_url,
-    preview_email, get_email_template, google_authenticate, build_gmail_service, create_message, send_message
+    display_random_logos, compose_company_rows, fetch_logo_data_uris, find_gdpr_contact, find_gdpr_contacts,
+    lookup_contact, registrable_domain,
+    preview_email, get_email_template, google_authenticate, build_gmail_service, create_message, send_message,
+    process_emails, prewarm_heavy_imports
 )
+from sharded_scan import SCAN_SHARD_DAYS, process_emails_sharded
+from results_table import ResultsStore, display_results_table, get_table_state, reset_table_state, selected_rows_frame
+from llm_scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, get_llm_scheduler
+from llm_router import route_metrics
+from http_client import get_http_client
+from session_store import current_session_id, get_session_store
+from scan_results import ENTITY_FIELDS, iter_email_records, iter_records
+from local_classifier import save_training_labels
+from prescan import (
+    PRESCAN_DAYS, PRESCAN_ENABLED, enroll, unenroll, is_enrolled, load_prescan, record_interactive_scan,
+    get_prescan_scheduler
+)
+
+# sample scan results (.json, .jsonl or .parquet) shown instead of scanning the inbox; set DEMO_DATA_PATH to an
+# empty string to scan Gmail
+DEMO_DATA_PATH = os.getenv('DEMO_DATA_PATH', 'gemini_processed_emails.jsonl')
+# wall-clock budget of a quick scan, which classifies the most informative emails first and stops in time
+QUICK_SCAN_SECONDS = int(os.getenv('QUICK_SCAN_SECONDS', '15'))
+# operator diagnostics (queue depths and similar process-wide metrics) in the sidebar
+SHOW_DIAGNOSTICS = os.getenv('SHOW_DIAGNOSTICS', '0') == '1'
 
 def initialize_authenticator():
     """Authenticate the user and initialize Google service if connected."""
@@ -15,7 +37,6 @@ def initialize_authenticator():
         authenticator.login()
 
     if st.session_state.get('connected'):
-        st.session_state['gmail_service'] = build_gmail_service()
         display_user_info(authenticator)
     else:
         display_homepage()
@@ -29,6 +50,8 @@ def display_user_info(authenticator):
     st.sidebar.write(f"You are logged in as {st.session_state['user_info'].get('name')}")
     if st.sidebar.button('Log out'):
         authenticator.logout()
+        get_session_store().drop(current_session_id())
+        st.session_state.pop('scan_artifacts', None)
 
 def display_homepage():
     """Display the homepage if the user is not connected."""
@@ -41,8 +64,34 @@ def configure_advanced_options():
     """Set advanced options for scanning emails."""
     with st.expander('Advanced Options'):
         day_range = st.slider('Fetch Emails From the Past (Days)', min_value=1, max_value=60, step=7, value=7)
-        ignored_categories = st.multiselect('Ignore Categories', ['Personal', 'Promotions', 'Social', 'Updates', 'Forums'])
-    return day_range, ignored_categories
+        ignored_categories = st.multiselect('Ignore Categories', ['Personal', 'Promotions', 'Social', 'Updates', 'Forums'],
+                                            default=['Personal', 'Social', 'Forums'])
+        quick_scan = st.toggle(f'Quick Scan ({QUICK_SCAN_SECONDS} seconds)', value=False,
+                               help='Analyze the most informative emails first, one per sender, and show what '
+                                    'was found when the time is up.')
+        if PRESCAN_ENABLED and not DEMO_DATA_PATH:
+            configure_background_scans(ignored_categories)
+    return day_range, ignored_categories, QUICK_SCAN_SECONDS if quick_scan else None
+
+def configure_background_scans(ignored_categories):
+    """Let the user opt in to background pre-scans with the selected categories."""
+    user_id = st.session_state['oauth_id']
+    enrolled = is_enrolled(user_id)
+    background = st.toggle('Keep my results fresh in the background', value=enrolled,
+                           help='Scans new emails every few hours so that results open instantly. '
+                                'Your access token is stored on the server until you turn this off.')
+    if background:
+        # enrolling rewrites the user's whole state file, so it only runs when the token or the categories
+        # changed, not on every rerun
+        enrollment = (st.session_state['credentials'], tuple(sorted(ignored_categories)))
+        if not enrolled or st.session_state.get('prescan_enrollment') != enrollment:
+            if enroll(user_id, st.session_state['credentials'], ignored_categories):
+                st.session_state['prescan_enrollment'] = enrollment
+            else:
+                st.warning('Log out and in again to allow background scans.')
+    elif enrolled:
+        unenroll(user_id)
+        st.session_state.pop('prescan_enrollment', None)
 
 @st.fragment
 def display_options():
@@ -61,38 +110,134 @@ def display_options():
     """)
 
     scan_button = st.button('Scan Inbox')
-    day_range, ignored_categories = configure_advanced_options()
+    day_range, ignored_categories, time_budget = configure_advanced_options()
+    params = scan_params(day_range, ignored_categories, time_budget)
 
     if scan_button:
-        
-        # for demo purposes, load sample emails
-        email_data = read_json('gemini_processed_emails.json')
-        
-        # email_data = process_emails(gmail_service, day_range, ignored_categories)
-
-        logo_url_list, classification_data = extract_email_data(email_data)
-
-        display_results(logo_url_list, classification_data)
-
-        run_bot()
-
-def extract_email_data(email_data):
-    """Process and extract email data for display."""
-    logo_url_set = set()
-    classification_data = []
-
-    for email_id, email_info in email_data.items():
-        compose_logo_url(logo_url_set, email_info)
-        compose_df(classification_data, email_info)
-
-    return list(logo_url_set), classification_data
-
-def display_results(logo_url_list, classification_data):
-    """Display logos and the classified data table."""
+        artifacts = run_scan(params, day_range, ignored_categories, time_budget)
+    else:
+        # reruns from table edits, the preview toggle or the options reuse the last scan as is
+        artifacts = st.session_state.get('scan_artifacts')
+        if artifacts is None:
+            return
+        if load_results_store() is None:
+            # the session was idle for so long that its results expired
+            st.session_state.pop('scan_artifacts', None)
+            st.info('Your previous results have expired. Click **Scan Inbox** to scan again.')
+            return
+        if artifacts['params'] != params:
+            st.info('The scan options changed. Click **Scan Inbox** to refresh the results.')
+
+    display_results(artifacts)
+
+    run_bot()
+
+def scan_params(day_range, ignored_categories, time_budget=None):
+    """Return the key identifying the scan that the current options would run."""
+    return (DEMO_DATA_PATH or 'gmail', day_range, tuple(sorted(ignored_categories)), time_budget)
+
+def run_scan(params, day_range, ignored_categories, time_budget=None):
+    """Scan the inbox and store the results, rows and logos as the session's scan artifacts."""
+    if DEMO_DATA_PATH:
+        # for demo purposes, stream sample results, reading only the columns needed to resolve companies
+        records = iter_records(DEMO_DATA_PATH, ENTITY_FIELDS)
+    elif time_budget:
+        # partial results by design, so neither the shards nor the background results are involved
+        email_data = process_emails(build_gmail_service(), day_range, ignored_categories,
+                                    user=st.session_state['oauth_id'], budget_seconds=time_budget)
+        save_training_labels(st.session_state['oauth_id'], email_data)
+        records = iter_email_records(email_data)
+    else:
+        # the background scan's results are served first, whatever the window, and only the rest is scanned
+        email_data = scan_with_prescan(day_range, ignored_categories)
+        if email_data is None and day_range > SCAN_SHARD_DAYS:
+            # long windows are split into checkpointed date shards scanned in parallel
+            email_data = process_emails_sharded(st.session_state['credentials'], st.session_state['oauth_id'],
+                                                day_range, ignored_categories)
+        elif email_data is None:
+            email_data = process_emails(build_gmail_service(), day_range, ignored_categories,
+                                        user=st.session_state['oauth_id'])
+        save_training_labels(st.session_state['oauth_id'], email_data)
+        records = iter_email_records(email_data)
+
+    logo_list, classification_data = extract_email_data(records)
+    # row ids refer to the previous results, so their selection does not carry over
+    reset_table_state()
+
+    # the raw email data is not kept; the session only holds the compact Arrow rows and the logos, and those
+    # live in the process-wide store, which spills them to disk while the session is idle
+    session_store = get_session_store()
+    session_id = current_session_id()
+    session_store.put(session_id, 'results_store', ResultsStore(classification_data))
+    session_store.put(session_id, 'logo_list', logo_list)
+
+    previous = st.session_state.get('scan_artifacts')
+    artifacts = {
+        'params': params,
+        'version': previous['version'] + 1 if previous else 1,
+    }
+    st.session_state['scan_artifacts'] = artifacts
+    return artifacts
+
+def scan_with_prescan(day_range, ignored_categories):
+    """
+    Show the background scan's results at once, then scan only what it does not cover and merge the results.
+
+    The emails received since the background scan are scanned incrementally. The background scan only reaches
+    `PRESCAN_DAYS` back, so the older part of a longer window is scanned in shards.
+    """
+    if not PRESCAN_ENABLED:
+        return None
+    user_id = st.session_state['oauth_id']
+    precomputed = load_prescan(user_id, min(day_range, PRESCAN_DAYS), ignored_categories)
+    if precomputed is None:
+        return None
+    email_data, last_scan = precomputed
+
+    preview = st.empty()
+    with preview.container():
+        st.caption(f"Results of the background scan from {datetime.fromtimestamp(last_scan):%Y-%m-%d %H:%M}. "
+                   f"Checking for new emails...")
+        _, rows = compose_company_rows(iter_email_records(email_data))
+        st.dataframe(rows, hide_index=True, width='stretch')
+
+    scanned_at = time.time()
+    new_email_data = process_emails(build_gmail_service(), day_range, ignored_categories, user=user_id,
+                                    since=last_scan)
+    record_interactive_scan(user_id, new_email_data, scanned_at)
+    older_email_data = {}
+    if day_range > PRESCAN_DAYS:
+        older_email_data = process_emails_sharded(st.session_state['credentials'], user_id, day_range,
+                                                  ignored_categories, covered_days=PRESCAN_DAYS)
+    preview.empty()
+
+    # newest first, like a full scan
+    merged = dict(new_email_data)
+    for earlier_email_data in (email_data, older_email_data):
+        merged.update((message_id, email_info) for message_id, email_info in earlier_email_data.items()
+                      if message_id not in merged)
+    return merged
+
+def load_results_store():
+    """Return the results store of the session's last scan, or None if there is none."""
+    return get_session_store().get(current_session_id(), 'results_store')
+
+def extract_email_data(records):
+    """Resolve scan result records to companies and extract data for display."""
+    index, classification_data = compose_company_rows(records)
+
+    # one cached logo per company, most frequent senders first
+    entities = sorted(index.entities.values(), key=lambda entity: -entity.messages)
+    logo_list = fetch_logo_data_uris([entity.domain for entity in entities])
+
+    return logo_list, classification_data
+
+def display_results(artifacts):
+    """Display logos and the classified data table of a scan."""
     st.subheader("These companies and more have your data...")
-    display_random_logos(logo_url_list)
-    df_clean = pd.DataFrame(classification_data)
-    display_df(df_clean)
+    display_random_logos(get_session_store().get(current_session_id(), 'logo_list', []))
+    # the fragment is given the loader rather than the store, so it does not pin the store in memory
+    display_results_table(load_results_store)
 
 @st.fragment
 def run_bot():
@@ -105,22 +250,28 @@ def run_bot():
     with columns[2]:
         email_preview = st.toggle('Preview Email', value=True, help='Available for single selection only')
 
+    if not run_button:
+        return
+    # the selection is kept as row ids; the rows are only materialized when the bot runs
+    selected_rows = selected_rows_frame(load_results_store(), get_table_state())
+
     # Single email send with preview
-    if run_button and email_preview:
-        if not validate_selection(single_row=True):
+    if email_preview:
+        if not validate_selection(selected_rows, single_row=True):
             return
-        send_email(st.session_state['selected_rows'].iloc[0])
+        send_email(selected_rows.iloc[0], build_gmail_service())
 
     # Mass email send without preview
-    if run_button and email_preview==False:
-        if not validate_selection(single_row=False):
+    if email_preview==False:
+        if not validate_selection(selected_rows, single_row=False):
             return
-        for _, row in st.session_state['selected_rows'].iterrows():
-            send_email(row, preview=False)
+        gmail_service = build_gmail_service()
+        contacts = resolve_contacts(selected_rows)
+        for _, row in selected_rows.iterrows():
+            send_email(row, gmail_service, preview=False, contacts=contacts)
 
-def validate_selection(single_row=True):
+def validate_selection(selected_rows, single_row=True):
     """Validate user selection based on single or multiple row selections."""
-    selected_rows = st.session_state['selected_rows']
     if single_row and len(selected_rows) != 1:
         st.warning('Please select exactly one row to proceed with preview.')
         return False
@@ -132,17 +283,44 @@ def validate_selection(single_row=True):
         return False
     return True
 
-def send_email(row, preview=True):
+def resolve_contacts(selected_rows):
+    """Find the GDPR contacts of all selected companies up front, batching the lookups that need Gemini."""
+    contacts = {}
+    missing = []
+    for website in selected_rows['Website']:
+        domain = registrable_domain(website) or website
+        contact = lookup_contact(domain)
+        if contact is not None:
+            contacts[domain] = contact['email']
+        elif domain not in missing:
+            missing.append(domain)
+    if missing:
+        with st.spinner(f'Looking up the privacy contacts of {len(missing)} companies...'):
+            contacts.update(find_gdpr_contacts(missing, user=st.session_state.get('oauth_id'), priority=PRIORITY_BULK))
+    return contacts
+
+def send_email(row, gmail_service, preview=True, contacts=None):
     """Compose and send email based on row data, optionally preview."""
     selected_website = row['Website']
     selected_option = row['Select Option']
     selected_company = row['Company Name']
 
     try:
-        # Retrieve privacy URL and email address
-        response = return_privacy_url(selected_website)
-        url = get_first_working_url(response.json())
-        email = extract_email(url)
+        # Retrieve the GDPR contact from the bundled index, or look it up once per company domain; a previewed
+        # lookup has a user waiting on it, so it is queued ahead of bulk work
+        domain = registrable_domain(selected_website) or selected_website
+        if contacts is not None and domain in contacts:
+            # resolved in bulk by `resolve_contacts`; None means no privacy page was found
+            email = contacts[domain]
+            if email is None:
+                raise ValueError(f"No privacy page found for {domain}")
+        else:
+            contact = lookup_contact(domain)
+            if contact is not None:
+                email = contact['email']
+            else:
+                email = find_gdpr_contact(domain, user=st.session_state.get('oauth_id'),
+                                          priority=PRIORITY_INTERACTIVE if preview else PRIORITY_BULK)
 
         email_template = get_email_template()
         email_subject = email_template[selected_option]['subject']
@@ -151,18 +329,33 @@ def send_email(row, preview=True):
         )
 
         if preview:
-            preview_email(email, email_subject, email_body, st.session_state['gmail_service'])
+            preview_email(email, email_subject, email_body, gmail_service)
         else:
             # Sending multiple emails without preview
             message = create_message(st.session_state['user_info'].get('email'), email, email_subject, email_body)
 
             # Send the email
-            send_message(st.session_state['gmail_service'], 'me', message)
+            send_message(gmail_service, 'me', message)
             st.success(f"Email sent to {selected_company}")
     except Exception:
         st.error(f"Failed to send email to {selected_company}.")
 
 
+def display_diagnostics():
+    """Display process-wide metrics in the sidebar for operators."""
+    with st.sidebar.expander('Diagnostics'):
+        st.caption('Gemini scheduler')
+        st.json(get_llm_scheduler().metrics())
+        st.caption('Model routes')
+        st.json(route_metrics.snapshot())
+        st.caption('Outbound HTTP by host')
+        st.json(get_http_client().stats())
+        st.caption('Session memory')
+        st.json(get_session_store().memory_report(current_session_id()))
+        if PRESCAN_ENABLED:
+            st.caption('Background pre-scans')
+            st.json(get_prescan_scheduler().metrics())
+
 def sidebar_footer():
     """Display the footer in the sidebar."""
     # display the footer in the very bottom of the sidebar
@@ -178,8 +371,15 @@ def sidebar_footer():
 def main():
     if initialize_authenticator():
         display_options()
+    if SHOW_DIAGNOSTICS:
+        display_diagnostics()
     sidebar_footer()
 
+    # the page is on screen by now, so load the scan dependencies while the user reads it
+    prewarm_heavy_imports()
+    # no-op unless PRESCAN_ENABLED is set; the scheduler is shared by all sessions
+    get_prescan_scheduler()
+
 if __name__ == '__main__':
     main()
 
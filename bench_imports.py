@@ -0,0 +1,95 @@
+"""
+Import-time benchmark for the Streamlit entrypoint.
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter, reports the slowest imports and fails
+if the total import time exceeds the budget or if any dependency that should be lazily imported is loaded
+before the first page is rendered.
+
+Usage:
+    python bench_imports.py [--module app] [--budget-ms 1500] [--top 15]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# dependencies that must only be imported by the scan and lookup paths
+LAZY_MODULES = (
+    'vertexai',
+    'langchain_google_vertexai',
+    'unstructured',
+    'googleapiclient',
+    'pandas',
+)
+
+
+def run_importtime(module):
+    """
+    Import a module in a fresh interpreter with `-X importtime` enabled.
+
+    Parameters:
+        module (str): The module to import.
+
+    Returns:
+        list: Tuples of (self_us, cumulative_us, depth, module_name) in the order reported by Python.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        # Python indents nested imports by two spaces per level after a single separator space
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the app against a budget.")
+    parser.add_argument('--module', default='app', help="Module to import (default: app)")
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('IMPORT_BUDGET_MS', '1500')),
+                        help="Maximum total import time in milliseconds (default: IMPORT_BUDGET_MS or 1500)")
+    parser.add_argument('--top', type=int, default=15, help="Number of slowest top-level imports to list")
+    args = parser.parse_args()
+
+    entries = run_importtime(args.module)
+
+    # -X importtime reports children before their parent, so the module's subtree is everything
+    # between its own top-level line and the previous top-level line (interpreter start-up imports)
+    root = max(index for index, entry in enumerate(entries) if entry[2] == 0 and entry[3] == args.module)
+    start = root
+    while start > 0 and entries[start - 1][2] > 0:
+        start -= 1
+    subtree = entries[start:root + 1]
+
+    total_ms = entries[root][1] / 1000
+    direct = [entry for entry in subtree if entry[2] == 1]
+
+    print(f"Slowest imports of '{args.module}':")
+    for _, cumulative, _, name in sorted(direct, key=lambda entry: entry[1], reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:9.1f} ms  {name}")
+    print(f"Total: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+
+    loaded = {name for _, _, _, name in subtree}
+    eager = sorted(name for name in LAZY_MODULES if name in loaded)
+
+    failed = False
+    if eager:
+        print(f"FAIL: imported at startup but should be lazy: {', '.join(eager)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"FAIL: import time {total_ms:.1f} ms exceeds the budget of {args.budget_ms:.0f} ms")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
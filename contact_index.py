@@ -0,0 +1,210 @@
+"""
+Read-only index of company domains to GDPR contacts, shipped with the container image.
+
+Popular companies appear in almost every inbox, so their contacts are resolved from a local SQLite file instead
+of a privacy page discovery, a page load and a Gemini call. Every live lookup is appended to a JSONL log, from
+which the index is rebuilt.
+
+Usage:
+    python contact_index.py build [--log .cache/gdpr_lookups.jsonl] [--output gdpr_contacts.sqlite] [--min-lookups 1]
+    python contact_index.py lookup adidas.com
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+CONTACT_INDEX_PATH = os.getenv('CONTACT_INDEX_PATH', 'gdpr_contacts.sqlite')
+CONTACT_LOOKUP_LOG = os.getenv('CONTACT_LOOKUP_LOG', '.cache/gdpr_lookups.jsonl')
+# entries verified longer ago than this are ignored and looked up live again
+CONTACT_INDEX_MAX_AGE_DAYS = int(os.getenv('CONTACT_INDEX_MAX_AGE_DAYS', '365'))
+
+# how often the open index checks whether `build_index` swapped in a new file
+RELOAD_CHECK_SECONDS = 30
+
+_connection = None
+_connection_file = None
+_connection_checked_at = None
+_connection_lock = threading.Lock()
+_log_lock = threading.Lock()
+
+
+def _get_connection():
+    """
+    Return the connection to the index, reopening it when the file was replaced since it was opened.
+
+    The file is checked at most every `RELOAD_CHECK_SECONDS`; a rebuilt index has a new inode or modification
+    time. Callers hold `_connection_lock`.
+    """
+    global _connection, _connection_file, _connection_checked_at
+    now = time.monotonic()
+    if _connection_checked_at is not None and now - _connection_checked_at < RELOAD_CHECK_SECONDS:
+        return _connection
+    _connection_checked_at = now
+    try:
+        stat = os.stat(CONTACT_INDEX_PATH)
+        current_file = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        current_file = None
+    if current_file != _connection_file:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+        if current_file is not None:
+            # immutable: a file is never changed in place, only swapped, so SQLite skips locking altogether
+            _connection = sqlite3.connect(f'file:{CONTACT_INDEX_PATH}?mode=ro&immutable=1', uri=True,
+                                          check_same_thread=False)
+            print(f"Opened the contact index {CONTACT_INDEX_PATH}")
+        _connection_file = current_file
+    return _connection
+
+
+def lookup_contact(domain):
+    """
+    Look up the GDPR contact of a company in the bundled index.
+
+    Parameters:
+        domain (str): The registrable domain of the company, e.g. "adidas.com".
+
+    Returns:
+        dict or None: The "domain", "privacy_url", "email" and "verified_at" (ISO date) of the entry, or None
+                      if the domain is not indexed, the entry is too old, or there is no index.
+    """
+    with _connection_lock:
+        connection = _get_connection()
+        if connection is None or not domain:
+            return None
+        row = connection.execute(
+            'SELECT domain, privacy_url, email, verified_at FROM contacts WHERE domain = ?', (domain.casefold(),)
+        ).fetchone()
+
+    if row is None:
+        return None
+    entry = dict(zip(('domain', 'privacy_url', 'email', 'verified_at'), row))
+    if date.fromisoformat(entry['verified_at']) < date.today() - timedelta(days=CONTACT_INDEX_MAX_AGE_DAYS):
+        return None
+    return entry
+
+
+def record_lookup(domain, privacy_url, email):
+    """
+    Append the result of a live lookup to the lookup log, for the next index build.
+
+    Parameters:
+        domain (str): The registrable domain of the company.
+        privacy_url (str): The privacy page the email was extracted from.
+        email (str): The extracted email, or "No email available".
+
+    Returns:
+        None
+    """
+    line = json.dumps({'domain': domain, 'privacy_url': privacy_url, 'email': email,
+                       'checked_at': datetime.now().isoformat(timespec='seconds')})
+    try:
+        with _log_lock:
+            os.makedirs(os.path.dirname(CONTACT_LOOKUP_LOG) or '.', exist_ok=True)
+            with open(CONTACT_LOOKUP_LOG, 'a') as file:
+                file.write(line + '\n')
+    except OSError as e:
+        print(f"Could not record the contact lookup for {domain}: {e}")
+
+
+def read_lookup_log(path):
+    """
+    Read successful lookups from a lookup log.
+
+    Parameters:
+        path (str): The JSONL log written by `record_lookup`.
+
+    Returns:
+        dict: Domain -> list of (checked_at, privacy_url, email) with a valid email, oldest first.
+    """
+    lookups = {}
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            email = entry.get('email') or ''
+            if '@' not in email or not entry.get('domain'):
+                continue
+            lookups.setdefault(entry['domain'].casefold(), []).append(
+                (entry['checked_at'], entry.get('privacy_url', ''), email)
+            )
+    for entries in lookups.values():
+        entries.sort()
+    return lookups
+
+
+def build_index(log_path, output_path, min_lookups=1):
+    """
+    Build the index from a lookup log, keeping entries of the existing index that the log does not cover.
+
+    Parameters:
+        log_path (str): The lookup log.
+        output_path (str): The SQLite file to (re)create.
+        min_lookups (int, optional): Number of most recent lookups of a domain that must agree on the email.
+
+    Returns:
+        tuple: The number of (indexed, refreshed from the log) domains.
+    """
+    rows = {}
+    if os.path.exists(output_path):
+        existing = sqlite3.connect(output_path)
+        try:
+            for row in existing.execute('SELECT domain, privacy_url, email, verified_at FROM contacts'):
+                rows[row[0]] = row
+        finally:
+            existing.close()
+
+    refreshed = 0
+    for domain, entries in read_lookup_log(log_path).items():
+        recent = entries[-min_lookups:]
+        if len(recent) < min_lookups or len({email.casefold() for _, _, email in recent}) > 1:
+            continue
+        checked_at, privacy_url, email = recent[-1]
+        rows[domain] = (domain, privacy_url, email, checked_at[:10])
+        refreshed += 1
+
+    # write next to the target and swap it in, so a running app never sees a half-written file
+    tmp_path = f'{output_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    with sqlite3.connect(tmp_path) as connection:
+        connection.execute('CREATE TABLE contacts (domain TEXT PRIMARY KEY, privacy_url TEXT NOT NULL, '
+                           'email TEXT NOT NULL, verified_at TEXT NOT NULL) WITHOUT ROWID')
+        connection.executemany('INSERT INTO contacts VALUES (?, ?, ?, ?)', sorted(rows.values()))
+    connection.close()
+    os.replace(tmp_path, output_path)
+    return len(rows), refreshed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the bundled GDPR contact index.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="Rebuild the index from the live lookup log")
+    build_parser.add_argument('--log', default=CONTACT_LOOKUP_LOG, help="The lookup log")
+    build_parser.add_argument('--output', default=CONTACT_INDEX_PATH, help="The index file")
+    build_parser.add_argument('--min-lookups', type=int, default=1,
+                              help="Most recent lookups of a domain that must agree (default: 1)")
+
+    lookup_parser = subparsers.add_parser('lookup', help="Look up a domain in the index")
+    lookup_parser.add_argument('domain', help="Registrable domain, e.g. adidas.com")
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if not os.path.exists(args.log):
+            parser.error(f"no lookup log at {args.log}")
+        indexed, refreshed = build_index(args.log, args.output, args.min_lookups)
+        print(f"Indexed {indexed} domain(s) in {args.output}, {refreshed} refreshed from {args.log}")
+    else:
+        print(lookup_contact(args.domain) or f"{args.domain} is not indexed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import json
+import re
+from collections import Counter
+from email.utils import parseaddr
+from urllib.parse import urlsplit
+
+# legal-form and filler words dropped when comparing company names
+NAME_STOPWORDS = {
+    'inc', 'ltd', 'llc', 'gmbh', 'ag', 'sa', 'sas', 'bv', 'nv', 'plc', 'co', 'corp', 'corporation', 'company',
+    'limited', 'group', 'sp', 'z', 'o', 'oo', 'the', 'team',
+}
+
+_tld_extractor = None
+
+
+def registrable_domain(url_or_host):
+    """
+    Reduce a URL or host name to its registrable domain (eTLD+1), e.g. "https://www.shop.example.co.uk/" -> "example.co.uk".
+
+    Parameters:
+        url_or_host (str): A URL, with or without scheme, or a bare host name.
+
+    Returns:
+        str: The lowercase registrable domain, or an empty string if none can be derived.
+    """
+    global _tld_extractor
+    if not url_or_host:
+        return ''
+
+    if '://' not in url_or_host:
+        url_or_host = f'http://{url_or_host}'
+    host = (urlsplit(url_or_host.strip()).hostname or '').lower().rstrip('.')
+    if not host:
+        return ''
+
+    if _tld_extractor is None:
+        import tldextract
+        # use the public suffix list snapshot bundled with the package instead of downloading it at runtime
+        _tld_extractor = tldextract.TLDExtract(suffix_list_urls=())
+
+    extracted = _tld_extractor(host)
+    if not extracted.domain or not extracted.suffix:
+        return ''
+    return f'{extracted.domain}.{extracted.suffix}'
+
+
+def sender_domain(sender):
+    """
+    Extract the registrable domain of an email sender, e.g. 'adidas <adidas@pl-news.adidas.com>' -> "adidas.com".
+
+    Parameters:
+        sender (str): The value of the From header.
+
+    Returns:
+        str: The registrable domain of the sender address, or an empty string.
+    """
+    _, address = parseaddr(sender or '')
+    if '@' not in address:
+        return ''
+    return registrable_domain(address.rsplit('@', 1)[1])
+
+
+def normalize_company_name(name):
+    """
+    Normalize a company name for alias matching, e.g. "Adidas GmbH" and "adidas" both become "adidas".
+
+    Parameters:
+        name (str): The company name as inferred by Gemini.
+
+    Returns:
+        str: The casefolded name without punctuation and legal-form words.
+    """
+    words = re.findall(r'\w+', (name or '').casefold())
+    return ' '.join(word for word in words if word not in NAME_STOPWORDS)
+
+
+def parse_classification(email_info):
+    """
+    Parse the JSON-encoded classification stored under "Interaction Type" of a scanned email.
+
+    Parameters:
+        email_info (dict): A value of `email_data`.
+
+    Returns:
+        dict: The classification with "category", "company_name" and "website" (missing keys default to "").
+    """
+    classification = email_info.get("Interaction Type", "{}")
+    if isinstance(classification, str):
+        try:
+            classification = json.loads(classification)
+        except ValueError:
+            classification = {}
+    return classification
+
+
+class CompanyEntity:
+    """
+    A real-world company seen in the inbox, merged from all its name variants and websites.
+    """
+
+    def __init__(self, key: str, domain: str):
+        self.key = key
+        self.domain = domain
+        self.names = Counter()
+        self.websites = Counter()
+        self.categories = Counter()
+        self.messages = 0
+        self.first_seen = None
+        self.last_seen = None
+
+    def add(self, name, website, category, date):
+        if name:
+            self.names[name] += 1
+        if website:
+            self.websites[website] += 1
+        if category:
+            self.categories[category] += 1
+        self.messages += 1
+        # only ISO dates are comparable; unparsed raw header dates are ignored
+        if date and re.fullmatch(r'\d{4}-\d{2}-\d{2}', date):
+            self.first_seen = min(self.first_seen or date, date)
+            self.last_seen = max(self.last_seen or date, date)
+
+    @property
+    def name(self):
+        return self.names.most_common(1)[0][0] if self.names else self.domain
+
+    @property
+    def website(self):
+        if self.websites:
+            return self.websites.most_common(1)[0][0]
+        return f'https://{self.domain}' if self.domain else ''
+
+    @property
+    def category(self):
+        # a single user-triggered email is enough to know the company holds the user's data
+        for category in self.categories:
+            if category.casefold() == 'interacted':
+                return category
+        return self.categories.most_common(1)[0][0] if self.categories else ''
+
+
+class EntityIndex:
+    """
+    Resolve scanned emails to company entities keyed by registrable domain, merging company name aliases.
+    """
+
+    def __init__(self):
+        self.entities = {}
+        self.aliases = {}
+        self.labels = {}
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build an index from flat scan result records in a single pass, e.g. as read lazily from a results file.
+
+        Parameters:
+            records (iterable of dict): Records with "sender", "date", "category", "company_name" and "website",
+                                        see `scan_results.iter_records`.
+
+        Returns:
+            EntityIndex: The populated index.
+        """
+        index = cls()
+        # emails with a website go first so that name-only emails can be matched against their aliases;
+        # only the name-only ones are held back
+        without_website = []
+        for record in records:
+            if record.get('website'):
+                index.add_record(record)
+            else:
+                without_website.append(record)
+        for record in without_website:
+            index.add_record(record)
+        return index
+
+    def add_record(self, record):
+        """
+        Add a flat scan result record, see `scan_results.flatten_email`, to its entity, creating it if needed.
+
+        The entity is found by the registrable domain of the inferred website (folding country domains of the
+        same brand together), then by a known alias of the company name, and finally by the sender's domain.
+
+        Parameters:
+            record (dict): The record.
+
+        Returns:
+            CompanyEntity: The entity the email was added to.
+        """
+        return self._add(record.get('company_name') or '', record.get('website') or '',
+                         record.get('category') or '', record.get('sender'), record.get('date'))
+
+    def _add(self, name, website, category, sender, date):
+        alias = normalize_company_name(name)
+
+        domain = registrable_domain(website)
+        if domain:
+            key = self._match_country_domain(domain, alias) or domain
+        elif alias in self.aliases:
+            key = self.aliases[alias]
+        else:
+            domain = sender_domain(sender)
+            key = domain or f'name:{alias}'
+
+        entity = self.entities.get(key)
+        if entity is None:
+            entity = self.entities[key] = CompanyEntity(key, domain)
+            if domain:
+                self.labels.setdefault(domain.split('.', 1)[0], key)
+        if alias:
+            self.aliases.setdefault(alias, key)
+
+        entity.add(name, website, category, date)
+        return entity
+
+    def _match_country_domain(self, domain, alias):
+        """
+        Find an existing entity for another country domain of the same brand, e.g. "adidas.pl" for "adidas.com".
+
+        The domain labels must be equal and the company name must start with that label or with the same
+        word as the existing entity's name, so unrelated companies sharing a label are kept apart.
+        """
+        label = domain.split('.', 1)[0]
+        key = self.labels.get(label)
+        if key is None or key == domain:
+            return None
+
+        first_word = alias.split(' ', 1)[0]
+        existing_first_word = normalize_company_name(self.entities[key].name).split(' ', 1)[0]
+        if first_word and first_word in (label, existing_first_word):
+            return key
+        return None
+
+    def rows(self):
+        """
+        Return one table row per entity, most frequent senders first.
+
+        Returns:
+            list: Dictionaries with "Company Name", "Interaction Type", "Website", "Messages", "First Seen" and "Last Seen".
+        """
+        entities = sorted(self.entities.values(), key=lambda entity: (-entity.messages, entity.name.casefold()))
+        return [{
+            "Company Name": entity.name,
+            "Interaction Type": entity.category,
+            "Website": entity.website,
+            "Messages": entity.messages,
+            "First Seen": entity.first_seen,
+            "Last Seen": entity.last_seen,
+        } for entity in entities]
@@ -0,0 +1,311 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+
+# connect timeout, and the longest wait for each read of the response, in seconds; a server that keeps
+# trickling bytes never trips the read timeout, so every attempt also has a total deadline
+DEFAULT_TIMEOUT = (3, 10)
+HTTP_TOTAL_TIMEOUT = float(os.getenv('HTTP_TOTAL_TIMEOUT', '30'))
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', '64'))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', '16'))
+# retries may add at most this fraction of extra requests, plus a small steady allowance
+HTTP_RETRY_RATIO = float(os.getenv('HTTP_RETRY_RATIO', '0.1'))
+HTTP_RETRY_MIN_PER_SECOND = float(os.getenv('HTTP_RETRY_MIN_PER_SECOND', '1'))
+HTTP_MAX_RETRIES = 2
+# a host failing this many times in a row is skipped for the cooldown instead of stalling every caller
+HTTP_CIRCUIT_FAILURES = 3
+HTTP_CIRCUIT_COOLDOWN = 30
+HTTP2_ENABLED = os.getenv('HTTP2', '0') == '1'
+RETRY_STATUSES = {429, 502, 503, 504}
+LATENCY_SAMPLES = 200
+# privacy page discovery touches many one-off domains, so only the most recently used hosts keep their stats
+HTTP_MAX_TRACKED_HOSTS = int(os.getenv('HTTP_MAX_TRACKED_HOSTS', '1024'))
+USER_AGENT = 'Mozilla/5.0 (compatible; TraceCtrl/1.0; +https://github.com/arsentievalex/tracectrl-app)'
+
+
+class HttpClientError(Exception):
+    """Raised when a request fails without a response: connection error, timeout, or an open circuit."""
+
+
+class HttpResponse:
+    """
+    A fully read response, independent of the HTTP library that fetched it.
+    """
+
+    def __init__(self, status_code: int, url: str, headers, content: bytes, truncated: bool = False):
+        self.status_code = status_code
+        self.url = url
+        self.headers = headers
+        self.content = content
+        self.truncated = truncated
+
+    @property
+    def text(self):
+        charset = 'utf-8'
+        for part in self.headers.get('Content-Type', '').split(';')[1:]:
+            key, _, value = part.strip().partition('=')
+            if key.casefold() == 'charset' and value:
+                charset = value.strip('"\'')
+        try:
+            return self.content.decode(charset, errors='replace')
+        except LookupError:
+            return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class RetryBudget:
+    """
+    Process-wide cap on retries, so that an outage of one host cannot multiply the load on everything else.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = max(10.0, min_per_second * 10)
+        self._tokens = self.capacity
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        # every first attempt earns a fraction of a retry
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._refilled_at) * self.min_per_second)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def snapshot(self):
+        ordered = sorted(self.latencies)
+
+        def percentile(fraction):
+            return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 1) if ordered else None
+
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'circuit_open': self.open_until > time.monotonic(),
+        }
+
+
+class HttpClient:
+    """
+    Pooled HTTP client shared by every outbound call of the process.
+
+    Connections are kept alive in per-host pools. Every request has connect and read timeouts, idempotent
+    requests are retried with jittered exponential backoff while the retry budget allows, and hosts that keep
+    failing are short-circuited for a while. Per-host latency and error counts are kept for diagnostics, for
+    the `HTTP_MAX_TRACKED_HOSTS` most recently used hosts.
+    """
+
+    def __init__(self, http2: bool = HTTP2_ENABLED):
+        """
+        Create a new instance of "HttpClient".
+
+        Parameters:
+            http2 (bool, optional): Use httpx with HTTP/2 if it is installed (`pip install httpx[http2]`).
+        """
+        self._lock = threading.Lock()
+        # host -> HostStats, least recently used first
+        self._hosts = OrderedDict()
+        self.retry_budget = RetryBudget(HTTP_RETRY_RATIO, HTTP_RETRY_MIN_PER_SECOND)
+        self.backend = None
+
+        if http2:
+            try:
+                import httpx
+                import h2  # noqa: F401, httpx only negotiates HTTP/2 when h2 is installed
+
+                self._client = httpx.Client(
+                    http2=True, follow_redirects=True, headers={'User-Agent': USER_AGENT},
+                    limits=httpx.Limits(max_connections=HTTP_POOL_HOSTS * HTTP_POOL_PER_HOST,
+                                        max_keepalive_connections=HTTP_POOL_HOSTS),
+                )
+                self._httpx = httpx
+                self.backend = 'httpx'
+            except ImportError:
+                print("HTTP2=1 but httpx[http2] is not installed, using requests")
+
+        if self.backend is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self._session = requests.Session()
+            self._session.headers['User-Agent'] = USER_AGENT
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST)
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+            self._requests = requests
+            self.backend = 'requests'
+
+    def _host(self, url):
+        host = urlsplit(url).netloc.rpartition('@')[2]
+        with self._lock:
+            stats = self._hosts.get(host)
+            if stats is None:
+                stats = self._hosts[host] = HostStats()
+                if len(self._hosts) > HTTP_MAX_TRACKED_HOSTS:
+                    self._hosts.popitem(last=False)
+            else:
+                self._hosts.move_to_end(host)
+            return stats
+
+    def _send(self, method, url, timeout, max_bytes, total_timeout, **kwargs):
+        deadline = time.monotonic() + total_timeout if total_timeout else None
+        if self.backend == 'httpx':
+            connect, read = timeout
+            try:
+                with self._client.stream(method, url, timeout=self._httpx.Timeout(read, connect=connect),
+                                         **kwargs) as response:
+                    content, truncated = _read_limited(response.iter_bytes(), max_bytes, deadline, url)
+                    return HttpResponse(response.status_code, str(response.url), response.headers, content, truncated)
+            except self._httpx.HTTPError as e:
+                raise HttpClientError(str(e)) from e
+
+        try:
+            with self._session.request(method, url, timeout=timeout, stream=True, allow_redirects=True,
+                                       **kwargs) as response:
+                content, truncated = _read_limited(response.iter_content(64 * 1024), max_bytes, deadline, url)
+                return HttpResponse(response.status_code, response.url, response.headers, content, truncated)
+        except self._requests.exceptions.RequestException as e:
+            raise HttpClientError(str(e)) from e
+
+    def request(self, method, url, timeout=DEFAULT_TIMEOUT, max_bytes=None, retries=None,
+                total_timeout=HTTP_TOTAL_TIMEOUT, **kwargs):
+        """
+        Send a request through the shared pools.
+
+        Parameters:
+            method (str): The HTTP method.
+            url (str): The URL.
+            timeout (tuple, optional): (connect, read) timeouts in seconds. The read timeout applies to each read,
+                                       not to the whole response.
+            max_bytes (int, optional): Stop reading the body after this many bytes.
+            retries (int, optional): Retries on connection errors and 429/5xx. Defaults to `HTTP_MAX_RETRIES`
+                                     for GET and HEAD, and to none for other methods.
+            total_timeout (float, optional): Seconds after which an attempt is abandoned while reading the body,
+                                             however steadily bytes arrive. None disables it.
+            **kwargs: Passed on to the HTTP library, e.g. `headers` or `json`.
+
+        Returns:
+            HttpResponse: The response, whatever its status code.
+
+        Raises:
+            HttpClientError: If no response was received, or the host's circuit is open.
+        """
+        if retries is None:
+            retries = HTTP_MAX_RETRIES if method.upper() in ('GET', 'HEAD') else 0
+        stats = self._host(url)
+        if stats.open_until > time.monotonic():
+            raise HttpClientError(f"{urlsplit(url).netloc} is failing, skipped until its cooldown ends")
+
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            error = None
+            response = None
+            try:
+                response = self._send(method, url, timeout, max_bytes, total_timeout, **kwargs)
+            except HttpClientError as e:
+                error = e
+            elapsed = time.monotonic() - started
+
+            with self._lock:
+                stats.requests += 1
+                stats.latencies.append(elapsed)
+                if error is not None or response.status_code >= 500:
+                    stats.errors += 1
+                    stats.consecutive_failures += 1
+                    if stats.consecutive_failures >= HTTP_CIRCUIT_FAILURES:
+                        stats.open_until = time.monotonic() + HTTP_CIRCUIT_COOLDOWN
+                else:
+                    stats.consecutive_failures = 0
+
+            retryable = error is not None or response.status_code in RETRY_STATUSES
+            if not retryable or attempt >= retries or stats.open_until > time.monotonic() \
+                    or not self.retry_budget.withdraw():
+                if error is not None:
+                    raise error
+                return response
+
+            attempt += 1
+            with self._lock:
+                stats.retries += 1
+            time.sleep(min(4.0, 0.25 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self, top=20):
+        """
+        Return per-host request, error and latency statistics.
+
+        Parameters:
+            top (int, optional): Number of hosts to include, the busiest first.
+
+        Returns:
+            dict: Host -> requests, errors, retries, p50/p95 latency in ms and whether its circuit is open.
+        """
+        with self._lock:
+            hosts = sorted(self._hosts.items(), key=lambda item: item[1].requests, reverse=True)[:top]
+            return {host: stats.snapshot() for host, stats in hosts}
+
+
+def _read_limited(chunks, max_bytes, deadline=None, url=''):
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if deadline is not None and time.monotonic() > deadline:
+            raise HttpClientError(f"{url} exceeded the total timeout")
+        parts.append(chunk)
+        size += len(chunk)
+        if max_bytes is not None and size >= max_bytes:
+            return b''.join(parts)[:max_bytes], True
+    return b''.join(parts), False
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """
+    Return the HTTP client shared by all sessions in this process, creating it on first use.
+
+    Returns:
+        HttpClient: The process-wide client.
+    """
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient()
+    return _http_client
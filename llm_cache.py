@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+
+# Tracking query strings, long ids and whitespace differ between otherwise identical
+# newsletters and templated confirmations, so they are stripped before hashing.
+_URL_QUERY_PATTERN = re.compile(r'(https?://[^\s?#]+)[?#]\S*')
+_DIGITS_PATTERN = re.compile(r'\d{4,}')
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+_ZERO_WIDTH_PATTERN = re.compile('[\u200b\u200c\u200d\u2060\ufeff\u034f\u00ad]')
+
+
+def normalize_text(text):
+    """
+    Normalize text so that near-identical inputs map to the same cache key.
+
+    Parameters:
+        text (str): The raw input text (email body or page content).
+
+    Returns:
+        str: The text without URL query strings, zero-width characters, long digit runs and repeated whitespace.
+    """
+    text = _ZERO_WIDTH_PATTERN.sub('', text)
+    text = _URL_QUERY_PATTERN.sub(r'\1', text)
+    text = _DIGITS_PATTERN.sub('0', text)
+    return _WHITESPACE_PATTERN.sub(' ', text).strip()
+
+
+def prompt_version(*templates):
+    """
+    Compute a short fingerprint of prompt templates, schemas and other static model inputs.
+
+    Parameters:
+        *templates: Strings or JSON-serializable objects that shape the model output.
+
+    Returns:
+        str: A 12-character hex digest that changes whenever any of the templates change.
+    """
+    digest = hashlib.sha256()
+    for template in templates:
+        if not isinstance(template, str):
+            template = json.dumps(template, sort_keys=True)
+        digest.update(template.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:12]
+
+
+class LLMCache:
+    """
+    Two-tier cache for LLM responses: an in-memory LRU in front of an on-disk store with size-based eviction.
+    """
+
+    def __init__(self, cache_dir: str, max_memory_entries: int = 1024, max_disk_bytes: int = 64 * 1024 * 1024):
+        """
+        Create a new instance of "LLMCache".
+
+        Parameters:
+            cache_dir (str): Directory holding the on-disk tier.
+            max_memory_entries (int): Maximum number of responses kept in the in-memory LRU.
+            max_disk_bytes (int): Size of the on-disk tier above which the least recently used files are evicted.
+        """
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_name, version, text):
+        """
+        Build the cache key for a model call.
+
+        Parameters:
+            model_name (str): The model the response comes from.
+            version (str): The prompt template version, see `prompt_version`.
+            text (str): The variable model input; it is normalized before hashing.
+
+        Returns:
+            str: A hex SHA-256 digest.
+        """
+        payload = json.dumps([model_name, version, normalize_text(text)])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """
+        Look up a response, promoting disk hits into the in-memory tier.
+
+        Parameters:
+            key (str): The key from `make_key`.
+
+        Returns:
+            str or None: The cached response, or None on a miss.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, 'r') as file:
+                value = json.load(file)['response']
+            # bump mtime so that disk eviction is least-recently-used rather than oldest-written
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        """
+        Store a response in both tiers.
+
+        Parameters:
+            key (str): The key from `make_key`.
+            value (str): The model response.
+
+        Returns:
+            None
+        """
+        self._remember(key, value)
+
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump({'response': value}, file)
+            os.replace(tmp_path, path)
+            written = os.path.getsize(path)
+        except OSError as e:
+            print(f"Could not write LLM cache entry {key}: {e}")
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            else:
+                self._disk_bytes += written
+            over_budget = self._disk_bytes > self.max_disk_bytes
+
+        if over_budget:
+            self._evict_disk()
+
+    def get_or_compute(self, key, compute, stats=None):
+        """
+        Return the cached response for `key`, calling `compute` and caching its result on a miss.
+
+        Parameters:
+            key (str): The key from `make_key`.
+            compute (callable): Zero-argument function producing the response.
+            stats (collections.Counter, optional): Per-caller counter incremented under "hits" or "misses".
+
+        Returns:
+            str: The cached or freshly computed response. Falsy results are returned but not cached.
+        """
+        value = self.get(key)
+        hit = value is not None
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if stats is not None:
+            stats['hits' if hit else 'misses'] += 1
+        if hit:
+            return value
+
+        value = compute()
+        if value:
+            self.set(key, value)
+        return value
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def _list_disk_entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_disk_bytes(self):
+        return sum(size for _, size, _ in self._list_disk_entries())
+
+    def _evict_disk(self):
+        # trim to 90% of the budget so that eviction does not run on every single write
+        target = int(self.max_disk_bytes * 0.9)
+        entries = sorted(self._list_disk_entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        with self._lock:
+            self._disk_bytes = total
+
+    def stats(self):
+        """
+        Return process-wide cache statistics.
+
+        Returns:
+            dict: "hits", "misses", "hit_ratio" and the number of in-memory entries.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+            }
+
+
+def hit_ratio(stats):
+    """
+    Compute the hit ratio from a per-caller counter filled by `LLMCache.get_or_compute`.
+
+    Parameters:
+        stats (collections.Counter): Counter with "hits" and "misses" keys.
+
+    Returns:
+        float: Ratio of hits to lookups, 0.0 if there were no lookups.
+    """
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else 0.0
@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+from llm_scheduler import PRIORITY_BULK, DeadlineExceededError, get_llm_scheduler
+
+VERTEX_LOCATION = 'us-central1'
+# answers below this confidence are escalated to the next route
+ROUTER_MIN_CONFIDENCE = float(os.getenv('ROUTER_MIN_CONFIDENCE', '0.7'))
+
+
+class Route:
+    """
+    One step of a routing ladder: a model with its own output-token budget and number of attempts.
+    """
+
+    def __init__(self, name: str, model_name: str, max_output_tokens: int, attempts: int = 1):
+        """
+        Create a new instance of "Route".
+
+        Parameters:
+            name (str): Short name used in logs and metrics, e.g. "fast".
+            model_name (str): The Vertex AI model, e.g. "gemini-1.5-flash-001".
+            max_output_tokens (int): Hard limit on the tokens the model may generate.
+            attempts (int, optional): How many times the route is tried when its output is invalid.
+        """
+        self.name = name
+        self.model_name = model_name
+        self.max_output_tokens = max_output_tokens
+        self.attempts = attempts
+
+    def describe(self):
+        return [self.name, self.model_name, self.max_output_tokens, self.attempts]
+
+
+class RouteMetrics:
+    """
+    Process-wide call, latency and token counters per route.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def record(self, route, seconds, usage, outcome):
+        with self._lock:
+            counters = self._counters.setdefault(route.name, Counter())
+            counters['calls'] += 1
+            counters['seconds'] += seconds
+            counters['prompt_tokens'] += usage.get('prompt_tokens', 0)
+            counters['output_tokens'] += usage.get('output_tokens', 0)
+            counters[outcome] += 1
+
+    def snapshot(self):
+        """
+        Return the counters of every route.
+
+        Returns:
+            dict: Per route: calls, average latency, prompt and output tokens, and how many answers were
+                  "accepted", "low_confidence", "invalid" or "failed".
+        """
+        with self._lock:
+            snapshot = {}
+            for name, counters in self._counters.items():
+                stats = dict(counters)
+                stats['average_seconds'] = round(stats.pop('seconds') / stats['calls'], 3)
+                snapshot[name] = stats
+            return snapshot
+
+
+route_metrics = RouteMetrics()
+
+_vertex_initialized = False
+_vertex_lock = threading.Lock()
+
+
+def init_vertex():
+    """
+    Initialize Vertex AI with the service account once per process.
+
+    Returns:
+        None
+    """
+    global _vertex_initialized
+    with _vertex_lock:
+        if _vertex_initialized:
+            return
+        import google.auth
+        import vertexai
+
+        credentials, project_id = google.auth.load_credentials_from_file('service_acc.json')
+        vertexai.init(project=project_id, location=VERTEX_LOCATION, credentials=credentials)
+        _vertex_initialized = True
+
+
+def usage_of(response):
+    """
+    Read the token usage of a Vertex AI response.
+
+    Parameters:
+        response (vertexai.generative_models.GenerationResponse): The model response.
+
+    Returns:
+        dict: "prompt_tokens" and "output_tokens", zero when the response carries no usage metadata.
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_token_count', 0) or 0,
+        'output_tokens': getattr(usage, 'candidates_token_count', 0) or 0,
+    }
+
+
+def response_text(response):
+    # a response cut off by the token limit, or blocked, has no usable text
+    try:
+        candidate = response.candidates[0]
+        if candidate.finish_reason.name not in ('STOP', 'FINISH_REASON_UNSPECIFIED'):
+            return None
+        return response.text
+    except (IndexError, AttributeError, ValueError):
+        return None
+
+
+class StructuredRouter:
+    """
+    Send a structured-output prompt up a ladder of routes, cheapest first.
+
+    An answer is accepted as soon as it matches the schema and its "confidence" reaches the threshold.
+    Invalid answers are retried on the same route as many times as the route allows, then escalated;
+    low-confidence answers are escalated right away. If no route produces a confident answer, the most
+    confident valid one is returned.
+    """
+
+    def __init__(self, name: str, routes: list, system_instruction: str, response_schema: dict, validate,
+                 min_confidence: float = ROUTER_MIN_CONFIDENCE):
+        """
+        Create a new instance of "StructuredRouter".
+
+        Parameters:
+            name (str): Name of the task, used in logs.
+            routes (list of Route): The ladder, cheapest route first.
+            system_instruction (str): System instruction for every model.
+            response_schema (dict): Vertex AI response schema; it must contain a numeric "confidence".
+            validate (callable): Takes the response text and returns the parsed dict, or None if it is invalid.
+            min_confidence (float, optional): Confidence needed to accept an answer without escalating.
+        """
+        self.name = name
+        self.routes = routes
+        self.system_instruction = system_instruction
+        self.response_schema = response_schema
+        self.validate = validate
+        self.min_confidence = min_confidence
+
+    def version_parts(self):
+        """Return what identifies the routing policy, for prompt versioning of cached answers."""
+        return [route.describe() for route in self.routes] + [self.min_confidence]
+
+    def _call(self, route, prompt, user, priority, deadline):
+        from vertexai.generative_models import GenerativeModel, GenerationConfig
+
+        init_vertex()
+        model = GenerativeModel(route.model_name, system_instruction=self.system_instruction)
+        config = GenerationConfig(response_mime_type='application/json', response_schema=self.response_schema,
+                                  max_output_tokens=route.max_output_tokens, temperature=0)
+
+        with get_llm_scheduler().slot(user, priority, deadline):
+            started = time.monotonic()
+            try:
+                response = model.generate_content([prompt], generation_config=config)
+            except Exception:
+                route_metrics.record(route, time.monotonic() - started, {}, 'failed')
+                raise
+        return response, time.monotonic() - started
+
+    def run(self, prompt, user=None, priority=PRIORITY_BULK, deadline=None):
+        """
+        Answer a prompt on the cheapest route that gives a valid, confident answer.
+
+        Parameters:
+            prompt (str): The formatted prompt.
+            user (str, optional): The requesting user's id, for fair queuing of the model calls.
+            priority (int, optional): Scheduler priority of the calls.
+            deadline (float, optional): `time.monotonic()` value after which no further model call is admitted.
+
+        Returns:
+            tuple: The parsed answer (dict, or None if no route produced a valid one) and the name of the
+                   route that produced it.
+
+        Raises:
+            DeadlineExceededError: If no valid answer was found before `deadline`. Past the deadline, an unsure
+                                   answer is returned rather than escalated.
+            Exception: Errors of the model call, e.g. rate limiting, are not handled here.
+        """
+        best, best_route = None, None
+        for route in self.routes:
+            for _ in range(route.attempts):
+                try:
+                    response, seconds = self._call(route, prompt, user, priority, deadline)
+                except DeadlineExceededError:
+                    if best is None:
+                        raise
+                    return best, best_route
+                usage = usage_of(response)
+                text = response_text(response)
+                answer = self.validate(text) if text else None
+
+                if answer is None:
+                    outcome = 'invalid'
+                elif answer['confidence'] < self.min_confidence:
+                    outcome = 'low_confidence'
+                else:
+                    outcome = 'accepted'
+                route_metrics.record(route, seconds, usage, outcome)
+                print(f"{self.name} via {route.name} ({route.model_name}): {outcome} in {seconds:.2f}s, "
+                      f"{usage['prompt_tokens']} prompt + {usage['output_tokens']} output tokens")
+
+                if answer is None:
+                    continue
+                if best is None or answer['confidence'] > best['confidence']:
+                    best, best_route = answer, route.name
+                if outcome == 'accepted':
+                    return answer, route.name
+                # a valid but unsure answer is not retried on the same model
+                break
+        return best, best_route
+
+
+def parse_json_object(text, required, enums=None):
+    """
+    Parse a model answer that must be a JSON object with the given keys and a confidence between 0 and 1.
+
+    Parameters:
+        text (str): The response text.
+        required (iterable of str): Keys that must be present with string values, besides "confidence".
+        enums (dict, optional): Allowed values per key.
+
+    Returns:
+        dict or None: The object with "confidence" as a float, or None if it does not match.
+    """
+    try:
+        answer = json.loads(text)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(answer, dict):
+        return None
+    for key in required:
+        if not isinstance(answer.get(key), str):
+            return None
+    for key, allowed in (enums or {}).items():
+        if answer.get(key) not in allowed:
+            return None
+    try:
+        confidence = float(answer.get('confidence'))
+    except (TypeError, ValueError):
+        return None
+    if not 0 <= confidence <= 1:
+        return None
+    answer['confidence'] = confidence
+    return answer
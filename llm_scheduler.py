@@ -0,0 +1,239 @@
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+PRIORITY_INTERACTIVE = 0  # a user is waiting on a single lookup, e.g. the email preview
+PRIORITY_BULK = 1  # inbox scans and bulk sends
+PRIORITY_BACKGROUND = 2  # scheduled pre-scans, nobody is waiting on them
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BULK: 'bulk', PRIORITY_BACKGROUND: 'background'}
+
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv('GEMINI_REQUESTS_PER_MINUTE', '60'))
+GEMINI_BURST = int(os.getenv('GEMINI_BURST', '5'))
+GEMINI_RATE_LIMIT_BACKOFF = float(os.getenv('GEMINI_RATE_LIMIT_BACKOFF', '60'))
+# tokens background requests leave in the bucket, so that a user arriving mid pre-scan is admitted at once
+GEMINI_BACKGROUND_RESERVE = int(os.getenv('GEMINI_BACKGROUND_RESERVE', '2'))
+
+
+def is_rate_limit_error(error):
+    """
+    Check whether an exception from Vertex AI means the quota is exhausted.
+
+    Parameters:
+        error (Exception): The exception raised by the model call.
+
+    Returns:
+        bool: True for 429 / "Quota exceeded" errors.
+    """
+    return '429' in str(error) or 'Quota exceeded' in str(error)
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a Gemini call is not admitted before the caller's deadline."""
+
+
+class FairShareScheduler:
+    """
+    Process-wide admission control for Gemini calls shared by all Streamlit sessions.
+
+    A global token bucket enforces the request rate. Interactive requests are always admitted before bulk ones,
+    and background requests only run while they leave a reserve of tokens in the bucket. Within a priority,
+    users are served round-robin, so one long scan cannot starve other sessions.
+    """
+
+    def __init__(self, requests_per_minute: float, burst: int, rate_limit_backoff: float, background_reserve: int = 0):
+        """
+        Create a new instance of "FairShareScheduler".
+
+        Parameters:
+            requests_per_minute (float): Sustained admission rate of the token bucket.
+            burst (int): Bucket capacity, i.e. how many requests may be admitted back to back.
+            rate_limit_backoff (float): Seconds during which nothing is admitted after a 429.
+            background_reserve (int, optional): Tokens that background requests must leave in the bucket.
+        """
+        self.rate = requests_per_minute / 60
+        self.burst = burst
+        self.rate_limit_backoff = rate_limit_backoff
+        # the reserve can never exceed what the bucket holds, or background work would never run
+        self.background_reserve = min(background_reserve, max(burst - 1, 0))
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        # per priority: user -> deque of waiting tickets, and the round-robin order of users
+        self._waiting = {priority: {} for priority in PRIORITY_NAMES}
+        self._turns = {priority: deque() for priority in PRIORITY_NAMES}
+        self._granted = Counter()
+        self._wait_seconds = Counter()
+        self._rate_limited = 0
+        self._max_depth = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _next_ticket(self):
+        for priority in sorted(self._turns):
+            if self._turns[priority]:
+                user = self._turns[priority][0]
+                return priority, user, self._waiting[priority][user][0]
+        return None
+
+    def _withdraw(self, priority, user, ticket):
+        # callers hold the lock; drops a ticket that will never be granted, wherever it is in the queue
+        queues = self._waiting[priority]
+        queues[user].remove(ticket)
+        if not queues[user]:
+            del queues[user]
+            self._turns[priority].remove(user)
+        self._cond.notify_all()
+
+    def _depth(self):
+        return sum(len(tickets) for queues in self._waiting.values() for tickets in queues.values())
+
+    def acquire(self, user, priority=PRIORITY_BULK, deadline=None):
+        """
+        Block until the caller may send one request to Gemini.
+
+        Parameters:
+            user (str): Identifier of the session's user, used for fair queuing.
+            priority (int, optional): `PRIORITY_INTERACTIVE`, `PRIORITY_BULK` or `PRIORITY_BACKGROUND`.
+            deadline (float, optional): `time.monotonic()` value after which the caller stops waiting.
+
+        Returns:
+            float: Seconds spent waiting in the queue.
+
+        Raises:
+            DeadlineExceededError: If the request is not admitted before `deadline`; its ticket is withdrawn.
+        """
+        user = user or 'anonymous'
+        ticket = object()
+        needed = 1 + (self.background_reserve if priority == PRIORITY_BACKGROUND else 0)
+        enqueued_at = time.monotonic()
+
+        with self._cond:
+            queues = self._waiting[priority]
+            if user not in queues:
+                queues[user] = deque()
+                self._turns[priority].append(user)
+            queues[user].append(ticket)
+            self._max_depth = max(self._max_depth, self._depth())
+
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    head = self._next_ticket()
+                    if head[2] is ticket and self._tokens >= needed and now >= self._paused_until:
+                        break
+                    if deadline is not None and now >= deadline:
+                        raise DeadlineExceededError(f"Gemini request for {user} was not admitted in time")
+                    if now < self._paused_until:
+                        timeout = self._paused_until - now
+                    else:
+                        timeout = max((needed - self._tokens) / self.rate, 0.01)
+                    if deadline is not None:
+                        timeout = min(timeout, max(deadline - now, 0.01))
+                    self._cond.wait(min(timeout, 1.0))
+            except BaseException:
+                # e.g. the deadline, or a Streamlit rerun stopping the script thread; a dead ticket at the head
+                # would block everyone
+                self._withdraw(priority, user, ticket)
+                raise
+
+            self._tokens -= 1
+            queues[user].popleft()
+            turns = self._turns[priority]
+            turns.popleft()
+            if queues[user]:
+                # the user goes to the back of the line for their next request
+                turns.append(user)
+            else:
+                del queues[user]
+
+            waited = time.monotonic() - enqueued_at
+            self._granted[PRIORITY_NAMES[priority]] += 1
+            self._wait_seconds[PRIORITY_NAMES[priority]] += waited
+            self._cond.notify_all()
+
+        if waited > 1:
+            print(f"Gemini request for {user} ({PRIORITY_NAMES[priority]}) waited {waited:.1f}s in the queue")
+        return waited
+
+    def report_rate_limited(self):
+        """
+        Pause admissions for every session after a 429, instead of each session discovering the limit on its own.
+
+        Returns:
+            None
+        """
+        with self._cond:
+            self._rate_limited += 1
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, time.monotonic() + self.rate_limit_backoff)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, user, priority=PRIORITY_BULK, deadline=None):
+        """
+        Context manager around one Gemini call: waits for admission and reports rate-limit errors.
+
+        Parameters:
+            user (str): Identifier of the session's user.
+            priority (int, optional): `PRIORITY_INTERACTIVE`, `PRIORITY_BULK` or `PRIORITY_BACKGROUND`.
+            deadline (float, optional): `time.monotonic()` value after which admission is given up,
+                                        see `acquire`.
+        """
+        self.acquire(user, priority, deadline)
+        try:
+            yield
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self.report_rate_limited()
+            raise
+
+    def metrics(self):
+        """
+        Return queue and admission metrics.
+
+        Returns:
+            dict: Current queue depth per priority and per user, maximum depth seen, admitted requests
+                  and average wait per priority, rate-limit events and seconds until admissions resume.
+        """
+        with self._cond:
+            depth_by_user = Counter()
+            for queues in self._waiting.values():
+                for user, tickets in queues.items():
+                    depth_by_user[user] += len(tickets)
+
+            return {
+                'queue_depth': {PRIORITY_NAMES[priority]: sum(len(tickets) for tickets in queues.values())
+                                for priority, queues in self._waiting.items()},
+                'queue_depth_by_user': dict(depth_by_user),
+                'max_queue_depth': self._max_depth,
+                'admitted': dict(self._granted),
+                'average_wait_seconds': {name: round(self._wait_seconds[name] / count, 3)
+                                         for name, count in self._granted.items()},
+                'rate_limited': self._rate_limited,
+                'paused_for_seconds': round(max(0.0, self._paused_until - time.monotonic()), 1),
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_llm_scheduler():
+    """
+    Return the scheduler shared by all sessions in this process, creating it on first use.
+
+    Returns:
+        FairShareScheduler: The process-wide scheduler.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FairShareScheduler(GEMINI_REQUESTS_PER_MINUTE, GEMINI_BURST, GEMINI_RATE_LIMIT_BACKOFF,
+                                            GEMINI_BACKGROUND_RESERVE)
+    return _scheduler
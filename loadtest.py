@@ -0,0 +1,361 @@
+"""
+Multi-session load test for the Streamlit app, built on `streamlit.testing.v1.AppTest`.
+
+Every simulated session logs in, runs a quick scan, scans the inbox, edits the results table (search, select
+all matching, bulk request type, paging) and runs a bulk send. Google sign-in, Gmail, Gemini, Firecrawl and logo.dev are
+stubbed, so only the app's own rerun cost is measured. The report lists per-step rerun latency percentiles
+and the memory held per live session (peak RSS growth by default, or the retained Python heap with
+--tracemalloc, which is exact but slows every rerun down).
+
+Usage:
+    python loadtest.py [--sessions 50] [--concurrency 10] [--emails 500] [--tracemalloc] [--json report.json]
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import traceback
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+# bare-mode warnings from the worker threads would drown the report
+os.environ.setdefault('STREAMLIT_LOGGER_LEVEL', 'error')
+# scans take the (stubbed) Gmail path rather than streaming the bundled demo results
+os.environ['DEMO_DATA_PATH'] = ''
+
+from streamlit import config
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import magic, script_cache
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1.util import build_mock_config_get_option
+
+
+APP_PATH = 'app.py'
+RUN_TIMEOUT = 60  # seconds allowed for a single rerun
+SAMPLE_WEBSITES = ['adidas.com', 'zara.com', 'uber.com', 'spotify.com', 'booking.com', 'linkedin.com', 'vinted.pl']
+LOGO_DATA_URI = 'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=='
+
+
+def load_test_session_id():
+    """
+    Stand in for `session_store.current_session_id`: AppTest gives every session the id "test session id",
+    so the simulated sessions are told apart by their user, or they would share one slot of the artifact store.
+    """
+    import streamlit as st
+
+    return f"session-{st.session_state.get('oauth_id', 'default')}"
+
+
+class StubAuthenticator:
+    """Stands in for `streamlit_auth.Authenticate`; sessions are logged in through session state instead."""
+
+    def login(self, *args, **kwargs):
+        pass
+
+    def logout(self):
+        pass
+
+
+def synthetic_email_data(count):
+    """
+    Build scan results shaped like `process_emails` output, with many companies and repeat senders.
+
+    Parameters:
+        count (int): Number of emails.
+
+    Returns:
+        dict: Scan results keyed by message id.
+    """
+    email_data = {}
+    for index in range(count):
+        # every third company reuses a well-known domain so entity merging has work to do
+        if index % 3 == 0:
+            domain = SAMPLE_WEBSITES[index % len(SAMPLE_WEBSITES)]
+        else:
+            domain = f"company{index % max(count // 4, 1)}.com"
+        name = domain.split('.')[0].capitalize()
+        email_data[f"msg{index:06d}"] = {
+            "Subject": f"Your order #{index}" if index % 5 == 0 else f"Newsletter {index}",
+            "Sender": f"{name} <noreply@{domain}>",
+            "Date": f"2024-10-{index % 28 + 1:02d}",
+            "Interaction Type": json.dumps({
+                "category": "Interacted" if index % 5 == 0 else "Not Interacted",
+                "company_name": name,
+                "website": f"https://www.{domain}",
+            }),
+        }
+    return email_data
+
+
+def stub_external_services(email_data):
+    """
+    Patch every call that leaves the process.
+
+    Parameters:
+        email_data (dict): Scan results returned for every full scan; quick scans return a quarter of them.
+
+    Returns:
+        list: The started patchers, to be stopped after the run.
+    """
+    # a quick scan returns part of the inbox, as when its time budget runs out
+    quick_scan_results = dict(list(email_data.items())[:max(len(email_data) // 4, 1)])
+    patchers = [
+        mock.patch('utils.google_authenticate', return_value=StubAuthenticator()),
+        mock.patch('utils.build_gmail_service', return_value=object()),
+        mock.patch('utils.process_emails', side_effect=lambda *args, budget_seconds=None, **kwargs: (
+            quick_scan_results if budget_seconds is not None else email_data)),
+        mock.patch('sharded_scan.process_emails_sharded', return_value=email_data),
+        mock.patch('utils.fetch_logo_data_uris', side_effect=lambda domains, limit=42: [LOGO_DATA_URI] * min(limit, len(domains))),
+        mock.patch('utils.find_gdpr_contact', return_value='privacy@example.com'),
+        mock.patch('utils.find_gdpr_contacts', side_effect=lambda domains, user=None, priority=None: {
+            domain: 'privacy@example.com' for domain in domains}),
+        mock.patch('utils.send_message', return_value={'id': 'stub'}),
+        mock.patch('utils.prewarm_heavy_imports'),
+        mock.patch('session_store.current_session_id', side_effect=load_test_session_id),
+    ]
+    for patcher in patchers:
+        patcher.start()
+    return patchers
+
+
+def serialize_script_compilation():
+    """
+    Compile the app under a lock: every AppTest session compiles the script on its own runner thread, and
+    concurrent `ast.parse` calls are not thread-safe on CPython 3.11 ("AST constructor recursion depth mismatch").
+
+    Returns:
+        The started patcher, to be stopped after the run.
+    """
+    lock = threading.Lock()
+    add_magic = magic.add_magic
+
+    def locked_add_magic(code, script_path):
+        with lock:
+            return add_magic(code, script_path)
+
+    patcher = mock.patch.object(script_cache.magic, 'add_magic', locked_add_magic)
+    patcher.start()
+    return patcher
+
+
+def share_app_test_globals():
+    """
+    Keep AppTest's process-wide state in place for the whole run.
+
+    Every AppTest run installs a mock `Runtime` and turns the "global.appTest" option on, and undoes both when
+    it ends, so a session finishing pulls them from under the sessions still running ("Runtime hasn't been
+    created!", or widgets missing their test metadata). The option is set once instead, and the last runtime
+    installed stays in use after its run cleared it; the runtimes only hold in-memory managers.
+
+    Returns:
+        list: The started patchers, to be stopped after the run.
+    """
+    latest = []
+
+    def instance():
+        runtime = Runtime._instance
+        if runtime is not None:
+            latest[:] = [runtime]
+        if not latest:
+            raise RuntimeError("Runtime hasn't been created!")
+        return latest[0]
+
+    patchers = [
+        mock.patch.object(config, 'get_option', build_mock_config_get_option({'global.appTest': True})),
+        mock.patch('streamlit.testing.v1.app_test.patch_config_options', lambda overrides: contextlib.nullcontext()),
+        mock.patch.object(Runtime, 'instance', staticmethod(instance)),
+        mock.patch.object(Runtime, 'exists', staticmethod(lambda: Runtime._instance is not None or bool(latest))),
+    ]
+    for patcher in patchers:
+        patcher.start()
+    return patchers
+
+
+def find_widget(widgets, label_prefix):
+    for widget in widgets:
+        if widget.label.startswith(label_prefix):
+            return widget
+    return None
+
+
+class SessionResult:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.missing = []
+        self.errors = []
+        self.step = None
+        self.app = None
+
+
+def timed_run(app, result, step):
+    result.step = step
+    started = time.perf_counter()
+    app.run(timeout=RUN_TIMEOUT)
+    result.latencies[step].append((time.perf_counter() - started) * 1000)
+    if app.exception:
+        result.errors.append(f"{step}: {app.exception[0].message}")
+
+
+def simulate_session(session_index):
+    """
+    Drive one user session through login, a quick scan, a full scan, table edits and a bulk send.
+
+    Parameters:
+        session_index (int): Number of the session, used for its user id.
+
+    Returns:
+        SessionResult: Latencies per step, widgets that were missing when a step needed them, and errors.
+                       A session that crashes keeps the latencies of the steps it completed.
+    """
+    result = SessionResult()
+    try:
+        run_session_steps(session_index, result)
+    except Exception as e:
+        # one crashed session must not take the whole report down
+        traceback.print_exc()
+        result.errors.append(f"{result.step or 'setup'}: {type(e).__name__}: {e}")
+    return result
+
+
+def run_session_steps(session_index, result):
+    app = AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT)
+    app.session_state['connected'] = True
+    app.session_state['oauth_id'] = f"load-test-{session_index}"
+    app.session_state['user_info'] = {'name': f"Load Test {session_index}", 'email': 'user@example.com',
+                                      'picture': LOGO_DATA_URI}
+    app.session_state['credentials'] = '{}'
+    timed_run(app, result, 'login')
+
+    def interact(step, widgets, label_prefix, action):
+        widget = find_widget(widgets(), label_prefix)
+        if widget is None:
+            result.missing.append(step)
+            return
+        action(widget)
+        timed_run(app, result, step)
+
+    interact('quick scan on', lambda: app.toggle, 'Quick Scan', lambda widget: widget.set_value(True))
+    interact('quick scan', lambda: app.button, 'Scan Inbox', lambda widget: widget.click())
+    interact('quick scan off', lambda: app.toggle, 'Quick Scan', lambda widget: widget.set_value(False))
+    interact('scan', lambda: app.button, 'Scan Inbox', lambda widget: widget.click())
+    interact('search', lambda: app.text_input, 'Search companies', lambda widget: widget.input('co'))
+    interact('clear search', lambda: app.text_input, 'Search companies', lambda widget: widget.input(''))
+    interact('select all', lambda: app.button, 'Select all', lambda widget: widget.click())
+    interact('bulk option', lambda: app.selectbox, 'Request type for selected',
+             lambda widget: widget.set_value('Request Data'))
+    interact('apply option', lambda: app.button, 'Apply to', lambda widget: widget.click())
+    interact('next page', lambda: app.number_input, 'Page', lambda widget: widget.increment())
+    interact('preview off', lambda: app.toggle, 'Preview Email', lambda widget: widget.set_value(False))
+    interact('bulk send', lambda: app.button, 'Run Bot', lambda widget: widget.click())
+
+    # keep the session alive so that the memory it holds is still counted at the end of the run
+    result.app = app
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def memory_in_use():
+    """Return the traced Python heap if tracemalloc is on, otherwise the peak resident set size, in bytes."""
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def summarize(results, wall_seconds, memory_bytes):
+    steps = defaultdict(list)
+    for result in results:
+        for step, latencies in result.latencies.items():
+            steps[step].extend(latencies)
+
+    report = {
+        'sessions': len(results),
+        'wall_seconds': round(wall_seconds, 2),
+        'steps': {},
+        'missing_widgets': dict(Counter(step for result in results for step in result.missing)),
+        'errors': [error for result in results for error in result.errors][:20],
+        'memory_per_session_kb': round(memory_bytes / max(len(results), 1) / 1024, 1),
+    }
+    all_latencies = []
+    for step, latencies in steps.items():
+        all_latencies.extend(latencies)
+        report['steps'][step] = {
+            'runs': len(latencies),
+            'p50_ms': round(percentile(latencies, 0.50), 1),
+            'p90_ms': round(percentile(latencies, 0.90), 1),
+            'p99_ms': round(percentile(latencies, 0.99), 1),
+            'max_ms': round(max(latencies), 1),
+        }
+    if all_latencies:
+        report['overall'] = {
+            'runs': len(all_latencies),
+            'p50_ms': round(percentile(all_latencies, 0.50), 1),
+            'p90_ms': round(percentile(all_latencies, 0.90), 1),
+            'p99_ms': round(percentile(all_latencies, 0.99), 1),
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{report['sessions']} sessions in {report['wall_seconds']}s")
+    print(f"{'step':<16}{'runs':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step, stats in report['steps'].items():
+        print(f"{step:<16}{stats['runs']:>6}{stats['p50_ms']:>10}{stats['p90_ms']:>10}{stats['p99_ms']:>10}"
+              f"{stats['max_ms']:>10}")
+    if 'overall' in report:
+        overall = report['overall']
+        print(f"{'overall':<16}{overall['runs']:>6}{overall['p50_ms']:>10}{overall['p90_ms']:>10}"
+              f"{overall['p99_ms']:>10}")
+    print(f"Memory per session: {report['memory_per_session_kb']} KiB")
+    if report['missing_widgets']:
+        print(f"Failed steps, their widget was not rendered: {report['missing_widgets']}")
+    for error in report['errors']:
+        print(f"Error: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many concurrent sessions and report rerun latency.")
+    parser.add_argument('--sessions', type=int, default=50, help="Number of simulated sessions (default: 50)")
+    parser.add_argument('--concurrency', type=int, default=10, help="Sessions running at the same time (default: 10)")
+    parser.add_argument('--emails', type=int, default=500, help="Emails returned by the stubbed scan (default: 500)")
+    parser.add_argument('--tracemalloc', action='store_true', help="Measure the retained Python heap per session")
+    parser.add_argument('--json', help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    patchers = (stub_external_services(synthetic_email_data(args.emails)) + [serialize_script_compilation()]
+                + share_app_test_globals())
+    if args.tracemalloc:
+        tracemalloc.start()
+    memory_before = memory_in_use()
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+            results = list(executor.map(simulate_session, range(args.sessions)))
+    finally:
+        for patcher in patchers:
+            patcher.stop()
+    wall_seconds = time.perf_counter() - started
+    memory_bytes = memory_in_use() - memory_before
+    tracemalloc.stop()
+
+    report = summarize(results, wall_seconds, memory_bytes)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+    # a step that could not run means the session did not behave like a user's, so its latencies are incomplete
+    if report['missing_widgets'] or report['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,496 @@
+"""
+Local classifier that learns from past Gemini classifications.
+
+A logistic regression over hashed word n-grams of the subject and sender predicts the interaction category,
+and a table of recurring sender domains predicts the company name and website. Predictions take microseconds
+on the CPU; only emails the model is unsure about, or whose sender it has not seen often enough, are sent
+to Gemini.
+
+Usage:
+    python local_classifier.py train [paths ...] [--epochs 5] [--output .cache/local_classifier.json]
+    python local_classifier.py evaluate [paths ...] [--model .cache/local_classifier.json]
+
+Paths are scan results (message-id keyed JSON like the demo data, JSONL or Parquet, see scan_results.py) or
+directories of shard checkpoints.
+They default to the demo data, SCAN_CHECKPOINT_DIR and LOCAL_CLASSIFIER_DATA_DIR.
+
+One model serves every user of the deployment, so training it on the users' scans pools all their subjects and
+senders into it. The labels of the users' scans are therefore only kept in LOCAL_CLASSIFIER_DATA_DIR when
+LOCAL_CLASSIFIER_POOL_USERS=1; otherwise the model only learns from the demo data and the week of checkpoints.
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter
+from email.utils import parseaddr
+from functools import lru_cache
+
+from entity_index import parse_classification, registrable_domain
+from scan_results import iter_email_records, iter_records, results_format, write_records
+
+LOCAL_CLASSIFIER_PATH = os.getenv('LOCAL_CLASSIFIER_PATH', '.cache/local_classifier.json')
+# predictions below this confidence fall back to Gemini
+LOCAL_CLASSIFIER_MIN_CONFIDENCE = float(os.getenv('LOCAL_CLASSIFIER_MIN_CONFIDENCE', '0.9'))
+# a sender domain needs this many labelled emails before its company is trusted
+MIN_SENDER_EXAMPLES = 3
+# emails taken from one scan's checkpoints, so that a single large inbox does not shape the model for everyone
+MAX_EXAMPLES_PER_SCAN = int(os.getenv('LOCAL_CLASSIFIER_MAX_EXAMPLES_PER_SCAN', '2000'))
+# how often the shared model checks whether its file was retrained
+RELOAD_CHECK_SECONDS = 30
+# classifications made by this model are tagged with it, so they are never used as training labels
+LOCAL_SOURCE = 'local'
+FEATURE_BITS = 18
+CATEGORIES = ('Not Interacted', 'Interacted')
+# the Gemini labels of every user's scans, one directory per user, kept for retraining; opt-in because the
+# shared model then learns from all users' subjects and senders, see the module docstring
+LOCAL_CLASSIFIER_DATA_DIR = os.getenv('LOCAL_CLASSIFIER_DATA_DIR', '.cache/training_labels')
+LOCAL_CLASSIFIER_POOL_USERS = os.getenv('LOCAL_CLASSIFIER_POOL_USERS', '0') == '1'
+DEFAULT_DATA_PATHS = (os.getenv('DEMO_DATA_PATH', 'gemini_processed_emails.jsonl'),
+                      os.getenv('SCAN_CHECKPOINT_DIR', '.cache/scan_checkpoints'),
+                      LOCAL_CLASSIFIER_DATA_DIR)
+
+
+def tokenize(text):
+    # digits are collapsed so that order numbers and dates map to the same features
+    return re.findall(r'\w+', re.sub(r'\d+', '0', (text or '').casefold()))
+
+
+@lru_cache(maxsize=4096)
+def parse_sender(sender):
+    """
+    Split a From header into display name, local part, host and registrable domain.
+
+    Parameters:
+        sender (str): The From header.
+
+    Returns:
+        tuple: (name, local_part, host, domain), lowercase except for the name.
+    """
+    name, address = parseaddr(sender or '')
+    local_part, _, host = address.casefold().rpartition('@')
+    return name, local_part, host, registrable_domain(host)
+
+
+def extract_features(subject, sender):
+    """
+    Turn an email's subject and sender into hashed feature indices.
+
+    Parameters:
+        subject (str): The Subject header.
+        sender (str): The From header.
+
+    Returns:
+        list: Distinct feature indices in [0, 2**FEATURE_BITS).
+    """
+    name, local_part, host, domain = parse_sender(sender)
+    words = tokenize(subject)
+
+    features = [f's:{word}' for word in words]
+    features += [f's2:{first} {second}' for first, second in zip(words, words[1:])]
+    features += [f'n:{word}' for word in tokenize(name)]
+    features += [f'l:{word}' for word in tokenize(local_part)]
+    features += [f'h:{host}', f'd:{domain}']
+
+    mask = (1 << FEATURE_BITS) - 1
+    return sorted({zlib.crc32(feature.encode('utf-8')) & mask for feature in features})
+
+
+def normalize_category(category):
+    for known in CATEGORIES:
+        if (category or '').strip().casefold() == known.casefold():
+            return known
+    return None
+
+
+def load_labeled_emails(paths):
+    """
+    Read Gemini-labelled emails from scan results and shard checkpoints.
+
+    Emails classified by the local model itself are skipped, so the model never learns from, or is scored
+    against, its own predictions. Each scan directory contributes at most `MAX_EXAMPLES_PER_SCAN` emails.
+
+    Parameters:
+        paths (iterable of str): JSON, JSONL or Parquet files, or directories searched recursively for them.
+
+    Returns:
+        list: Dicts with "id", "subject", "sender", "category", "company_name" and "website",
+              one per message id, skipping emails without a valid category.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                # the checkpoints of one scan, i.e. one user's inbox, share a directory
+                files.extend((os.path.join(directory, name), directory) for name in sorted(names)
+                             if name.endswith(('.json', '.jsonl', '.jsonl.gz', '.parquet')))
+        elif os.path.isfile(path):
+            files.append((path, path))
+
+    examples = {}
+    per_scan = Counter()
+    for file_path, scan in files:
+        for example in read_labeled_file(file_path):
+            if per_scan[scan] >= MAX_EXAMPLES_PER_SCAN:
+                break
+            if example['id'] not in examples:
+                examples[example['id']] = example
+                per_scan[scan] += 1
+    return list(examples.values())
+
+
+def read_labeled_file(file_path):
+    """
+    Read the Gemini-labelled emails of one scan results file or checkpoint.
+
+    Returns:
+        generator: Dicts as returned by `load_labeled_emails`.
+    """
+    if results_format(file_path) != 'json':
+        for record in iter_records(file_path, ('message_id', 'subject', 'sender', 'category', 'company_name',
+                                               'website', 'source')):
+            category = normalize_category(record['category'])
+            if category is None or record['source'] == LOCAL_SOURCE:
+                continue
+            yield {
+                'id': record['message_id'],
+                'subject': record['subject'] or '',
+                'sender': record['sender'] or '',
+                'category': category,
+                'company_name': record['company_name'] or '',
+                'website': record['website'] or '',
+            }
+        return
+
+    try:
+        with open(file_path, 'r') as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return
+    # shard checkpoints keep the scan results under "email_data"
+    email_data = data.get('email_data', data) if isinstance(data, dict) else {}
+    for message_id, email_info in email_data.items():
+        if not isinstance(email_info, dict):
+            continue
+        classification = parse_classification(email_info)
+        category = normalize_category(classification.get('category'))
+        if category is None or classification.get('source') == LOCAL_SOURCE:
+            continue
+        yield {
+            'id': message_id,
+            'subject': email_info.get('Subject', ''),
+            'sender': email_info.get('Sender', ''),
+            'category': category,
+            'company_name': classification.get('company_name', ''),
+            'website': classification.get('website', ''),
+        }
+
+
+_labels_lock = threading.Lock()
+
+
+def labels_path(user_id):
+    user_key = hashlib.sha256(str(user_id).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(LOCAL_CLASSIFIER_DATA_DIR, user_key, 'labels.jsonl')
+
+
+def save_training_labels(user_id, email_data):
+    """
+    Keep the Gemini labels of a user's scan as training data, if `LOCAL_CLASSIFIER_POOL_USERS` is set.
+
+    The labels are merged into the user's file, newest first, keeping at most `MAX_EXAMPLES_PER_SCAN` emails,
+    which is all `load_labeled_emails` reads from one directory. Only the subject, sender and labels are kept.
+
+    Parameters:
+        user_id (str): The user's OAuth id, only stored hashed.
+        email_data (dict): Scan results keyed by message id, e.g. those returned by `process_emails`.
+
+    Returns:
+        int: The number of labelled emails in the user's file after the merge, 0 if nothing is kept.
+    """
+    if not LOCAL_CLASSIFIER_POOL_USERS:
+        return 0
+    records = {}
+    for record in iter_email_records(email_data):
+        if normalize_category(record['category']) is not None and record['source'] != LOCAL_SOURCE:
+            records[record['message_id']] = {field: record[field] for field in (
+                'message_id', 'subject', 'sender', 'category', 'company_name', 'website', 'source')}
+    if not records:
+        return 0
+
+    path = labels_path(user_id)
+    with _labels_lock:
+        if os.path.exists(path):
+            try:
+                for record in iter_records(path, ('message_id', 'subject', 'sender', 'category', 'company_name',
+                                                  'website', 'source')):
+                    records.setdefault(record['message_id'], record)
+            except (OSError, ValueError) as e:
+                print(f"Could not read the training labels in {path}, replacing them: {e}")
+        try:
+            written = write_records(list(records.values())[:MAX_EXAMPLES_PER_SCAN], path)
+            # like the checkpoints, the labels hold subjects and senders
+            os.chmod(path, 0o600)
+        except OSError as e:
+            print(f"Could not save the training labels to {path}: {e}")
+            return 0
+    return written
+
+
+def in_holdout(example, fraction=0.2):
+    # split by message id so the same email always lands on the same side
+    return zlib.crc32(example['id'].encode('utf-8')) % 100 < fraction * 100
+
+
+class LocalClassifier:
+    """
+    Hashed n-gram logistic regression for the category plus a sender-domain table for company and website.
+    """
+
+    def __init__(self, weights=None, bias: float = 0.0, senders: dict = None):
+        """
+        Create a new instance of "LocalClassifier".
+
+        Parameters:
+            weights (array.array, optional): One weight per hashed feature. Zeros if omitted.
+            bias (float, optional): The logistic regression bias.
+            senders (dict, optional): Sender domain -> [company_name, website, agreement, examples].
+        """
+        self.weights = weights if weights is not None else array('d', bytes(8 << FEATURE_BITS))
+        self.bias = bias
+        self.senders = senders or {}
+
+    def _probability(self, features):
+        score = self.bias + sum(self.weights[index] for index in features) / math.sqrt(max(len(features), 1))
+        score = max(-30.0, min(30.0, score))
+        return 1 / (1 + math.exp(-score))
+
+    @classmethod
+    def train(cls, examples, epochs=5, learning_rate=0.5, l2=1e-6, seed=0):
+        """
+        Fit the classifier on labelled emails.
+
+        Parameters:
+            examples (list): Labelled emails from `load_labeled_emails`.
+            epochs (int, optional): Passes of stochastic gradient descent over the examples.
+            learning_rate (float, optional): Initial step size, decayed per epoch.
+            l2 (float, optional): L2 regularization strength.
+            seed (int, optional): Seed of the shuffling, for reproducible models.
+
+        Returns:
+            LocalClassifier: The trained classifier.
+        """
+        model = cls()
+        rows = [(extract_features(example['subject'], example['sender']),
+                 1.0 if example['category'] == CATEGORIES[1] else 0.0) for example in examples]
+        rng = random.Random(seed)
+
+        for epoch in range(epochs):
+            rng.shuffle(rows)
+            step = learning_rate / (1 + epoch)
+            for features, label in rows:
+                gradient = model._probability(features) - label
+                scale = step * gradient / math.sqrt(max(len(features), 1))
+                for index in features:
+                    model.weights[index] -= scale + step * l2 * model.weights[index]
+                model.bias -= step * gradient
+
+        companies = {}
+        for example in examples:
+            domain = parse_sender(example['sender'])[3]
+            if domain and example['company_name']:
+                companies.setdefault(domain, Counter())[(example['company_name'], example['website'])] += 1
+        for domain, counts in companies.items():
+            (company_name, website), top = counts.most_common(1)[0]
+            total = sum(counts.values())
+            model.senders[domain] = [company_name, website, round(top / total, 4), total]
+        return model
+
+    def predict(self, subject, sender):
+        """
+        Predict the classification of an email.
+
+        Parameters:
+            subject (str): The Subject header.
+            sender (str): The From header.
+
+        Returns:
+            dict: "company_name", "category", "website" and "confidence", in the shape of a Gemini classification,
+                  and "source" set to `LOCAL_SOURCE`.
+                  The confidence is 0 when the sender domain has too few labelled emails.
+        """
+        probability = self._probability(extract_features(subject, sender))
+        category = CATEGORIES[1] if probability >= 0.5 else CATEGORIES[0]
+        confidence = max(probability, 1 - probability)
+
+        domain = parse_sender(sender)[3]
+        company_name, website, agreement, total = self.senders.get(domain, ['', '', 0.0, 0])
+        if total < MIN_SENDER_EXAMPLES:
+            agreement = 0.0
+
+        return {
+            'company_name': company_name,
+            'category': category,
+            'website': website,
+            'confidence': round(min(confidence, agreement), 4),
+            'source': LOCAL_SOURCE,
+        }
+
+    def save(self, path=LOCAL_CLASSIFIER_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # only non-zero weights are stored, most buckets are never hit
+        weights = {index: round(weight, 6) for index, weight in enumerate(self.weights) if abs(weight) > 1e-9}
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'feature_bits': FEATURE_BITS, 'bias': self.bias, 'weights': weights,
+                       'senders': self.senders}, file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=LOCAL_CLASSIFIER_PATH):
+        """
+        Load a saved classifier.
+
+        Parameters:
+            path (str, optional): The model file written by `save`.
+
+        Returns:
+            LocalClassifier or None: The classifier, or None if the file is missing, unreadable or was
+                                     trained with a different feature size.
+        """
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if data.get('feature_bits') != FEATURE_BITS:
+            return None
+
+        model = cls(bias=data['bias'], senders=data['senders'])
+        for index, weight in data['weights'].items():
+            model.weights[int(index)] = weight
+        return model
+
+
+_local_classifier = None
+_local_classifier_mtime = None
+_local_classifier_checked_at = None
+_local_classifier_lock = threading.Lock()
+
+
+def get_local_classifier():
+    """
+    Return the classifier shared by all sessions, loading it from LOCAL_CLASSIFIER_PATH on first use.
+
+    The file's modification time is checked every `RELOAD_CHECK_SECONDS`, so a retrained model is picked up
+    without restarting the app.
+
+    Returns:
+        LocalClassifier or None: The classifier, or None if no model has been trained.
+    """
+    global _local_classifier, _local_classifier_mtime, _local_classifier_checked_at
+    now = time.monotonic()
+    with _local_classifier_lock:
+        if _local_classifier_checked_at is not None and now - _local_classifier_checked_at < RELOAD_CHECK_SECONDS:
+            return _local_classifier
+        _local_classifier_checked_at = now
+        try:
+            mtime = os.path.getmtime(LOCAL_CLASSIFIER_PATH)
+        except OSError:
+            mtime = None
+        if mtime != _local_classifier_mtime:
+            _local_classifier = LocalClassifier.load() if mtime is not None else None
+            _local_classifier_mtime = mtime
+            print(f"Loaded the local classifier from {LOCAL_CLASSIFIER_PATH}" if _local_classifier is not None
+                  else "No local classifier available")
+    return _local_classifier
+
+
+def evaluate(model, examples, min_confidence=LOCAL_CLASSIFIER_MIN_CONFIDENCE):
+    """
+    Compare the classifier with the Gemini labels.
+
+    Parameters:
+        model (LocalClassifier): The classifier.
+        examples (list): Labelled emails from `load_labeled_emails`.
+        min_confidence (float, optional): Confidence at which a prediction replaces the Gemini call.
+
+    Returns:
+        dict: Number of emails, category accuracy over all emails, the fraction of Gemini calls avoided,
+              and category and company accuracy over the emails that would not go to Gemini.
+    """
+    category_correct = 0
+    covered = 0
+    covered_category_correct = 0
+    covered_company_correct = 0
+
+    for example in examples:
+        prediction = model.predict(example['subject'], example['sender'])
+        category_ok = prediction['category'] == example['category']
+        category_correct += category_ok
+        if prediction['confidence'] >= min_confidence:
+            covered += 1
+            covered_category_correct += category_ok
+            covered_company_correct += prediction['company_name'] == example['company_name']
+
+    total = max(len(examples), 1)
+    return {
+        'emails': len(examples),
+        'category_accuracy': round(category_correct / total, 4),
+        'calls_avoided': round(covered / total, 4),
+        'covered_category_accuracy': round(covered_category_correct / covered, 4) if covered else None,
+        'covered_company_accuracy': round(covered_company_correct / covered, 4) if covered else None,
+    }
+
+
+def print_evaluation(title, report):
+    print(title)
+    for key, value in report.items():
+        print(f"  {key:<28}{value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the local email classifier.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train', help="Train on Gemini labels and report holdout accuracy")
+    train_parser.add_argument('paths', nargs='*', default=list(DEFAULT_DATA_PATHS),
+                              help="Scan result files or checkpoint directories")
+    train_parser.add_argument('--epochs', type=int, default=5, help="Training epochs (default: 5)")
+    train_parser.add_argument('--output', default=LOCAL_CLASSIFIER_PATH, help="Where to save the model")
+
+    evaluate_parser = subparsers.add_parser('evaluate', help="Evaluate a saved model against Gemini labels")
+    evaluate_parser.add_argument('paths', nargs='*', default=list(DEFAULT_DATA_PATHS),
+                                 help="Scan result files or checkpoint directories")
+    evaluate_parser.add_argument('--model', default=LOCAL_CLASSIFIER_PATH, help="The saved model")
+    args = parser.parse_args()
+
+    examples = load_labeled_emails(args.paths)
+    if not examples:
+        parser.error(f"no labelled emails found in {', '.join(args.paths)}")
+
+    if args.command == 'train':
+        train = [example for example in examples if not in_holdout(example)]
+        holdout = [example for example in examples if in_holdout(example)]
+        if holdout:
+            print_evaluation(f"Holdout ({len(holdout)} of {len(examples)} emails):",
+                             evaluate(LocalClassifier.train(train, epochs=args.epochs), holdout))
+        # the saved model is trained on everything
+        LocalClassifier.train(examples, epochs=args.epochs).save(args.output)
+        print(f"Saved model trained on {len(examples)} emails to {args.output}")
+    else:
+        model = LocalClassifier.load(args.model)
+        if model is None:
+            parser.error(f"no usable model at {args.model}")
+        print_evaluation(f"Against {len(examples)} Gemini labels:", evaluate(model, examples))
+
+
+if __name__ == '__main__':
+    main()
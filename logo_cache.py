@@ -0,0 +1,187 @@
+import base64
+import hashlib
+import os
+import random
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from http_client import HttpClientError, get_http_client
+
+LOGO_CACHE_DIR = os.getenv('LOGO_CACHE_DIR', '.cache/logos')
+LOGO_CACHE_MAX_MB = int(os.getenv('LOGO_CACHE_MAX_MB', '32'))
+LOGO_GRID_MAX = 42  # six rows of seven logos
+LOGO_FETCH_WORKERS = 8
+# logos are inlined as data URIs and resent on every rerun, so larger images are treated as missing
+LOGO_MAX_BYTES = 32 * 1024
+
+_eviction_lock = threading.Lock()
+# bytes on disk, scanned once and then tracked per write, so the directory is only walked when over budget
+_disk_bytes = None
+
+
+def _logo_path(domain):
+    return os.path.join(LOGO_CACHE_DIR, hashlib.sha256(domain.encode('utf-8')).hexdigest()[:32])
+
+
+def _list_logos():
+    entries = []
+    for name in os.listdir(LOGO_CACHE_DIR):
+        path = os.path.join(LOGO_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def _evict_logos():
+    # keep the cache under its size budget, dropping the least recently used logos first; callers hold the lock
+    entries = _list_logos()
+    total = sum(size for _, size, _ in entries)
+    budget = LOGO_CACHE_MAX_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            continue
+    return total
+
+
+def _account_write(path, previous_size):
+    global _disk_bytes
+    try:
+        written = os.path.getsize(path)
+    except OSError:
+        return
+    with _eviction_lock:
+        if _disk_bytes is None:
+            _disk_bytes = sum(size for _, size, _ in _list_logos())
+        else:
+            _disk_bytes += written - previous_size
+        if _disk_bytes > LOGO_CACHE_MAX_MB * 1024 * 1024:
+            _disk_bytes = _evict_logos()
+
+
+def _store_logo(path, payload):
+    # a logo is cosmetic: a full or read-only disk only costs the cache, never the scan
+    tmp_path = None
+    try:
+        os.makedirs(LOGO_CACHE_DIR, exist_ok=True)
+        try:
+            # another session may have cached the same logo meanwhile
+            previous_size = os.path.getsize(path)
+        except OSError:
+            previous_size = 0
+        # a private temporary file per writer, so sessions fetching the same logo do not race on it
+        descriptor, tmp_path = tempfile.mkstemp(dir=LOGO_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(payload)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not cache logo {path}: {e}")
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return
+    _account_write(path, previous_size)
+
+
+def fetch_logo(domain):
+    """
+    Return the logo of a company domain, downloading it from logo.dev only if it is not cached on disk.
+
+    Domains without a logo are cached as empty files so that they are not probed again.
+
+    Parameters:
+        domain (str): The registrable domain of the company, e.g. "adidas.com".
+
+    Returns:
+        tuple or None: The (content_type, image_bytes) of the logo, or None if there is no logo.
+    """
+    path = _logo_path(domain)
+    try:
+        with open(path, 'rb') as file:
+            cached = file.read()
+        os.utime(path)
+        if not cached:
+            return None
+        content_type, _, image = cached.partition(b'\n')
+        return content_type.decode('ascii'), image
+    except OSError:
+        pass
+
+    logo_url = f"https://img.logo.dev/{domain}?token={os.getenv('LOGODEV_API_KEY')}"
+    try:
+        response = get_http_client().get(logo_url, max_bytes=LOGO_MAX_BYTES)
+    except HttpClientError as e:
+        # network errors are not cached, the logo may be available next time
+        print(f"Error fetching logo for {domain}: {e}")
+        return None
+
+    content_type = response.headers.get('Content-Type', '').split(';')[0]
+    found = response.status_code == 200 and content_type.startswith('image/') and not response.truncated
+
+    _store_logo(path, content_type.encode('ascii') + b'\n' + response.content if found else b'')
+    return (content_type, response.content) if found else None
+
+
+def fetch_logo_data_uris(domains, limit=LOGO_GRID_MAX):
+    """
+    Fetch logos for a list of domains concurrently and return them as inline data URIs.
+
+    Parameters:
+        domains (list of str): Registrable company domains, in order of preference.
+        limit (int, optional): Maximum number of logos to return.
+
+    Returns:
+        list: Data URIs of the available logos, at most `limit` of them, in the order of `domains`.
+    """
+    domains = [domain for domain in dict.fromkeys(domains) if domain]
+    data_uris = []
+
+    with ThreadPoolExecutor(max_workers=LOGO_FETCH_WORKERS) as executor:
+        # fetch in batches so that only as many domains as needed to fill the grid are requested
+        for start in range(0, len(domains), LOGO_FETCH_WORKERS):
+            for logo in executor.map(fetch_logo, domains[start:start + LOGO_FETCH_WORKERS]):
+                if logo is not None and len(data_uris) < limit:
+                    content_type, image = logo
+                    data_uris.append(f"data:{content_type};base64,{base64.b64encode(image).decode('ascii')}")
+            if len(data_uris) >= limit:
+                break
+
+    return data_uris
+
+
+def logo_grid_html(data_uris):
+    """
+    Render logos as a single HTML grid with randomized, but stable, sizes and order.
+
+    Parameters:
+        data_uris (list of str): Logo data URIs from `fetch_logo_data_uris`.
+
+    Returns:
+        str: The HTML of the grid.
+    """
+    # seed from the logos themselves so that reruns show the same layout without caching the markup
+    rng = random.Random(len(data_uris) + sum(len(uri) for uri in data_uris))
+    data_uris = list(data_uris)
+    rng.shuffle(data_uris)
+
+    images = []
+    for uri in data_uris:
+        width = rng.randint(30, 90)
+        images.append(
+            f'<img src="{uri}" style="border-radius:50%; width:{width}px; height:{width}px; object-fit:contain;"/>'
+        )
+
+    return (
+        '<div style="display:grid; grid-template-columns:repeat(7, 1fr); align-items:center; '
+        'justify-items:center; row-gap:10px; margin-bottom:10px;">' + ''.join(images) + '</div>'
+    )
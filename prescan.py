@@ -0,0 +1,387 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from llm_scheduler import PRIORITY_BACKGROUND
+from utils import (
+    GMAIL_MAX_MESSAGES, QuotaExhaustedError, build_gmail_query, build_gmail_service_from_credentials,
+    iter_message_pages, process_message
+)
+
+PRESCAN_ENABLED = os.getenv('PRESCAN_ENABLED', '0') == '1'
+PRESCAN_DIR = os.getenv('PRESCAN_DIR', '.cache/prescan')
+PRESCAN_INTERVAL_MINUTES = int(os.getenv('PRESCAN_INTERVAL_MINUTES', '360'))
+# the longest window a user can pick in the app
+PRESCAN_DAYS = int(os.getenv('PRESCAN_DAYS', '60'))
+PRESCAN_WORKERS = int(os.getenv('PRESCAN_WORKERS', '2'))
+# emails classified per user per day in the background; the rest waits for the next day or an interactive scan
+PRESCAN_DAILY_BUDGET = int(os.getenv('PRESCAN_DAILY_BUDGET', '300'))
+PRESCAN_TICK_SECONDS = 30
+MAX_SEEN_IDS = 20000
+
+_user_locks = {}
+_run_locks = {}
+_user_locks_lock = threading.Lock()
+
+
+def _user_lock(user_id):
+    # held while the state file is read and rewritten
+    with _user_locks_lock:
+        return _user_locks.setdefault(user_id, threading.Lock())
+
+
+def _run_lock(user_id):
+    # held for a whole pre-scan, so two runs never process the same emails or overwrite each other's progress
+    with _user_locks_lock:
+        return _run_locks.setdefault(user_id, threading.Lock())
+
+
+def state_path(user_id):
+    # user ids are not used as file names directly
+    return os.path.join(PRESCAN_DIR, f"{hashlib.sha256(user_id.encode('utf-8')).hexdigest()[:32]}.json")
+
+
+def load_state(user_id):
+    """
+    Load the pre-scan state of a user.
+
+    Parameters:
+        user_id (str): The user's OAuth id.
+
+    Returns:
+        dict or None: The state with "user_id", "credentials", "ignored_categories", "last_scan", "next_run",
+                      "budget", "email_data" and "seen_ids", or None if the user has not opted in.
+    """
+    try:
+        with open(state_path(user_id), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(state):
+    os.makedirs(PRESCAN_DIR, exist_ok=True)
+    path = state_path(state['user_id'])
+    tmp_path = f'{path}.tmp'
+    # the file holds a refresh token, so only the app's user may read it
+    descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'w') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, path)
+
+
+def is_enrolled(user_id):
+    return bool(user_id) and os.path.exists(state_path(user_id))
+
+
+def enroll(user_id, credentials_json, ignored_categories):
+    """
+    Opt a user in to background pre-scans, or update their credentials and categories.
+
+    Parameters:
+        user_id (str): The user's OAuth id.
+        credentials_json (str): Authorized user credentials, which must include a refresh token.
+        ignored_categories (list of str): The categories left out of the scans.
+
+    Returns:
+        bool: False if the credentials have no refresh token, so the user cannot be scanned offline.
+    """
+    if not json.loads(credentials_json).get('refresh_token'):
+        return False
+
+    ignored_categories = sorted(ignored_categories)
+    with _user_lock(user_id):
+        state = load_state(user_id)
+        if state is None or state['ignored_categories'] != ignored_categories:
+            # results for other categories cannot be reused
+            state = {'user_id': user_id, 'ignored_categories': ignored_categories, 'last_scan': None,
+                     'next_run': 0, 'budget': {'day': None, 'used': 0}, 'email_data': {}, 'seen_ids': []}
+        state['credentials'] = credentials_json
+        save_state(state)
+    return True
+
+
+def unenroll(user_id):
+    """
+    Opt a user out and delete their stored token and results.
+
+    Returns:
+        None
+    """
+    with _user_lock(user_id):
+        try:
+            os.remove(state_path(user_id))
+        except OSError:
+            pass
+
+
+def in_window(email_info, days):
+    first_day = (date.today() - timedelta(days=days - 1)).isoformat()
+    # emails without a parseable date are kept rather than silently dropped
+    return not email_info.get('Date') or email_info['Date'] >= first_day
+
+
+def load_prescan(user_id, days, ignored_categories):
+    """
+    Return the pre-computed results of a user for a scan window, if the background scans cover it.
+
+    Parameters:
+        user_id (str): The user's OAuth id.
+        days (int): The scan window in days.
+        ignored_categories (list of str): The categories left out of the scan.
+
+    Returns:
+        tuple or None: The `email_data` of the window and the Unix time the background scan covers up to,
+                       or None if the user is not enrolled, ignores other categories or was never scanned.
+    """
+    state = load_state(user_id)
+    if state is None or state['last_scan'] is None or state['ignored_categories'] != sorted(ignored_categories):
+        return None
+    email_data = {message_id: email_info for message_id, email_info in state['email_data'].items()
+                  if in_window(email_info, days)}
+    return email_data, state['last_scan']
+
+
+def merge_results(state, new_email_data, scanned_at=None):
+    """
+    Merge newly classified emails into a user's state, newest first, and drop those outside the window.
+
+    Parameters:
+        state (dict): The user's state from `load_state`, updated in place.
+        new_email_data (dict): Newly classified emails.
+        scanned_at (float, optional): If given, the new `last_scan`: every email before it has been processed.
+
+    Returns:
+        None
+    """
+    email_data = dict(new_email_data)
+    email_data.update((message_id, email_info) for message_id, email_info in state['email_data'].items()
+                      if message_id not in email_data)
+    state['email_data'] = {message_id: email_info for message_id, email_info in email_data.items()
+                           if in_window(email_info, PRESCAN_DAYS)}
+    if scanned_at is not None:
+        state['last_scan'] = scanned_at
+
+
+def record_interactive_scan(user_id, new_email_data, scanned_at):
+    """
+    Store the emails found by an incremental interactive scan, so the background scan does not redo them.
+
+    Parameters:
+        user_id (str): The user's OAuth id.
+        new_email_data (dict): The emails classified since the last background scan.
+        scanned_at (float): Unix time at which the interactive scan started.
+
+    Returns:
+        None
+    """
+    with _user_lock(user_id):
+        state = load_state(user_id)
+        if state is None:
+            return
+        merge_results(state, new_email_data, scanned_at)
+        save_state(state)
+
+
+def run_prescan(user_id):
+    """
+    Run one incremental background scan of a user, within their daily budget.
+
+    Parameters:
+        user_id (str): The user's OAuth id.
+
+    Returns:
+        dict: "classified" and "processed" counts and a "status" of "done", "budget exhausted",
+              "quota exhausted", "listing capped", "failed", "not enrolled" or "already running".
+
+    Description:
+        Only a run that listed every message of its query is "done" and moves `last_scan` forward. Any other
+        run leaves `last_scan` in place and keeps the ids it processed, so the next run lists the same range
+        again and continues past them.
+    """
+    run_lock = _run_lock(user_id)
+    if not run_lock.acquire(blocking=False):
+        return {'status': 'already running', 'processed': 0, 'classified': 0}
+    try:
+        return _run_prescan(user_id)
+    finally:
+        run_lock.release()
+
+
+def _run_prescan(user_id):
+    state = load_state(user_id)
+    if state is None:
+        return {'status': 'not enrolled', 'processed': 0, 'classified': 0}
+
+    today = date.today().isoformat()
+    if state['budget']['day'] != today:
+        state['budget'] = {'day': today, 'used': 0}
+
+    started = time.time()
+    # the first run covers the whole window, later runs only what arrived since
+    query = build_gmail_query(PRESCAN_DAYS, state['ignored_categories'], since=state['last_scan'])
+    seen = set(state['seen_ids'])
+    new_email_data = {}
+    new_seen = []
+    status = 'done'
+    # the emails seen by earlier unfinished runs are listed again, so they do not count towards the cap
+    max_listed = len(seen) + GMAIL_MAX_MESSAGES
+    listed = 0
+
+    try:
+        service, state['credentials'] = build_gmail_service_from_credentials(state['credentials'])
+        for messages, _ in iter_message_pages(service, query, max_messages=max_listed):
+            listed += len(messages)
+            for msg in messages:
+                if msg['id'] in seen:
+                    continue
+                if state['budget']['used'] >= PRESCAN_DAILY_BUDGET:
+                    status = 'budget exhausted'
+                    break
+                email_entry = process_message(service, msg['id'], cache_stats=Counter(), max_rate_limit_retries=0,
+                                              user=user_id, priority=PRIORITY_BACKGROUND)
+                state['budget']['used'] += 1
+                new_seen.append(msg['id'])
+                if email_entry is not None:
+                    new_email_data[msg['id']] = email_entry
+            if status != 'done':
+                break
+        if status == 'done' and listed >= max_listed:
+            # older emails of the window may not have been listed; last_scan must not move past them
+            status = 'listing capped'
+    except QuotaExhaustedError:
+        # background work gives way at the first 429
+        status = 'quota exhausted'
+    except Exception as e:
+        print(f"Pre-scan of {state_path(user_id)} failed: {e}")
+        status = 'failed'
+
+    with _user_lock(user_id):
+        latest = load_state(user_id)
+        if latest is None or latest['ignored_categories'] != state['ignored_categories']:
+            # the user opted out or changed categories while the scan ran
+            return {'status': 'not enrolled', 'processed': len(new_seen), 'classified': len(new_email_data)}
+        latest['credentials'] = state['credentials']
+        latest['budget'] = state['budget']
+        # an unfinished run does not move last_scan, the next run lists the same range and skips what it has seen;
+        # a finished run only keeps its own ids, for emails that arrived while it ran and are listed again
+        merge_results(latest, new_email_data, started if status == 'done' else None)
+        previous_seen = latest['seen_ids'] if status != 'done' else []
+        latest['seen_ids'] = (previous_seen + new_seen)[-MAX_SEEN_IDS:]
+        latest['next_run'] = time.time() + PRESCAN_INTERVAL_MINUTES * 60
+        save_state(latest)
+
+    print(f"Pre-scan of {state_path(user_id)}: {status}, {len(new_seen)} emails processed, "
+          f"{len(new_email_data)} classified")
+    return {'status': status, 'processed': len(new_seen), 'classified': len(new_email_data)}
+
+
+class PrescanScheduler:
+    """
+    Background thread that pre-scans opted-in users at a fixed interval.
+
+    Pre-scans run on a small worker pool, one at a time per user, with the lowest Gemini priority, so they only
+    use capacity that interactive sessions leave free.
+    """
+
+    def __init__(self, workers: int = PRESCAN_WORKERS):
+        """
+        Create a new instance of "PrescanScheduler".
+
+        Parameters:
+            workers (int, optional): Pre-scans running at the same time across all users.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='prescan')
+        self._running = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name='prescan-scheduler', daemon=True)
+        self.runs = Counter()
+
+    def start(self):
+        self._thread.start()
+
+    def due_users(self):
+        """
+        Return the enrolled users whose next pre-scan is due.
+
+        Returns:
+            list: User ids, the longest overdue first.
+        """
+        due = []
+        try:
+            names = os.listdir(PRESCAN_DIR)
+        except OSError:
+            return due
+        now = time.time()
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(PRESCAN_DIR, name), 'r') as file:
+                    state = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if not isinstance(state, dict) or not state.get('user_id'):
+                print(f"Skipping malformed pre-scan state {name}")
+                continue
+            if state.get('next_run', 0) <= now:
+                due.append((state.get('next_run', 0), state['user_id']))
+        return [user_id for _, user_id in sorted(due)]
+
+    def _loop(self):
+        while True:
+            try:
+                self._tick()
+            except Exception as e:
+                # an error in one tick must not stop the background scans of the whole process
+                print(f"Pre-scan scheduler tick failed: {e}")
+            time.sleep(PRESCAN_TICK_SECONDS)
+
+    def _tick(self):
+        for user_id in self.due_users():
+            with self._lock:
+                if user_id in self._running:
+                    continue
+                self._running.add(user_id)
+            self._executor.submit(self._run, user_id)
+
+    def _run(self, user_id):
+        try:
+            report = run_prescan(user_id)
+            self.runs[report['status']] += 1
+        except Exception as e:
+            print(f"Pre-scan of {state_path(user_id)} crashed: {e}")
+            self.runs['crashed'] += 1
+        finally:
+            with self._lock:
+                self._running.discard(user_id)
+
+    def metrics(self):
+        with self._lock:
+            return {'running': len(self._running), 'runs': dict(self.runs)}
+
+
+_prescan_scheduler = None
+_prescan_scheduler_lock = threading.Lock()
+
+
+def get_prescan_scheduler():
+    """
+    Return the process-wide pre-scan scheduler, starting it on first use. Does nothing unless PRESCAN_ENABLED is "1".
+
+    Returns:
+        PrescanScheduler or None: The running scheduler, or None if pre-scans are disabled.
+    """
+    global _prescan_scheduler
+    if not PRESCAN_ENABLED:
+        return None
+    with _prescan_scheduler_lock:
+        if _prescan_scheduler is None:
+            _prescan_scheduler = PrescanScheduler()
+            _prescan_scheduler.start()
+    return _prescan_scheduler
@@ -0,0 +1,272 @@
+import gzip
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+from http_client import HttpClientError, get_http_client
+
+# paths probed directly; most sites serve their privacy policy at one of them
+PRIVACY_PATHS = (
+    '/privacy',
+    '/privacy-policy',
+    '/privacy-notice',
+    '/legal/privacy',
+    '/legal/privacy-policy',
+    '/policies/privacy-policy',
+    '/.well-known/security.txt',
+)
+# words marking a privacy page in a URL or link text, in the languages of the most common senders
+PRIVACY_KEYWORDS = (
+    'privacy', 'datenschutz', 'privacidad', 'privacidade', 'confidentialite', 'confidentialité', 'riservatezza',
+    'prywatnosc', 'prywatności', 'privacybeleid', 'integritet', 'gdpr', 'rodo', 'data-protection', 'dataprotection',
+)
+DISCOVERY_TIMEOUT = (3, 5)  # connect and read timeouts of every request, in seconds
+DISCOVERY_DEADLINE = float(os.getenv('PRIVACY_DISCOVERY_DEADLINE', '8'))
+DISCOVERY_MAX_BYTES = 2 * 1024 * 1024
+MAX_SITEMAPS = 4
+# a candidate this good ends the discovery without waiting for the slower sources
+STRONG_SCORE = 3
+
+
+def privacy_score(url, text=''):
+    """
+    Score how likely a link points to a privacy policy.
+
+    Parameters:
+        url (str): The absolute URL.
+        text (str, optional): The link text.
+
+    Returns:
+        int: 0 if it does not look like a privacy page, higher is better.
+    """
+    path = urlsplit(url).path.casefold()
+    text = (text or '').casefold()
+    score = 0
+    if any(keyword in path for keyword in PRIVACY_KEYWORDS):
+        score += 2
+    if any(keyword in text for keyword in PRIVACY_KEYWORDS):
+        score += 2
+    if score and any(word in path or word in text for word in ('policy', 'notice', 'statement', 'erklaerung')):
+        score += 1
+    if 'cookie' in path or 'cookie' in text:
+        # cookie policies mention privacy but rarely name the data protection contact
+        score -= 1
+    return max(score, 0)
+
+
+class LinkExtractor(HTMLParser):
+    """
+    Collect the links of an HTML page with their text, and whether they sit inside a <footer>.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+        self._footer_depth = 0
+        self._href = None
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'footer':
+            self._footer_depth += 1
+        elif tag == 'a':
+            self._href = dict(attrs).get('href')
+            self._text = []
+
+    def handle_endtag(self, tag):
+        if tag == 'footer' and self._footer_depth:
+            self._footer_depth -= 1
+        elif tag == 'a' and self._href:
+            self.links.append((self._href, ' '.join(''.join(self._text).split()), self._footer_depth > 0))
+            self._href = None
+
+    def handle_data(self, data):
+        if self._href is not None:
+            self._text.append(data)
+
+
+def fetch(url):
+    """
+    GET a URL with the discovery timeouts, reading at most `DISCOVERY_MAX_BYTES` of the body.
+
+    Parameters:
+        url (str): The URL.
+
+    Returns:
+        tuple or None: The (final_url, content_type, body_bytes) of a 200 response, or None.
+    """
+    try:
+        # most probes are expected to 404 or time out, retrying them would only hold up the discovery
+        response = get_http_client().get(url, timeout=DISCOVERY_TIMEOUT, max_bytes=DISCOVERY_MAX_BYTES, retries=0)
+    except HttpClientError:
+        return None
+    if response.status_code != 200:
+        return None
+    return response.url, response.headers.get('Content-Type', ''), response.content
+
+
+def same_site(url, base_url):
+    host = (urlsplit(url).hostname or '').casefold()
+    base_host = (urlsplit(base_url).hostname or '').casefold()
+    base_host = base_host[4:] if base_host.startswith('www.') else base_host
+    return host == base_host or host.endswith(f'.{base_host}')
+
+
+def homepage_links(base_url):
+    """
+    Find privacy links on the homepage, preferring the footer where sites put their legal links.
+
+    Returns:
+        list: Tuples of (score, url, page), see `discover_privacy_urls`.
+    """
+    result = fetch(base_url)
+    if result is None:
+        return []
+    final_url, content_type, body = result
+    if 'html' not in content_type:
+        return []
+
+    parser = LinkExtractor()
+    parser.feed(body.decode('utf-8', errors='replace'))
+    candidates = []
+    for href, text, in_footer in parser.links:
+        url = urljoin(final_url, href)
+        score = privacy_score(url, text)
+        if score and url.startswith('http'):
+            candidates.append((score + (1 if in_footer else 0), url.split('#')[0], None))
+    return candidates
+
+
+def sitemap_links(base_url):
+    """
+    Find privacy URLs listed in the sitemaps declared in robots.txt, or in /sitemap.xml.
+
+    Returns:
+        list: Tuples of (score, url, page), see `discover_privacy_urls`.
+    """
+    sitemaps = []
+    robots = fetch(urljoin(base_url, '/robots.txt'))
+    candidates = []
+    if robots is not None:
+        for line in robots[2].decode('utf-8', errors='replace').splitlines():
+            field, _, value = line.partition(':')
+            field, value = field.strip().casefold(), value.strip()
+            if field == 'sitemap' and value:
+                sitemaps.append(value)
+            elif field in ('allow', 'disallow') and privacy_score(urljoin(base_url, value)):
+                # robots.txt sometimes names the privacy page to keep it crawlable
+                if '*' not in value and '$' not in value:
+                    candidates.append((privacy_score(urljoin(base_url, value)), urljoin(base_url, value), None))
+    if not sitemaps:
+        sitemaps.append(urljoin(base_url, '/sitemap.xml'))
+
+    fetched = 0
+    while sitemaps and fetched < MAX_SITEMAPS:
+        result = fetch(sitemaps.pop(0))
+        fetched += 1
+        if result is None:
+            continue
+        final_url, _, body = result
+        if final_url.endswith('.gz') or body[:2] == b'\x1f\x8b':
+            try:
+                body = gzip.decompress(body)
+            except OSError:
+                continue
+        text = body.decode('utf-8', errors='replace')
+        locations = [location.strip() for location in re.findall(r'<loc>(.*?)</loc>', text, re.S)]
+        if '<sitemapindex' in text:
+            # nested sitemaps: the ones for static or legal pages are the likeliest to list the policy
+            locations.sort(key=lambda location: not any(word in location.casefold()
+                                                        for word in ('page', 'legal', 'static', 'misc', 'info')))
+            sitemaps.extend(locations)
+            continue
+        for location in locations:
+            score = privacy_score(location)
+            if score:
+                candidates.append((score, location, None))
+    return candidates
+
+
+def probe_path(base_url, path):
+    """
+    Request one well-known path and keep it if it resolves to a privacy page.
+
+    security.txt is parsed for its "Policy:" URLs instead.
+
+    Returns:
+        list: Tuples of (score, url, page), see `discover_privacy_urls`.
+    """
+    result = fetch(urljoin(base_url, path))
+    if result is None:
+        return []
+    final_url, content_type, body = result
+
+    if path.endswith('security.txt'):
+        candidates = []
+        for line in body.decode('utf-8', errors='replace').splitlines():
+            field, _, value = line.partition(':')
+            if field.strip().casefold() == 'policy' and value.strip().startswith('http'):
+                url = value.strip()
+                if privacy_score(url):
+                    candidates.append((privacy_score(url), url, None))
+        return candidates
+
+    # a redirect to the homepage or a soft 404 does not count
+    if 'html' not in content_type or not privacy_score(final_url):
+        return []
+    # the page is kept so that it is not downloaded again, unless the size cap cut it off
+    page = (content_type, body) if len(body) < DISCOVERY_MAX_BYTES else None
+    return [(privacy_score(final_url) + 1, final_url, page)]
+
+
+def discover_privacy_urls(base_url, limit=3, deadline=DISCOVERY_DEADLINE):
+    """
+    Find the privacy policy of a website without third-party services.
+
+    Parameters:
+        base_url (str): The website, e.g. "https://adidas.com".
+        limit (int, optional): Maximum number of links to return.
+        deadline (float, optional): Seconds after which the discovery stops waiting for slow sources.
+
+    Returns:
+        dict: {"success": bool, "links": list of str}, best candidate first, in the shape of a Firecrawl map,
+              and under "pages" the (content_type, body) of the links that were already downloaded and
+              verified to be privacy pages, so callers do not fetch them again.
+
+    Description:
+        The homepage, robots.txt with its sitemaps, and the well-known privacy paths are all fetched
+        concurrently. Discovery ends as soon as a strong, on-site candidate is found (a footer link or a
+        probed path that resolved to a privacy page), or when the deadline passes.
+    """
+    started = time.monotonic()
+
+    executor = ThreadPoolExecutor(max_workers=2 + len(PRIVACY_PATHS))
+    futures = [executor.submit(homepage_links, base_url), executor.submit(sitemap_links, base_url)]
+    futures += [executor.submit(probe_path, base_url, path) for path in PRIVACY_PATHS]
+
+    candidates = {}
+    pages = {}
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            for score, url, page in future.result():
+                best = candidates.get(url, (0, False))
+                candidates[url] = (max(score, best[0]), page is not None or best[1])
+                if page is not None:
+                    pages[url] = page
+            if any(score >= STRONG_SCORE and same_site(url, base_url) for url, (score, _) in candidates.items()):
+                break
+    except FuturesTimeoutError:
+        print(f"Privacy discovery for {base_url} hit the {deadline}s deadline")
+    finally:
+        # requests still in flight finish on their own timeouts
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # on-site, verified and higher scoring candidates first
+    ranked = sorted(candidates.items(),
+                    key=lambda item: (same_site(item[0], base_url), item[1][1], item[1][0]), reverse=True)
+    links = [url for url, _ in ranked[:limit]]
+    print(f"Privacy discovery for {base_url}: {len(candidates)} candidate(s) in {time.monotonic() - started:.2f}s")
+    return {'success': bool(links), 'links': links, 'pages': {url: pages[url] for url in links if url in pages}}
@@ -0,0 +1,204 @@
+import streamlit as st
+
+REQUEST_OPTIONS = ['Request Data', 'Modify Data', 'Erase Data']
+PAGE_SIZES = [25, 50, 100, 250]
+DISPLAY_COLUMNS = ['Company Name', 'Interaction Type', 'Website', 'Messages', 'First Seen', 'Last Seen']
+SEARCH_COLUMNS = ['Company Name', 'Website']
+ROW_ID = '_row_id'
+
+
+class ResultsStore:
+    """
+    Columnar (Arrow) store of result rows supporting server-side filtering, sorting and paging.
+    """
+
+    def __init__(self, rows: list):
+        """
+        Create a new instance of "ResultsStore".
+
+        Parameters:
+            rows (list): Row dictionaries with the `DISPLAY_COLUMNS` keys, e.g. from `EntityIndex.rows`.
+        """
+        import pyarrow as pa
+
+        columns = {column: [row.get(column) for row in rows] for column in DISPLAY_COLUMNS}
+        columns[ROW_ID] = list(range(len(rows)))
+        self.table = pa.table(columns)
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def categories(self):
+        """
+        Return the distinct interaction types, for the category filter.
+
+        Returns:
+            list: The sorted distinct non-empty values of "Interaction Type".
+        """
+        import pyarrow.compute as pc
+
+        return sorted(value for value in pc.unique(self.table['Interaction Type']).to_pylist() if value)
+
+    def query(self, text='', categories=None, sort_by=None, descending=False):
+        """
+        Filter and sort the rows without converting them to Python objects.
+
+        Parameters:
+            text (str, optional): Case-insensitive substring matched against company name and website.
+            categories (list of str, optional): Interaction types to keep. All are kept if empty.
+            sort_by (str, optional): Column to sort by.
+            descending (bool, optional): Sort in descending order.
+
+        Returns:
+            pyarrow.Table: The matching rows.
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        table = self.table
+        if text:
+            pattern = text.casefold()
+            mask = None
+            for column in SEARCH_COLUMNS:
+                matches = pc.fill_null(pc.match_substring(pc.utf8_lower(table[column]), pattern), False)
+                mask = matches if mask is None else pc.or_(mask, matches)
+            table = table.filter(mask)
+        if categories:
+            table = table.filter(pc.is_in(table['Interaction Type'], value_set=pa.array(categories, type=pa.string())))
+        if sort_by:
+            table = table.sort_by([(sort_by, 'descending' if descending else 'ascending')])
+        return table
+
+    def take(self, row_ids):
+        """
+        Return the rows with the given ids, in id order.
+
+        Parameters:
+            row_ids (iterable of int): Row ids as stored in the `ROW_ID` column.
+
+        Returns:
+            pyarrow.Table: The selected rows.
+        """
+        import pyarrow as pa
+
+        return self.table.take(pa.array(sorted(row_ids), type=pa.int64()))
+
+
+def get_table_state():
+    """
+    Return the table state kept in the session: selected row ids, per-row request options and the view version.
+
+    Returns:
+        dict: The mutable state with "selected" (set), "options" (dict) and "version" (int).
+    """
+    if 'results_table' not in st.session_state:
+        st.session_state['results_table'] = {'selected': set(), 'options': {}, 'version': 0}
+    return st.session_state['results_table']
+
+
+def reset_table_state():
+    """
+    Forget the selection and request options, e.g. after a new scan replaced the rows.
+
+    Returns:
+        None
+    """
+    st.session_state.pop('results_table', None)
+
+
+def selected_rows_frame(store, state):
+    """
+    Build the DataFrame of selected rows that `run_bot` works on.
+
+    Parameters:
+        store (ResultsStore): The results store.
+        state (dict): The table state from `get_table_state`.
+
+    Returns:
+        pd.DataFrame: Selected rows with the display columns and "Select Option".
+    """
+    selected = store.take(state['selected']).to_pandas()
+    selected['Select Option'] = [state['options'].get(row_id, '-') for row_id in selected[ROW_ID]]
+    return selected.drop(columns=[ROW_ID])
+
+
+@st.fragment
+def display_results_table(load_store):
+    """
+    Display one page of the results with filters, sorting and selection that persists across pages.
+
+    Only the visible page is serialized to the browser; filtering, sorting and "select all matching" run
+    on the server against the Arrow table. The selection is kept as row ids, see `selected_rows_frame`.
+
+    Parameters:
+        load_store (callable): Returns the results store, or None if it expired; called on every run.
+
+    Returns:
+        None
+    """
+    store = load_store()
+    if store is None:
+        return
+    state = get_table_state()
+
+    filter_columns = st.columns([3, 2, 2, 1])
+    with filter_columns[0]:
+        text = st.text_input('Search companies', placeholder='Company name or website')
+    with filter_columns[1]:
+        categories = st.multiselect('Interaction Type', store.categories())
+    with filter_columns[2]:
+        sort_by = st.selectbox('Sort by', ['Messages', 'Company Name', 'Last Seen', 'First Seen'])
+    with filter_columns[3]:
+        page_size = st.selectbox('Rows', PAGE_SIZES)
+
+    matching = store.query(text, categories, sort_by, descending=sort_by in ('Messages', 'Last Seen'))
+    page_count = max(1, -(-matching.num_rows // page_size))
+
+    action_columns = st.columns([2, 2, 3, 1])
+    with action_columns[0]:
+        if st.button(f'Select all {matching.num_rows} matching'):
+            state['selected'].update(matching[ROW_ID].to_pylist())
+            state['version'] += 1
+    with action_columns[1]:
+        if st.button('Clear selection'):
+            state['selected'].clear()
+            state['version'] += 1
+    with action_columns[2]:
+        bulk_option = st.selectbox('Request type for selected', ['-'] + REQUEST_OPTIONS, label_visibility='collapsed')
+        if bulk_option != '-' and st.button(f'Apply to {len(state["selected"])} selected'):
+            state['options'].update({row_id: bulk_option for row_id in state['selected']})
+            state['version'] += 1
+    with action_columns[3]:
+        page = st.number_input('Page', min_value=1, max_value=page_count, value=1, label_visibility='collapsed')
+
+    page_df = matching.slice((page - 1) * page_size, page_size).to_pandas()
+    page_df['Select'] = [row_id in state['selected'] for row_id in page_df[ROW_ID]]
+    page_df['Select Option'] = [state['options'].get(row_id, '-') for row_id in page_df[ROW_ID]]
+    page_df = page_df.set_index(ROW_ID)
+
+    column_config = {
+        'Select Option': st.column_config.SelectboxColumn(options=REQUEST_OPTIONS),
+        'Website': st.column_config.LinkColumn(),
+        'Select': st.column_config.CheckboxColumn(),
+    }
+
+    # the key changes with the visible slice and after bulk actions so that stale edits are not replayed
+    edited_df = st.data_editor(
+        page_df,
+        column_config=column_config,
+        hide_index=True,
+        width='stretch',
+        column_order=['Select'] + DISPLAY_COLUMNS + ['Select Option'],
+        disabled=DISPLAY_COLUMNS,
+        key=f"results_page_{hash((text, tuple(categories), sort_by, page_size, page))}_{state['version']}",
+    )
+
+    for row_id, row in edited_df.iterrows():
+        if row['Select']:
+            state['selected'].add(row_id)
+        else:
+            state['selected'].discard(row_id)
+        state['options'][row_id] = row['Select Option']
+
+    st.caption(f"{len(state['selected'])} selected · {matching.num_rows} of {len(store)} companies match · "
+               f"page {page} of {page_count}")
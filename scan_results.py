@@ -0,0 +1,217 @@
+"""
+Scan results stored as flat records, one per email, in streaming JSONL or columnar Parquet.
+
+The legacy format is one JSON document keyed by message id, with the classification as JSON text inside it,
+which has to be loaded whole. Records keep the classification as typed fields, so JSONL can be read line by
+line and Parquet batch by batch with only the columns a reader needs.
+
+Usage:
+    python scan_results.py convert legacy_results.json scan_results.parquet
+    python scan_results.py head scan_results.parquet -n 5 [--columns company_name website]
+"""
+import argparse
+import gzip
+import json
+import os
+
+from entity_index import parse_classification
+
+# one flat record per scanned email; the classification is stored as typed columns instead of JSON text
+RECORD_FIELDS = ('message_id', 'subject', 'sender', 'date', 'category', 'company_name', 'website', 'confidence',
+                 'source')
+# the columns company resolution needs, so Parquet readers can skip the subjects
+ENTITY_FIELDS = ('sender', 'date', 'category', 'company_name', 'website')
+PARQUET_BATCH_SIZE = 10000
+
+
+def results_format(path):
+    """
+    Tell the format of a scan results file from its extension.
+
+    Parameters:
+        path (str): The file path.
+
+    Returns:
+        str: "jsonl" for .jsonl and .jsonl.gz, "parquet" for .parquet, otherwise "json" for the legacy
+             document keyed by message id.
+    """
+    if path.endswith(('.jsonl', '.jsonl.gz')):
+        return 'jsonl'
+    if path.endswith('.parquet'):
+        return 'parquet'
+    return 'json'
+
+
+def flatten_email(message_id, email_info):
+    """
+    Turn one entry of `email_data` into a flat record.
+
+    Parameters:
+        message_id (str): The Gmail message id.
+        email_info (dict): The scanned email, with its classification as JSON text under "Interaction Type".
+
+    Returns:
+        dict: The `RECORD_FIELDS` of the email; missing values are None.
+    """
+    classification = parse_classification(email_info)
+    confidence = classification.get('confidence')
+    return {
+        'message_id': message_id,
+        'subject': email_info.get('Subject'),
+        'sender': email_info.get('Sender'),
+        'date': email_info.get('Date'),
+        'category': classification.get('category') or None,
+        'company_name': classification.get('company_name') or None,
+        'website': classification.get('website') or None,
+        'confidence': float(confidence) if isinstance(confidence, (int, float)) else None,
+        # "local" for the local classifier, None for Gemini
+        'source': classification.get('source'),
+    }
+
+
+def iter_email_records(email_data):
+    """
+    Yield flat records of in-memory scan results, e.g. those returned by `process_emails`.
+
+    Parameters:
+        email_data (dict): Scan results keyed by message id.
+
+    Returns:
+        generator: Records as returned by `flatten_email`.
+    """
+    for message_id, email_info in email_data.items():
+        yield flatten_email(message_id, email_info)
+
+
+def iter_records(path, columns=None):
+    """
+    Read scan results lazily, one record at a time.
+
+    JSONL is streamed line by line and Parquet batch by batch, reading only the requested columns. The legacy
+    JSON document can only be read whole; convert it with `python scan_results.py convert`.
+
+    Parameters:
+        path (str): A .jsonl, .jsonl.gz, .parquet or legacy .json file.
+        columns (iterable of str, optional): The fields to read. Defaults to all of `RECORD_FIELDS`.
+
+    Returns:
+        generator: Record dictionaries with the requested fields.
+    """
+    columns = list(columns or RECORD_FIELDS)
+    file_format = results_format(path)
+
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        available = set(parquet_file.schema_arrow.names)
+        for batch in parquet_file.iter_batches(batch_size=PARQUET_BATCH_SIZE,
+                                               columns=[column for column in columns if column in available]):
+            for record in batch.to_pylist():
+                yield {column: record.get(column) for column in columns}
+        return
+
+    if file_format == 'jsonl':
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    yield {column: record.get(column) for column in columns}
+        return
+
+    with open(path, 'r') as file:
+        email_data = json.load(file)
+    for record in iter_email_records(email_data):
+        yield {column: record[column] for column in columns}
+
+
+def parquet_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('message_id', pa.string()),
+        ('subject', pa.string()),
+        ('sender', pa.string()),
+        ('date', pa.string()),
+        # a handful of distinct values, stored once per row group
+        ('category', pa.dictionary(pa.int32(), pa.string())),
+        ('company_name', pa.string()),
+        ('website', pa.string()),
+        ('confidence', pa.float32()),
+        ('source', pa.dictionary(pa.int32(), pa.string())),
+    ])
+
+
+def write_records(records, path):
+    """
+    Write scan results as JSONL or Parquet, depending on the extension, without holding them all in memory.
+
+    Parameters:
+        records (iterable of dict): Flat records, e.g. from `iter_email_records` or `iter_records`.
+        path (str): The output file, ending in .jsonl, .jsonl.gz or .parquet.
+
+    Returns:
+        int: The number of records written.
+    """
+    file_format = results_format(path)
+    if file_format == 'json':
+        raise ValueError(f"Unsupported output format for {path}, use .jsonl, .jsonl.gz or .parquet")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    written = 0
+
+    if file_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = parquet_schema()
+        batch = []
+        with pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+            for record in records:
+                batch.append(record)
+                if len(batch) >= PARQUET_BATCH_SIZE:
+                    writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                    written += len(batch)
+                    batch = []
+            if batch:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                written += len(batch)
+    else:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(tmp_path, 'wt', encoding='utf-8') as file:
+            for record in records:
+                file.write(json.dumps({field: record.get(field) for field in RECORD_FIELDS}, ensure_ascii=False))
+                file.write('\n')
+                written += 1
+
+    os.replace(tmp_path, path)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert and inspect scan result files.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help="Convert scan results between JSON, JSONL and Parquet")
+    convert_parser.add_argument('input', help="A .json, .jsonl, .jsonl.gz or .parquet file")
+    convert_parser.add_argument('output', help="A .jsonl, .jsonl.gz or .parquet file")
+
+    head_parser = subparsers.add_parser('head', help="Print the first records of a scan results file")
+    head_parser.add_argument('path')
+    head_parser.add_argument('-n', type=int, default=5)
+    head_parser.add_argument('--columns', nargs='+', choices=RECORD_FIELDS)
+
+    args = parser.parse_args()
+    if args.command == 'convert':
+        written = write_records(iter_records(args.input), args.output)
+        print(f"Wrote {written} records to {args.output} ({os.path.getsize(args.output)} bytes)")
+    else:
+        for number, record in enumerate(iter_records(args.path, args.columns)):
+            if number >= args.n:
+                break
+            print(json.dumps(record, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+import os
+import pickle
+import resource
+import shutil
+import sys
+import threading
+import time
+
+SESSION_STORE_DIR = os.getenv('SESSION_STORE_DIR', '.cache/sessions')
+# artifacts of a session untouched for this long are written to disk and dropped from memory
+SESSION_SPILL_AFTER = int(os.getenv('SESSION_SPILL_AFTER_SECONDS', '600'))
+# spilled artifacts are deleted after this long, the user has to scan again
+SESSION_EXPIRE_AFTER = int(os.getenv('SESSION_EXPIRE_AFTER_SECONDS', str(24 * 60 * 60)))
+SWEEP_INTERVAL = 60
+
+
+def estimate_size(value):
+    """
+    Estimate the memory held by an artifact, without serializing it.
+
+    Parameters:
+        value: An Arrow-backed object (with `nbytes` or a `table`), a string, or a container of them.
+
+    Returns:
+        int: Approximate size in bytes.
+    """
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    if hasattr(value, 'table') and hasattr(value.table, 'nbytes'):
+        return value.table.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+def current_rss():
+    """
+    Return the resident set size of the process.
+
+    Returns:
+        int: Current RSS in bytes where /proc is available, otherwise the peak RSS.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is reported in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SessionArtifactStore:
+    """
+    Process-wide home of large per-session artifacts, kept out of `st.session_state`.
+
+    Artifacts of active sessions live in memory. Those of idle sessions are pickled to disk and dropped from
+    memory, and restored transparently when the session comes back. Sizes are accounted per session so that
+    instances can be sized by users per GB.
+    """
+
+    def __init__(self, directory: str, spill_after: int, expire_after: int):
+        """
+        Create a new instance of "SessionArtifactStore".
+
+        Parameters:
+            directory (str): Where spilled sessions are written.
+            spill_after (int): Idle seconds after which a session's artifacts are spilled to disk.
+            expire_after (int): Idle seconds after which a session's artifacts are deleted.
+        """
+        self.directory = directory
+        self.spill_after = spill_after
+        self.expire_after = expire_after
+        self._lock = threading.Lock()
+        # session id -> {"artifacts": dict or None when spilled, "sizes": dict, "touched": float}
+        self._sessions = {}
+        self._swept_at = 0.0
+        self._sweeper = threading.Thread(target=self._sweep_loop, name='session-store-sweeper', daemon=True)
+        self.spills = 0
+        self.restores = 0
+
+    def start(self):
+        """Start sweeping idle sessions in the background, off the sessions' script threads."""
+        self._sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Session store sweep failed: {e}")
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, f'{session_id}.pickle')
+
+    def put(self, session_id, name, value):
+        """
+        Store an artifact of a session, replacing the previous one with the same name.
+
+        Parameters:
+            session_id (str): The Streamlit session id.
+            name (str): The artifact name.
+            value: The artifact; it must be picklable.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            session = self._load(session_id)
+            session['artifacts'][name] = value
+            session['sizes'][name] = estimate_size(value)
+            session['touched'] = time.monotonic()
+
+    def get(self, session_id, name, default=None):
+        """
+        Return an artifact of a session, reading it back from disk if the session was spilled.
+
+        Parameters:
+            session_id (str): The Streamlit session id.
+            name (str): The artifact name.
+            default (optional): Returned if the artifact does not exist.
+
+        Returns:
+            The artifact, or `default`.
+        """
+        with self._lock:
+            if session_id not in self._sessions:
+                return default
+            session = self._load(session_id)
+            session['touched'] = time.monotonic()
+            return session['artifacts'].get(name, default)
+
+    def drop(self, session_id):
+        """
+        Forget all artifacts of a session, e.g. on logout.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        try:
+            os.remove(self._path(session_id))
+        except OSError:
+            pass
+
+    def _load(self, session_id):
+        # callers hold the lock
+        session = self._sessions.setdefault(session_id, {'artifacts': {}, 'sizes': {}, 'touched': time.monotonic()})
+        if session['artifacts'] is None:
+            try:
+                with open(self._path(session_id), 'rb') as file:
+                    session['artifacts'] = pickle.load(file)
+                os.remove(self._path(session_id))
+                self.restores += 1
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                print(f"Could not restore spilled session {session_id}: {e}")
+                session['artifacts'], session['sizes'] = {}, {}
+        return session
+
+    def sweep(self, force=False):
+        """
+        Spill idle sessions to disk and delete expired ones. Runs at most once per `SWEEP_INTERVAL` unless forced.
+
+        The background sweeper calls this; sessions never sweep on their own script thread.
+
+        Parameters:
+            force (bool, optional): Sweep even if the last sweep was recent.
+
+        Returns:
+            None
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._swept_at < SWEEP_INTERVAL:
+                return
+            self._swept_at = now
+            idle = [(session_id, now - session['touched'], session) for session_id, session in self._sessions.items()]
+
+        for session_id, idle_for, session in idle:
+            if idle_for >= self.expire_after:
+                self._expire(session_id)
+            elif idle_for >= self.spill_after and session['artifacts']:
+                self._spill(session_id)
+
+    def _idle_for(self, session):
+        # callers hold the lock
+        return time.monotonic() - session['touched']
+
+    def _expire(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            # the session may have come back since the sweep listed it
+            if session is None or self._idle_for(session) < self.expire_after:
+                return
+            del self._sessions[session_id]
+        try:
+            os.remove(self._path(session_id))
+        except OSError:
+            pass
+
+    def _spill(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            # the session may have been used since the sweep listed it; spilling it now would drop live artifacts
+            if session is None or not session['artifacts'] or self._idle_for(session) < self.spill_after:
+                return
+            # a shallow copy, so a put while pickling cannot change the dict under it
+            artifacts = dict(session['artifacts'])
+            touched = session['touched']
+
+        # pickling a large session takes a while, so other sessions' get and put are not held up by it
+        path = self._path(session_id)
+        tmp_path = f'{path}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                pickle.dump(artifacts, file, protocol=pickle.HIGHEST_PROTOCOL)
+        except (OSError, pickle.PicklingError) as e:
+            print(f"Could not spill session {session_id}: {e}")
+            return
+
+        with self._lock:
+            # only drop the artifacts if the session was not used, replaced or dropped while they were written
+            if self._sessions.get(session_id) is not session or session['touched'] != touched:
+                self._remove_quietly(tmp_path)
+                return
+            try:
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Could not spill session {session_id}: {e}")
+                self._remove_quietly(tmp_path)
+                return
+            session['artifacts'] = None
+            self.spills += 1
+
+    @staticmethod
+    def _remove_quietly(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def memory_report(self, session_id=None):
+        """
+        Report the memory held by sessions.
+
+        Parameters:
+            session_id (str, optional): Include a per-artifact breakdown for this session.
+
+        Returns:
+            dict: Process RSS, sessions in memory and on disk, artifact bytes in memory, average artifact and
+                  RSS bytes per session, the resulting estimate of sessions per GiB, and the session breakdown.
+        """
+        with self._lock:
+            in_memory = {sid: sum(session['sizes'].values())
+                         for sid, session in self._sessions.items() if session['artifacts'] is not None}
+            spilled = len(self._sessions) - len(in_memory)
+            breakdown = dict(self._sessions[session_id]['sizes']) if session_id in self._sessions else {}
+
+        rss = current_rss()
+        sessions = max(len(in_memory), 1)
+        return {
+            'process_rss_mb': round(rss / 2 ** 20, 1),
+            'sessions_in_memory': len(in_memory),
+            'sessions_spilled': spilled,
+            'artifact_mb_in_memory': round(sum(in_memory.values()) / 2 ** 20, 2),
+            'average_artifact_kb_per_session': round(sum(in_memory.values()) / sessions / 1024, 1),
+            'rss_mb_per_session': round(rss / sessions / 2 ** 20, 1),
+            'sessions_per_gb_estimate': int(2 ** 30 / (rss / sessions)) if rss else None,
+            'spills': self.spills,
+            'restores': self.restores,
+            'this_session_kb': {name: round(size / 1024, 1) for name, size in breakdown.items()},
+        }
+
+    def clear_disk(self):
+        """Delete spilled sessions left over by a previous process."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    Return the artifact store shared by all sessions in this process, creating it on first use.
+
+    Spilled sessions of an earlier process cannot be resumed, so they are deleted when the store is created,
+    and the background sweeper is started.
+
+    Returns:
+        SessionArtifactStore: The process-wide store.
+    """
+    global _session_store
+    with _session_store_lock:
+        if _session_store is None:
+            _session_store = SessionArtifactStore(SESSION_STORE_DIR, SESSION_SPILL_AFTER, SESSION_EXPIRE_AFTER)
+            _session_store.clear_disk()
+            _session_store.start()
+    return _session_store
+
+
+def current_session_id():
+    """
+    Return the id of the Streamlit session running the current script.
+
+    Returns:
+        str: The session id, or "default" outside of a Streamlit script run.
+    """
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else 'default'
@@ -0,0 +1,403 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date, timedelta
+
+import streamlit as st
+
+from llm_cache import hit_ratio
+from utils import (
+    GMAIL_MAX_MESSAGES, QuotaExhaustedError, build_category_filter, build_gmail_service_from_credentials,
+    iter_message_pages, process_message
+)
+
+SCAN_CHECKPOINT_DIR = os.getenv('SCAN_CHECKPOINT_DIR', '.cache/scan_checkpoints')
+SCAN_SHARD_DAYS = int(os.getenv('SCAN_SHARD_DAYS', '7'))
+SCAN_WORKERS = int(os.getenv('SCAN_WORKERS', '4'))
+# with several shards competing for one quota, a shard gives up (and keeps its checkpoint) instead of waiting forever
+SCAN_RATE_LIMIT_RETRIES = int(os.getenv('SCAN_RATE_LIMIT_RETRIES', '2'))
+CHECKPOINT_EVERY = 25  # messages between checkpoint writes
+# checkpoints hold subjects and senders, so they are deleted once they are this old
+SCAN_CHECKPOINT_MAX_AGE_DAYS = int(os.getenv('SCAN_CHECKPOINT_MAX_AGE_DAYS', '7'))
+# emails that could not be fetched or classified are retried on resume, up to this many attempts in total
+MAX_MESSAGE_ATTEMPTS = 3
+
+
+def plan_shards(days, shard_days=SCAN_SHARD_DAYS, today=None):
+    """
+    Cover the scan window with fixed calendar shards, newest first.
+
+    Shards are aligned to multiples of `shard_days` since the first day of the calendar rather than to today,
+    so a shard keeps its dates, and its checkpoint, from one day to the next. The oldest and newest shards
+    may therefore reach past the window.
+
+    Parameters:
+        days (int): The number of past days to scan, including today.
+        shard_days (int, optional): The number of days per shard.
+        today (datetime.date, optional): The last day of the window. Defaults to the current date.
+
+    Returns:
+        list: Tuples of (first_day, last_day) as `datetime.date`, both inclusive.
+    """
+    today = today or date.today()
+    first_window_day = today - timedelta(days=days - 1)
+    shards = []
+    index = today.toordinal() // shard_days
+    while True:
+        first_day = date.fromordinal(max(index * shard_days, 1))
+        shards.append((first_day, first_day + timedelta(days=shard_days - 1)))
+        if first_day <= first_window_day:
+            return shards
+        index -= 1
+
+
+def shard_query(shard, category_filter):
+    """
+    Build the Gmail search query for one shard.
+
+    Parameters:
+        shard (tuple): The (first_day, last_day) of the shard, both inclusive.
+        category_filter (str): The category part of the query, see `build_category_filter`.
+
+    Returns:
+        str: The Gmail search query.
+    """
+    first_day, last_day = shard
+    # Gmail's after: is inclusive and before: is exclusive at day granularity
+    after = first_day.strftime('%Y/%m/%d')
+    before = (last_day + timedelta(days=1)).strftime('%Y/%m/%d')
+    return f'after:{after} before:{before} {category_filter}'.strip()
+
+
+class MessageBudget:
+    """
+    Cap on the messages processed by all shards of one scan together, shared by their worker threads.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.remaining = total
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class ShardCheckpoint:
+    """
+    On-disk progress of one shard: the processed message ids and the classified emails, in listing order.
+
+    Emails whose processing failed, e.g. on a transient Gmail error, are counted separately and retried on
+    resume until they reach `MAX_MESSAGE_ATTEMPTS`.
+    """
+
+    def __init__(self, path: str, shard: tuple):
+        self.path = path
+        self.shard = shard
+        self.done = False
+        self.processed_ids = []
+        self.failed_attempts = {}
+        self.email_data = {}
+        self.seconds = 0.0
+        self._processed_set = set()
+
+    @classmethod
+    def load(cls, path, shard):
+        """
+        Load a checkpoint from disk, or start an empty one if none exists or it is unreadable.
+
+        Parameters:
+            path (str): The checkpoint file.
+            shard (tuple): The (first_day, last_day) of the shard.
+
+        Returns:
+            ShardCheckpoint: The checkpoint.
+        """
+        checkpoint = cls(path, shard)
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return checkpoint
+
+        checkpoint.done = data.get('done', False)
+        checkpoint.processed_ids = data.get('processed_ids', [])
+        checkpoint.failed_attempts = data.get('failed_attempts', {})
+        checkpoint.email_data = data.get('email_data', {})
+        checkpoint.seconds = data.get('seconds', 0.0)
+        checkpoint._processed_set = set(checkpoint.processed_ids)
+        return checkpoint
+
+    def is_processed(self, message_id):
+        return (message_id in self._processed_set
+                or self.failed_attempts.get(message_id, 0) >= MAX_MESSAGE_ATTEMPTS)
+
+    @property
+    def skipped(self):
+        # the listed emails a resumed shard passes over
+        return len(self._processed_set) + sum(attempts >= MAX_MESSAGE_ATTEMPTS
+                                              for attempts in self.failed_attempts.values())
+
+    @property
+    def has_retries(self):
+        return any(attempts < MAX_MESSAGE_ATTEMPTS for attempts in self.failed_attempts.values())
+
+    def record(self, message_id, email_entry):
+        if email_entry is None:
+            self.failed_attempts[message_id] = self.failed_attempts.get(message_id, 0) + 1
+            return
+        self.failed_attempts.pop(message_id, None)
+        self.processed_ids.append(message_id)
+        self._processed_set.add(message_id)
+        self.email_data[message_id] = email_entry
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        # checkpoints hold subjects and senders, so only the app's user may read them
+        descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump({
+                'shard': [day.isoformat() for day in self.shard],
+                'done': self.done,
+                'seconds': self.seconds,
+                'processed_ids': self.processed_ids,
+                'failed_attempts': self.failed_attempts,
+                'email_data': self.email_data,
+            }, file)
+        os.replace(tmp_path, self.path)
+
+
+def prune_checkpoints(max_age_days=SCAN_CHECKPOINT_MAX_AGE_DAYS):
+    """
+    Delete checkpoints that have not been written for `max_age_days`, and the scan directories they leave empty.
+
+    Returns:
+        int: The number of checkpoints deleted.
+    """
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+    deleted = 0
+    for directory, _, names in os.walk(SCAN_CHECKPOINT_DIR, topdown=False):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    deleted += 1
+            except OSError:
+                continue
+        if directory != SCAN_CHECKPOINT_DIR:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+    return deleted
+
+
+def checkpoint_path(scan_key, shard):
+    first_day, last_day = shard
+    return os.path.join(SCAN_CHECKPOINT_DIR, scan_key, f"{first_day.isoformat()}_{last_day.isoformat()}.json")
+
+
+def make_scan_key(user_id, category_filter):
+    """
+    Identify the checkpoints of a user's scan. Shards are absolute date ranges, so the key does not include the window.
+
+    Parameters:
+        user_id (str): The user's OAuth id.
+        category_filter (str): The category part of the query.
+
+    Returns:
+        str: A 16-character hex digest.
+    """
+    return hashlib.sha256(json.dumps([user_id, category_filter]).encode('utf-8')).hexdigest()[:16]
+
+
+def scan_shard(credentials_json, user_id, shard, checkpoint, category_filter, budget, on_message=None):
+    """
+    Process one shard in a worker thread, resuming from its checkpoint.
+
+    Parameters:
+        credentials_json (str): Serialized OAuth credentials used to build this worker's own Gmail service.
+        user_id (str): The user's OAuth id, for fair queuing of Gemini calls.
+        shard (tuple): The (first_day, last_day) of the shard.
+        checkpoint (ShardCheckpoint): The shard's checkpoint, updated in place and saved periodically.
+        category_filter (str): The category part of the query.
+        budget (MessageBudget): The scan's cap on processed messages, shared with the other shards.
+        on_message (callable, optional): Called with no arguments after each processed message.
+
+    Returns:
+        dict: The shard report with "shard", "status", "messages", "classified", "seconds",
+              "messages_per_second" and the shard's LLM cache counter under "cache_stats".
+    """
+    service, _ = build_gmail_service_from_credentials(credentials_json)
+    cache_stats = Counter()
+    processed = 0
+    status = 'done'
+    started = time.monotonic()
+    # the emails processed by earlier runs are listed again, so they do not count towards the listing cap
+    max_listed = checkpoint.skipped + budget.total
+    listed = 0
+
+    try:
+        for messages, _ in iter_message_pages(service, shard_query(shard, category_filter), max_messages=max_listed):
+            listed += len(messages)
+            for msg in messages:
+                message_id = msg['id']
+                if checkpoint.is_processed(message_id):
+                    continue
+                if not budget.take():
+                    status = 'capped'
+                    break
+
+                checkpoint.record(message_id, process_message(
+                    service, message_id, cache_stats=cache_stats, max_rate_limit_retries=SCAN_RATE_LIMIT_RETRIES,
+                    user=user_id
+                ))
+                processed += 1
+                if on_message is not None:
+                    on_message()
+                if processed % CHECKPOINT_EVERY == 0:
+                    checkpoint.save()
+            if status != 'done':
+                break
+        if status == 'done' and listed >= max_listed:
+            # older emails of the shard may not have been listed, so it is resumed rather than marked done
+            status = 'capped'
+    except QuotaExhaustedError as e:
+        print(f"Stopping shard {shard[0]}..{shard[1]}: {e}")
+        status = 'quota exhausted'
+    except Exception as e:
+        print(f"Shard {shard[0]}..{shard[1]} failed: {e}")
+        status = 'failed'
+
+    seconds = time.monotonic() - started
+    checkpoint.seconds += seconds
+    # the shard holding today keeps receiving mail, so it is only ever resumed incrementally, never skipped;
+    # a shard with emails left to retry is resumed as well
+    checkpoint.done = status == 'done' and shard[1] < date.today() and not checkpoint.has_retries
+    checkpoint.save()
+
+    return {
+        'shard': f"{shard[0].isoformat()} – {shard[1].isoformat()}",
+        'status': status,
+        'messages': processed,
+        'classified': len(checkpoint.email_data),
+        'seconds': round(seconds, 1),
+        'messages_per_second': round(processed / seconds, 2) if seconds else 0.0,
+        'cache_stats': cache_stats,
+    }
+
+
+def process_emails_sharded(credentials_json, user_id, days, ignored_categories, covered_days=0,
+                           workers=SCAN_WORKERS, shard_days=SCAN_SHARD_DAYS, max_messages=GMAIL_MAX_MESSAGES):
+    """
+    Scan a large window by processing date shards in parallel, each with its own on-disk checkpoint.
+
+    Parameters:
+        credentials_json (str): Serialized OAuth credentials of the user.
+        user_id (str): The user's OAuth id, used to keep checkpoints apart.
+        days (int): The number of days from which to fetch and process emails.
+        ignored_categories (list of str): A list of email categories to ignore during processing.
+        covered_days (int, optional): The most recent days whose emails the caller already has, e.g. from the
+                                      background scan. Shards within them are skipped and their emails left out.
+        workers (int, optional): Number of shards processed concurrently.
+        shard_days (int, optional): Number of days per shard.
+        max_messages (int, optional): Cap on the number of messages processed by all shards together in this
+                                      scan, like the cap of `process_emails`. Shards it stops are resumed
+                                      by the next scan.
+
+    Returns:
+        dict: The same message-id keyed `email_data` as `process_emails`, merged newest shard first.
+
+    Description:
+        Completed shards are loaded from their checkpoints without touching Gmail or Gemini, and unfinished ones
+        continue where they stopped, so a crash or quota exhaustion only costs the remaining work.
+        Throughput is reported for every shard once the scan is over. Emails of the outer shards that fall
+        outside the window, or within `covered_days`, are left out of the result.
+    """
+    category_filter = build_category_filter(ignored_categories)
+    if category_filter is None:
+        return {}
+    prune_checkpoints()
+
+    shards = plan_shards(days, shard_days)
+    first_covered_day = date.today() - timedelta(days=covered_days - 1) if covered_days else None
+    if first_covered_day is not None:
+        shards = [shard for shard in shards if shard[0] < first_covered_day]
+    scan_key = make_scan_key(user_id, category_filter)
+    checkpoints = [ShardCheckpoint.load(checkpoint_path(scan_key, shard), shard) for shard in shards]
+    pending = [checkpoint for checkpoint in checkpoints if not checkpoint.done]
+
+    progress_bar = st.progress(0, text=f"Scanning {len(pending)} of {len(shards)} shard(s)...")
+    processed = Counter()
+    lock = threading.Lock()
+
+    def on_message():
+        with lock:
+            processed['messages'] += 1
+
+    budget = MessageBudget(max_messages)
+    reports = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(scan_shard, credentials_json, user_id, checkpoint.shard, checkpoint, category_filter,
+                            budget, on_message): checkpoint
+            for checkpoint in pending
+        }
+        remaining = set(futures)
+        # the progress bar can only be updated from the script thread, so it polls the shared counter
+        while remaining:
+            finished, remaining = wait(remaining, timeout=0.5, return_when=FIRST_COMPLETED)
+            reports.extend(future.result() for future in finished)
+            done_shards = len(shards) - len(remaining)
+            progress_bar.progress(int(99 * done_shards / len(shards)),
+                                  text=f"Analyzed {processed['messages']} emails, "
+                                       f"{done_shards}/{len(shards)} shard(s) finished...")
+
+    progress_bar.empty()
+
+    # merge in plan order (newest shard first, listing order within a shard) so the result is deterministic
+    first_window_day = (date.today() - timedelta(days=days - 1)).isoformat()
+    end_day = first_covered_day.isoformat() if first_covered_day is not None else None
+
+    def in_window(email_info):
+        # emails without a parseable date are kept rather than silently dropped
+        sent = email_info.get('Date')
+        return not sent or first_window_day <= sent and (end_day is None or sent < end_day)
+
+    email_data = {}
+    for checkpoint in checkpoints:
+        email_data.update((message_id, email_info) for message_id, email_info in checkpoint.email_data.items()
+                          if in_window(email_info))
+
+    cache_stats = sum((report.pop('cache_stats') for report in reports), Counter())
+    reports.sort(key=lambda report: report['shard'], reverse=True)
+    unfinished = [report for report in reports if report['status'] != 'done']
+
+    summary = (f"Classified {len(email_data)} emails in {len(shards)} shard(s), {cache_stats['local']} locally, "
+               f"{len(shards) - len(pending)} restored from checkpoints · "
+               f"LLM cache hit ratio {hit_ratio(cache_stats):.0%}")
+    print(summary)
+    for report in reports:
+        print(f"Shard {report['shard']}: {report['status']}, {report['messages']} emails "
+              f"in {report['seconds']}s ({report['messages_per_second']}/s)")
+
+    st.caption(summary)
+    if reports:
+        with st.expander('Shard throughput'):
+            st.table(reports)
+    if unfinished:
+        capped = any(report['status'] == 'capped' for report in unfinished)
+        capped = f" within the limit of {max_messages} emails per scan" if capped else ""
+        st.warning(f"{len(unfinished)} shard(s) did not finish{capped}. Scan again to resume them.")
+
+    return email_data
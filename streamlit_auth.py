@@ -6,7 +6,6 @@ import time
 import streamlit as st
 from typing import Literal
 import google_auth_oauthlib.flow
-from googleapiclient.discovery import build
 import json
 from streamlit_auth_cookie import CookieHandler
 
@@ -123,6 +122,8 @@ class Authenticate:
                     # Store credentials in session state
                     st.session_state["credentials"] = credentials.to_json()
 
+                    from googleapiclient.discovery import build
+
                     user_info_service = build(
                         serviceName="oauth2",
                         version="v2",
@@ -0,0 +1,62 @@
+import os
+
+from llm_cache import LLMCache, normalize_text
+
+
+def test_normalize_text_strips_volatile_parts():
+    text = 'Hi\u200b  there,\n\nyour order 123456 ships. Track: https://shop.example/t?utm_source=mail&id=9 now'
+
+    assert normalize_text(text) == 'Hi there, your order 0 ships. Track: https://shop.example/t now'
+
+
+def test_normalize_text_keeps_short_numbers():
+    assert normalize_text('Save 20% on 3 items') == 'Save 20% on 3 items'
+
+
+def test_keys_ignore_volatile_parts_but_not_the_model_or_version():
+    key = LLMCache.make_key('gemini', 'v1', 'Order 12345 https://a.example/x?u=1')
+
+    assert LLMCache.make_key('gemini', 'v1', 'Order  67890 https://a.example/x?u=2') == key
+    assert LLMCache.make_key('gemini', 'v2', 'Order 12345 https://a.example/x?u=1') != key
+    assert LLMCache.make_key('other', 'v1', 'Order 12345 https://a.example/x?u=1') != key
+
+
+def test_memory_tier_evicts_least_recently_used(tmp_path):
+    cache = LLMCache(str(tmp_path), max_memory_entries=2)
+    cache.set('a' * 64, 'first')
+    cache.set('b' * 64, 'second')
+    cache.get('a' * 64)
+    cache.set('c' * 64, 'third')
+
+    assert list(cache._memory) == ['a' * 64, 'c' * 64]
+    # evicted from memory, but still served from disk
+    assert cache.get('b' * 64) == 'second'
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    # no memory tier, so every lookup goes to disk and refreshes the entry
+    cache = LLMCache(str(tmp_path), max_memory_entries=0, max_disk_bytes=10 ** 6)
+    keys = ['a' * 64, 'b' * 64, 'c' * 64]
+    for age, key in zip((300, 200, 100), keys):
+        cache.set(key, 'x' * 100)
+        os.utime(cache._path(key), (1000 - age, 1000 - age))
+    entry_size = os.path.getsize(cache._path(keys[0]))
+
+    cache.get(keys[0])
+    cache.max_disk_bytes = 3 * entry_size
+    cache.set('d' * 64, 'x' * 100)
+
+    # the oldest entry was read last, so the second oldest goes first
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == 'x' * 100
+    assert cache._disk_bytes <= cache.max_disk_bytes * 0.9
+
+
+def test_falsy_results_are_not_cached(tmp_path):
+    cache = LLMCache(str(tmp_path))
+    stats = {'hits': 0, 'misses': 0}
+
+    assert cache.get_or_compute('e' * 64, lambda: '', stats) == ''
+    assert cache.get_or_compute('e' * 64, lambda: 'answer', stats) == 'answer'
+    assert cache.get_or_compute('e' * 64, lambda: 'other', stats) == 'answer'
+    assert stats == {'hits': 1, 'misses': 2}
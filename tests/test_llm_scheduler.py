@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from llm_scheduler import (
+    PRIORITY_BACKGROUND, PRIORITY_BULK, PRIORITY_INTERACTIVE, DeadlineExceededError, FairShareScheduler
+)
+
+
+def wait_for_depth(scheduler, depth, timeout=5):
+    deadline = time.monotonic() + timeout
+    while sum(scheduler.metrics()['queue_depth'].values()) < depth:
+        assert time.monotonic() < deadline, "requests were not queued in time"
+        time.sleep(0.005)
+
+
+def admit_in_order(scheduler, requests):
+    """Queue (user, priority) requests one after the other and return the order in which they were admitted."""
+    admitted = []
+    lock = threading.Lock()
+
+    def request(user, priority):
+        scheduler.acquire(user, priority)
+        with lock:
+            admitted.append((user, priority))
+
+    # the only token is taken, so every request waits in the queue until all of them are there
+    scheduler.acquire('setup')
+    threads = []
+    for depth, (user, priority) in enumerate(requests, start=1):
+        thread = threading.Thread(target=request, args=(user, priority))
+        thread.start()
+        threads.append(thread)
+        wait_for_depth(scheduler, depth)
+    for thread in threads:
+        thread.join(timeout=10)
+    return admitted
+
+
+def test_users_are_served_round_robin():
+    scheduler = FairShareScheduler(requests_per_minute=1200, burst=1, rate_limit_backoff=1)
+
+    admitted = admit_in_order(scheduler, [('alice', PRIORITY_BULK)] * 3 + [('bob', PRIORITY_BULK)] * 2)
+
+    assert [user for user, _ in admitted] == ['alice', 'bob', 'alice', 'bob', 'alice']
+
+
+def test_interactive_requests_go_before_bulk_and_background():
+    scheduler = FairShareScheduler(requests_per_minute=1200, burst=1, rate_limit_backoff=1)
+
+    admitted = admit_in_order(scheduler, [('alice', PRIORITY_BACKGROUND), ('alice', PRIORITY_BULK),
+                                          ('bob', PRIORITY_INTERACTIVE)])
+
+    assert [priority for _, priority in admitted] == [PRIORITY_INTERACTIVE, PRIORITY_BULK, PRIORITY_BACKGROUND]
+
+
+def test_background_requests_leave_the_reserve():
+    scheduler = FairShareScheduler(requests_per_minute=1, burst=3, rate_limit_backoff=1, background_reserve=2)
+    scheduler.acquire('alice', PRIORITY_BULK)
+
+    # two tokens are left, which is exactly the reserve
+    with pytest.raises(DeadlineExceededError):
+        scheduler.acquire('bob', PRIORITY_BACKGROUND, deadline=time.monotonic() + 0.05)
+    scheduler.acquire('bob', PRIORITY_BULK, deadline=time.monotonic() + 0.05)
+
+
+def test_deadline_withdraws_the_ticket():
+    scheduler = FairShareScheduler(requests_per_minute=1, burst=1, rate_limit_backoff=1)
+    scheduler.acquire('alice')
+
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceededError):
+        scheduler.acquire('bob', deadline=started + 0.1)
+
+    assert time.monotonic() - started < 1
+    metrics = scheduler.metrics()
+    assert sum(metrics['queue_depth'].values()) == 0
+    assert metrics['queue_depth_by_user'] == {}
+
+
+def test_expired_ticket_does_not_block_the_queue():
+    scheduler = FairShareScheduler(requests_per_minute=600, burst=1, rate_limit_backoff=1)
+    scheduler.acquire('setup')
+    outcomes = {}
+
+    def request(user, deadline=None):
+        try:
+            scheduler.acquire(user, deadline=deadline)
+            outcomes[user] = 'admitted'
+        except DeadlineExceededError:
+            outcomes[user] = 'expired'
+
+    # bob's ticket is at the head of the queue when it expires, carol waits behind it
+    bob = threading.Thread(target=request, args=('bob', time.monotonic() + 0.05))
+    bob.start()
+    wait_for_depth(scheduler, 1)
+    carol = threading.Thread(target=request, args=('carol',))
+    carol.start()
+    bob.join(timeout=5)
+    carol.join(timeout=5)
+
+    assert outcomes == {'bob': 'expired', 'carol': 'admitted'}
+
+
+def test_rate_limit_pauses_admissions():
+    scheduler = FairShareScheduler(requests_per_minute=6000, burst=5, rate_limit_backoff=60)
+    scheduler.report_rate_limited()
+
+    with pytest.raises(DeadlineExceededError):
+        scheduler.acquire('alice', PRIORITY_INTERACTIVE, deadline=time.monotonic() + 0.05)
+    assert scheduler.metrics()['rate_limited'] == 1
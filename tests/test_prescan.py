@@ -0,0 +1,117 @@
+import json
+from datetime import date
+
+import pytest
+
+import prescan
+from utils import QuotaExhaustedError
+
+USER = 'user-1'
+
+
+@pytest.fixture
+def inbox(monkeypatch, tmp_path):
+    """An enrolled user whose inbox holds `inbox['ids']`, newest first, listed in pages of 10."""
+    state = {'ids': [f'msg-{i}' for i in range(25)], 'fail_at': None, 'processed': []}
+
+    def iter_message_pages(service, query, max_messages):
+        message_ids = state['ids'][:max_messages]
+        for start in range(0, len(message_ids), 10):
+            yield [{'id': message_id} for message_id in message_ids[start:start + 10]], len(message_ids)
+
+    def process_message(service, message_id, **kwargs):
+        if message_id == state['fail_at']:
+            raise QuotaExhaustedError('429')
+        state['processed'].append(message_id)
+        return {'Subject': message_id, 'Date': date.today().isoformat()}
+
+    monkeypatch.setattr(prescan, 'PRESCAN_DIR', str(tmp_path))
+    monkeypatch.setattr(prescan, 'build_gmail_service_from_credentials', lambda credentials: (None, credentials))
+    monkeypatch.setattr(prescan, 'iter_message_pages', iter_message_pages)
+    monkeypatch.setattr(prescan, 'process_message', process_message)
+    assert prescan.enroll(USER, json.dumps({'refresh_token': 'token'}), [])
+    return state
+
+
+def test_finished_run_moves_last_scan(inbox):
+    result = prescan.run_prescan(USER)
+
+    state = prescan.load_state(USER)
+    assert result['status'] == 'done'
+    assert result['processed'] == 25
+    assert state['last_scan'] is not None
+    assert len(state['email_data']) == 25
+    assert prescan.load_prescan(USER, 7, []) is not None
+
+
+def test_capped_listing_does_not_move_last_scan(inbox, monkeypatch):
+    monkeypatch.setattr(prescan, 'GMAIL_MAX_MESSAGES', 10)
+
+    statuses = [prescan.run_prescan(USER)['status'] for _ in range(2)]
+    state = prescan.load_state(USER)
+    assert statuses == ['listing capped', 'listing capped']
+    assert state['last_scan'] is None
+    assert prescan.load_prescan(USER, 7, []) is None
+
+    # the third run lists past the 20 seen emails to the end of the inbox
+    assert prescan.run_prescan(USER)['status'] == 'done'
+    assert prescan.load_state(USER)['last_scan'] is not None
+    assert inbox['processed'] == inbox['ids']
+
+
+def test_exhausted_budget_does_not_move_last_scan(inbox, monkeypatch):
+    monkeypatch.setattr(prescan, 'PRESCAN_DAILY_BUDGET', 15)
+
+    result = prescan.run_prescan(USER)
+
+    state = prescan.load_state(USER)
+    assert (result['status'], result['processed']) == ('budget exhausted', 15)
+    assert state['last_scan'] is None
+    assert state['seen_ids'] == inbox['ids'][:15]
+
+
+def test_quota_exhaustion_keeps_progress_without_moving_last_scan(inbox):
+    inbox['fail_at'] = 'msg-12'
+
+    result = prescan.run_prescan(USER)
+    state = prescan.load_state(USER)
+    assert (result['status'], result['processed']) == ('quota exhausted', 12)
+    assert state['last_scan'] is None
+
+    inbox['fail_at'] = None
+    assert prescan.run_prescan(USER)['status'] == 'done'
+    # the second run skipped the emails the first one processed
+    assert inbox['processed'] == inbox['ids']
+
+
+def test_finished_run_only_keeps_its_own_seen_ids(inbox, monkeypatch):
+    monkeypatch.setattr(prescan, 'PRESCAN_DAILY_BUDGET', 15)
+    prescan.run_prescan(USER)
+    monkeypatch.setattr(prescan, 'PRESCAN_DAILY_BUDGET', 100)
+
+    assert prescan.run_prescan(USER)['status'] == 'done'
+    assert prescan.load_state(USER)['seen_ids'] == inbox['ids'][15:]
+
+
+def test_concurrent_run_is_skipped(inbox):
+    run_lock = prescan._run_lock(USER)
+    run_lock.acquire()
+    try:
+        assert prescan.run_prescan(USER)['status'] == 'already running'
+    finally:
+        run_lock.release()
+    assert inbox['processed'] == []
+
+
+def test_results_are_dropped_when_categories_change_during_a_run(inbox, monkeypatch):
+    def process_message(service, message_id, **kwargs):
+        # the user picks other categories in the app while the background scan runs
+        prescan.enroll(USER, json.dumps({'refresh_token': 'token'}), ['Promotions'])
+        return {'Subject': message_id, 'Date': date.today().isoformat()}
+
+    monkeypatch.setattr(prescan, 'process_message', process_message)
+
+    assert prescan.run_prescan(USER)['status'] == 'not enrolled'
+    state = prescan.load_state(USER)
+    assert state['ignored_categories'] == ['Promotions']
+    assert state['last_scan'] is None and state['email_data'] == {}
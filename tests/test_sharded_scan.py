@@ -0,0 +1,84 @@
+from collections import Counter
+from datetime import date, timedelta
+
+import pytest
+
+import sharded_scan
+from sharded_scan import MessageBudget, ShardCheckpoint, plan_shards, scan_shard, shard_query
+
+
+@pytest.mark.parametrize('days', [1, 7, 8, 30, 60, 365])
+@pytest.mark.parametrize('today', [date(2026, 1, 1), date(2026, 3, 15), date(2026, 10, 19)])
+def test_shards_cover_the_window_newest_first(days, today):
+    shards = plan_shards(days, shard_days=7, today=today)
+
+    assert shards[0][0] <= today <= shards[0][1]
+    assert shards[-1][0] <= today - timedelta(days=days - 1)
+    for (first_day, last_day), (next_first_day, next_last_day) in zip(shards, shards[1:]):
+        assert last_day - first_day == timedelta(days=6)
+        # contiguous, without gaps or overlaps
+        assert next_last_day + timedelta(days=1) == first_day
+
+
+def test_shards_keep_their_dates_from_one_day_to_the_next():
+    today = date(2026, 10, 19)
+    yesterday_shards = set(plan_shards(30, shard_days=7, today=today - timedelta(days=1)))
+
+    for shard in plan_shards(30, shard_days=7, today=today)[1:]:
+        assert shard in yesterday_shards
+    assert all(first_day.toordinal() % 7 == 0 for first_day, _ in yesterday_shards)
+
+
+def test_shard_query_covers_the_last_day():
+    query = shard_query((date(2026, 10, 12), date(2026, 10, 18)), '-category:promotions')
+
+    assert query == 'after:2026/10/12 before:2026/10/19 -category:promotions'
+
+
+@pytest.fixture
+def fake_gmail(monkeypatch):
+    shards = {
+        (date(2026, 10, 12), date(2026, 10, 18)): [f'new-{i}' for i in range(30)],
+        (date(2026, 10, 5), date(2026, 10, 11)): [f'old-{i}' for i in range(30)],
+    }
+    calls = Counter()
+
+    def iter_message_pages(service, query, max_messages):
+        message_ids = shards[query][:max_messages]
+        for start in range(0, len(message_ids), 10):
+            yield [{'id': message_id} for message_id in message_ids[start:start + 10]], len(message_ids)
+
+    def process_message(service, message_id, **kwargs):
+        calls[message_id] += 1
+        return {'Subject': message_id, 'Date': '2026-10-10'}
+
+    monkeypatch.setattr(sharded_scan, 'build_gmail_service_from_credentials', lambda credentials: (None, credentials))
+    monkeypatch.setattr(sharded_scan, 'shard_query', lambda shard, category_filter: shard)
+    monkeypatch.setattr(sharded_scan, 'iter_message_pages', iter_message_pages)
+    monkeypatch.setattr(sharded_scan, 'process_message', process_message)
+    return list(shards), calls
+
+
+def test_shards_share_one_message_cap(fake_gmail, tmp_path):
+    shards, calls = fake_gmail
+    budget = MessageBudget(40)
+
+    reports = [scan_shard('{}', 'user', shard, ShardCheckpoint(str(tmp_path / f'{index}.json'), shard), '', budget)
+               for index, shard in enumerate(shards)]
+
+    assert sum(calls.values()) == 40
+    assert [report['status'] for report in reports] == ['done', 'capped']
+
+
+def test_capped_shard_resumes_past_its_processed_emails(fake_gmail, tmp_path):
+    shards, calls = fake_gmail
+    path = str(tmp_path / 'old.json')
+
+    first = scan_shard('{}', 'user', shards[1], ShardCheckpoint(path, shards[1]), '', MessageBudget(20))
+    checkpoint = ShardCheckpoint.load(path, shards[1])
+    second = scan_shard('{}', 'user', shards[1], checkpoint, '', MessageBudget(20))
+
+    assert (first['status'], first['messages']) == ('capped', 20)
+    assert (second['status'], second['messages']) == ('done', 10)
+    assert checkpoint.done
+    assert max(calls.values()) == 1
@@ -1,72 +1,116 @@
-import requests
-from langchain_google_vertexai import VertexAI
 import re
-from langchain_community.document_loaders import UnstructuredURLLoader
-import vertexai
-from vertexai.generative_models import GenerativeModel, GenerationConfig
-import google.auth
+import codecs
+import importlib
+import threading
+import time
 import json
 import streamlit as st
-import random
-import pandas as pd
 import os
 from streamlit_auth import Authenticate
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 from email.mime.text import MIMEText
+from html.parser import HTMLParser
 import base64
 from datetime import datetime, timedelta
-import time
-
-
-def get_first_working_url(json_data):
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from llm_cache import LLMCache, prompt_version, hit_ratio
+from entity_index import EntityIndex, registrable_domain, sender_domain
+from logo_cache import fetch_logo_data_uris, logo_grid_html
+from llm_scheduler import (
+    PRIORITY_BULK, PRIORITY_INTERACTIVE, DeadlineExceededError, get_llm_scheduler, is_rate_limit_error
+)
+from llm_router import Route, StructuredRouter, parse_json_object
+from local_classifier import LOCAL_CLASSIFIER_MIN_CONFIDENCE, get_local_classifier
+from privacy_discovery import discover_privacy_urls
+from contact_index import lookup_contact, record_lookup
+from http_client import HttpClientError, get_http_client
+
+
+GEMINI_MODEL_NAME = 'gemini-1.5-flash-001'
+# classifications the fast model is unsure about, or gets wrong, are escalated to this model
+GEMINI_ESCALATION_MODEL_NAME = os.getenv('GEMINI_ESCALATION_MODEL_NAME', 'gemini-1.5-pro-002')
+
+LLM_CACHE_DIR = os.getenv('LLM_CACHE_DIR', '.cache/llm')
+LLM_CACHE_MAX_DISK_MB = int(os.getenv('LLM_CACHE_MAX_DISK_MB', '64'))
+
+_llm_cache = None
+
+
+# Vertex AI, LangChain, pandas, Arrow and the Google API client take seconds to import, so they are imported
+# inside the scan and lookup functions that need them instead of slowing down the login page
+HEAVY_MODULES = (
+    'vertexai',
+    'vertexai.generative_models',
+    'langchain_google_vertexai',
+    'unstructured.partition.auto',
+    'google.oauth2.credentials',
+    'google.auth.transport.requests',
+    'googleapiclient.discovery',
+    'pandas',
+    'pyarrow.compute',
+)
+
+_prewarm_started = False
+
+
+def prewarm_heavy_imports():
     """
-    Retrieve the first working URL from a list in a JSON response.
+    Import the heavy dependencies in a background thread so that the first scan does not pay for them.
 
-    Parameters:
-        json_data (dict): JSON data containing a "success" status and a list of URLs under the "links" key.
+    Meant to be called after the first page has rendered. It does nothing if PREWARM_IMPORTS is set to "0"
+    or if pre-warming was already started in this process.
 
     Returns:
-        str: The first URL that returns a successful HTTP response (status code 200).
-
-    Raises:
-        ValueError: If the operation is unsuccessful, no URLs are provided, or no valid URL is found.
+        None
     """
-    # Check if "success" key exists and its value is True
-    if not json_data.get('success', False):
-        raise ValueError("The operation was not successful")
+    global _prewarm_started
+    if _prewarm_started or os.getenv('PREWARM_IMPORTS', '1') == '0':
+        return
+    _prewarm_started = True
 
-    # Check if "links" key exists and it has a list of URLs
-    urls = json_data.get('links', [])
-    if not urls:
-        raise ValueError("No URLs provided")
+    def prewarm():
+        for module_name in HEAVY_MODULES:
+            try:
+                importlib.import_module(module_name)
+            except ImportError as e:
+                print(f"Could not pre-warm {module_name}: {e}")
 
-    # Iterate through the list of URLs and check for a valid one
-    for url in urls:
-        try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                return url
-        except requests.exceptions.RequestException as e:
-            # Handle possible connection errors and skip to next URL
-            print(f"Error checking {url}: {e}")
-            continue
+    threading.Thread(target=prewarm, name='prewarm-imports', daemon=True).start()
 
-    # If no valid URL is found, raise an error
-    raise ValueError("No valid URL found in the provided list")
+
+def get_llm_cache():
+    """
+    Return the process-wide LLM response cache, creating it on first use.
+
+    Returns:
+        LLMCache: The cache shared by all sessions in this process.
+    """
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = LLMCache(LLM_CACHE_DIR, max_disk_bytes=LLM_CACHE_MAX_DISK_MB * 1024 * 1024)
+    return _llm_cache
 
 
 def return_privacy_url(base_url):
     """
-     Query an API to retrieve URLs related to privacy information for a given website.
+     Retrieve URLs related to privacy information for a given website.
 
      Parameters:
          base_url (str): The base URL of the website for which to retrieve privacy-related links.
 
      Returns:
-         requests.Response: The API response object containing privacy URLs.
+         dict: A "success" status and the privacy URLs under the "links" key, best candidate first, with the
+               pages the discovery already downloaded under "pages", see `discover_privacy_urls`.
+
+     Description:
+         The website's own robots.txt, sitemaps, footer links and well-known privacy paths are searched first.
+         The Firecrawl map API is only queried if none of them point to a privacy page.
      """
+    discovered = discover_privacy_urls(base_url)
+    if discovered['success']:
+        return discovered
+
+    print(f"No privacy page found on {base_url}, falling back to Firecrawl")
     url = "https://api.firecrawl.dev/v1/map"
 
     payload = {
@@ -80,208 +124,500 @@ def return_privacy_url(base_url):
         f"Authorization": f"Bearer {os.getenv('FIRECRAWL_API_KEY')}",
         "Content-Type": "application/json"
     }
-    return requests.request("POST", url, json=payload, headers=headers)
+    try:
+        response = get_http_client().post(url, json=payload, headers=headers, timeout=(3, 30))
+        return response.json()
+    except (HttpClientError, ValueError) as e:
+        print(f"Firecrawl lookup for {base_url} failed: {e}")
+        return {"success": False, "links": []}
 
 
-def extract_email(privacy_url):
+EXTRACT_EMAIL_PROMPT = """
+    Based on the below text, what is the email for data privacy/GDPR contact?
+    Return only email address.
+    {page_content}
     """
-    Extract the data privacy or GDPR contact email address from a privacy URL.
+
+EXTRACT_EMAIL_PROMPT_VERSION = prompt_version(EXTRACT_EMAIL_PROMPT)
+
+
+# make sure to return only valid email addresses
+EMAIL_PATTERN = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
+
+
+# privacy pages are long, but not this long; the rest of an oversized page is not read
+PAGE_MAX_BYTES = 4 * 1024 * 1024
+
+
+def page_text(content, content_type):
+    """
+    Partition a downloaded web page and return its text content.
 
     Parameters:
-        privacy_url (str): The URL of the privacy page to analyze.
+        content (bytes): The body of the page.
+        content_type (str): The Content-Type header of the response.
 
     Returns:
-        str: The extracted email address if found; otherwise, "No email available".
+        str: The text of the page, its elements separated by blank lines.
     """
-    url = [privacy_url]
-    loader = UnstructuredURLLoader(urls=url)
-    data = loader.load()
+    import io
+    from unstructured.partition.auto import partition
 
-    credentials, project_id = google.auth.load_credentials_from_file('service_acc.json')
-    vertexai.init(project=project_id, location="us-central1", credentials=credentials)
+    # the same partitioning UnstructuredURLLoader applies, without its own unpooled requests
+    content_type = content_type.split(';')[0].strip() or 'text/html'
+    elements = partition(file=io.BytesIO(content), content_type=content_type)
+    return '\n\n'.join(str(element) for element in elements)
 
-    model = VertexAI(model_name='gemini-1.5-flash-001', temperature=0)
 
-    prompt = f"""
-    Based on the below text, what is the email for data privacy/GDPR contact?
-    Return only email address.
-    {data[0]}
+def load_page_text(url):
     """
-    response = model.invoke(prompt)
+    Load a web page through the shared HTTP client and return its text content.
 
-    # make sure to return only valid email addresses
-    email_pattern = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
+    Parameters:
+        url (str): The URL of the page.
 
-    match = re.search(email_pattern, response)
-    if match:
-        return match.group(0)
-    else:
-        return "No email available"
+    Returns:
+        str: The text of the page, its elements separated by blank lines.
+
+    Raises:
+        ValueError: If the page cannot be fetched or does not answer with 200.
+    """
+    try:
+        response = get_http_client().get(url, max_bytes=PAGE_MAX_BYTES)
+    except HttpClientError as e:
+        raise ValueError(f"Could not load {url}: {e}") from e
+    if response.status_code != 200:
+        raise ValueError(f"Could not load {url}: HTTP {response.status_code}")
+    return page_text(response.content, response.headers.get('Content-Type', 'text/html'))
 
 
-# function to check if url is working
-def check_url(url):
+def load_privacy_page(json_data):
     """
-    Check if a URL is accessible and returns a successful HTTP status.
+    Load the first working privacy page of a `return_privacy_url` response.
 
     Parameters:
-        url (str): The URL to check.
+        json_data (dict): A "success" status, the candidate URLs under "links", and optionally under "pages"
+                          the (content_type, body) of candidates the discovery already downloaded.
 
     Returns:
-        bool: True if the URL returns a 200 status code, False otherwise.
+        tuple: The (url, text) of the first page that answers with 200. Pages downloaded by the discovery are
+               reused, the other candidates are fetched once each.
+
+    Raises:
+        ValueError: If the operation is unsuccessful, no URLs are provided, or no valid URL is found.
     """
-    try:
-        response = requests.get(url)
-        return response.status_code == 200
-    except requests.exceptions.RequestException as e:
-        return False
+    if not json_data.get('success', False):
+        raise ValueError("The operation was not successful")
+
+    urls = json_data.get('links', [])
+    if not urls:
+        raise ValueError("No URLs provided")
+
+    pages = json_data.get('pages', {})
+    for url in urls:
+        if url in pages:
+            content_type, content = pages[url]
+            return url, page_text(content, content_type)
+        try:
+            return url, load_page_text(url)
+        except ValueError as e:
+            # skip to the next candidate
+            print(f"Error checking {url}: {e}")
+
+    raise ValueError("No valid URL found in the provided list")
 
 
-# read json file and transform to dictionary
-def read_json(file_path):
+def extract_email_from_text(page_content, user=None, priority=PRIORITY_INTERACTIVE):
     """
-    Read a JSON file and return its contents as a dictionary.
+    Extract the data privacy or GDPR contact email address from the text of a privacy page.
 
     Parameters:
-        file_path (str): The path to the JSON file.
+        page_content (str): The text of the privacy page.
+        user (str, optional): The requesting user's id, for fair queuing of the Gemini call.
+        priority (int, optional): Scheduler priority of the Gemini call.
 
     Returns:
-        dict: The data from the JSON file as a dictionary.
+        str: The extracted email address if found; otherwise, "No email available".
     """
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-    return data
+    def invoke_model():
+        import google.auth
+        import vertexai
+        from langchain_google_vertexai import VertexAI
+
+        credentials, project_id = google.auth.load_credentials_from_file('service_acc.json')
+        vertexai.init(project=project_id, location="us-central1", credentials=credentials)
+
+        model = VertexAI(model_name=GEMINI_MODEL_NAME, temperature=0)
+        with get_llm_scheduler().slot(user, priority):
+            return model.invoke(EXTRACT_EMAIL_PROMPT.format(page_content=page_content))
 
+    # the same privacy page is shared by many users, so the answer is cached by page content
+    cache = get_llm_cache()
+    cache_key = cache.make_key(GEMINI_MODEL_NAME, EXTRACT_EMAIL_PROMPT_VERSION, page_content)
+    response = cache.get_or_compute(cache_key, invoke_model)
+
+    match = re.search(EMAIL_PATTERN, response)
+    if match:
+        return match.group(0)
+    else:
+        return "No email available"
 
-def compose_logo_url(logo_url_set, email_info):
+
+# characters of a privacy page sent in a batched extraction; the contact sits next to a handful of phrases
+GDPR_EXCERPT_CHARS = int(os.getenv('GDPR_EXCERPT_CHARS', '2000'))
+# prompt tokens per batched request, and companies per request, which bounds the answer length
+GDPR_BATCH_TOKEN_BUDGET = int(os.getenv('GDPR_BATCH_TOKEN_BUDGET', '8000'))
+GDPR_BATCH_MAX_DOMAINS = int(os.getenv('GDPR_BATCH_MAX_DOMAINS', '10'))
+GDPR_LOOKUP_WORKERS = int(os.getenv('GDPR_LOOKUP_WORKERS', '8'))
+# single and bulk lookups share one daily cache per registrable domain
+GDPR_CONTACT_TTL = 24 * 60 * 60
+CONTACT_KEYWORDS = (
+    'data protection', 'protection officer', 'dpo', 'gdpr', 'privacy', 'contact', 'e-mail', 'email', 'write to',
+    'datenschutz', 'rgpd', 'rodo', '[at]', '(at)',
+)
+
+EXTRACT_EMAILS_SYSTEM_INSTRUCTIONS = """
+    You find the contact email address for data privacy and GDPR requests on company privacy pages.
+    Prefer a dedicated privacy, data protection or DPO address over general support addresses.
+    Only return addresses that appear in the excerpt of that company; return an empty string if there is none.
+    """
+
+EXTRACT_EMAILS_PROMPT = """
+    Below are excerpts of the privacy pages of several companies, each introduced by its domain.
+    For every domain, return the email address for data privacy/GDPR requests, and your overall confidence
+    in the answers, from 0 (a guess) to 1 (certain).
+
+    {excerpts}
+    """
+
+EXTRACT_EMAILS_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "contacts": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "domain": {"type": "STRING"},
+                    "email": {"type": "STRING"}
+                },
+                "required": ["domain", "email"],
+                "propertyOrdering": ["domain", "email"]
+            }
+        },
+        "confidence": {"type": "NUMBER"}
+    },
+    "required": ["contacts", "confidence"],
+    "propertyOrdering": ["contacts", "confidence"]
+}
+
+
+def privacy_excerpt(page_content, max_chars=GDPR_EXCERPT_CHARS):
     """
-    Generate a logo URL based on company website information and add it to a set if valid.
+    Trim a privacy page to the lines most likely to name the GDPR contact.
 
     Parameters:
-        logo_url_set (set): A set to store valid logo URLs.
-        email_info (dict): Dictionary containing email interaction information, including a JSON-formatted "Interaction Type".
+        page_content (str): The text of the privacy page.
+        max_chars (int, optional): Maximum length of the excerpt.
 
     Returns:
-        None
+        str: Lines with email addresses or contact phrases and their neighbours, in page order.
     """
-    classification = json.loads(email_info["Interaction Type"])
-    website = classification.get("website", "")
+    lines = [line.strip() for line in page_content.splitlines() if line.strip()]
+    if sum(len(line) + 1 for line in lines) <= max_chars:
+        return '\n'.join(lines)
+
+    scores = []
+    for line in lines:
+        folded = line.casefold()
+        score = 3 * len(re.findall(EMAIL_PATTERN, line)) + sum(keyword in folded for keyword in CONTACT_KEYWORDS)
+        scores.append(score)
+
+    # the best lines first, each with the line before it, which often says what the address is for
+    selected = set()
+    size = 0
+    for index in sorted(range(len(lines)), key=lambda index: -scores[index]):
+        if not scores[index]:
+            break
+        for neighbour in (index - 1, index):
+            if 0 <= neighbour < len(lines) and neighbour not in selected:
+                line_size = min(len(lines[neighbour]), 300) + 1
+                if size + line_size > max_chars:
+                    continue
+                selected.add(neighbour)
+                size += line_size
+    return '\n'.join(lines[index][:300] for index in sorted(selected))
+
+
+def estimate_tokens(text):
+    # about four characters per token for the mostly English page text
+    return len(text) // 4 + 1
+
+
+def plan_extraction_batches(excerpts, token_budget=GDPR_BATCH_TOKEN_BUDGET, max_domains=GDPR_BATCH_MAX_DOMAINS):
+    """
+    Split excerpts into batches that each fit one request.
 
-    # Clean the website: remove 'https://www.' or 'http://www.' and any slashes
-    cleaned_website = re.sub(r'https?://(www\.)?', '', website).strip('/')
+    Parameters:
+        excerpts (dict): Domain -> excerpt.
+        token_budget (int, optional): Estimated prompt tokens per batch.
+        max_domains (int, optional): Domains per batch.
 
-    logo_url = f"https://img.logo.dev/{cleaned_website}?token={os.getenv('LOGODEV_API_KEY')}"
+    Returns:
+        list: Lists of domains; an excerpt larger than the budget gets a batch of its own.
+    """
+    batches = []
+    batch, tokens = [], 0
+    for domain, excerpt in excerpts.items():
+        excerpt_tokens = estimate_tokens(excerpt) + 10
+        if batch and (tokens + excerpt_tokens > token_budget or len(batch) >= max_domains):
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(domain)
+        tokens += excerpt_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def validate_contacts(text):
+    """
+    Parse a batched extraction answer, keeping only well-formed email addresses.
 
-    # Check if the URL is valid and add it to the set
-    if check_url(logo_url):
-        logo_url_set.add(logo_url)
+    Parameters:
+        text (str): The model's response text.
 
+    Returns:
+        dict or None: "contacts" as a dict of registrable domain -> email ("" if none was found) and "confidence",
+                      or None if the answer is mis-shaped.
+    """
+    answer = parse_json_object(text, required=[])
+    if answer is None or not isinstance(answer.get('contacts'), list):
+        return None
+    contacts = {}
+    for contact in answer['contacts']:
+        if not isinstance(contact, dict) or not isinstance(contact.get('domain'), str):
+            return None
+        match = re.search(EMAIL_PATTERN, contact.get('email') or '')
+        # the model may echo the domain as "www.adidas.com" or a URL
+        domain = registrable_domain(contact['domain']) or contact['domain'].strip().casefold()
+        contacts[domain] = match.group(0) if match else ''
+    answer['contacts'] = contacts
+    return answer
+
+
+# a batch of ten answers is a few hundred tokens
+contact_extraction_router = StructuredRouter(
+    'extract_emails',
+    routes=[Route('batch', GEMINI_MODEL_NAME, max_output_tokens=40 * GDPR_BATCH_MAX_DOMAINS + 64)],
+    system_instruction=EXTRACT_EMAILS_SYSTEM_INSTRUCTIONS,
+    response_schema=EXTRACT_EMAILS_RESPONSE_SCHEMA,
+    validate=validate_contacts,
+)
+
+EXTRACT_EMAILS_PROMPT_VERSION = prompt_version(EXTRACT_EMAILS_SYSTEM_INSTRUCTIONS, EXTRACT_EMAILS_PROMPT,
+                                               EXTRACT_EMAILS_RESPONSE_SCHEMA, contact_extraction_router.version_parts())
+
+
+def extract_emails_batched(excerpts, user=None, priority=PRIORITY_BULK):
+    """
+    Extract the GDPR contacts of several companies with one Gemini call per batch of privacy page excerpts.
 
-def compose_df(classification_data, email_info):
+    Parameters:
+        excerpts (dict): Domain -> privacy page excerpt, see `privacy_excerpt`.
+        user (str, optional): The requesting user's id, for fair queuing of the Gemini calls.
+        priority (int, optional): Scheduler priority of the Gemini calls.
+
+    Returns:
+        dict: Domain -> email address, only for the domains whose address was found verbatim in their excerpt.
+              Answers are cached per excerpt, so a company is only sent to Gemini again when its page changes.
+    """
+    cache = get_llm_cache()
+    keys = {domain: cache.make_key(GEMINI_MODEL_NAME, EXTRACT_EMAILS_PROMPT_VERSION, f'{domain}\n{excerpt}')
+            for domain, excerpt in excerpts.items()}
+    found = {}
+    pending = {}
+    for domain, excerpt in excerpts.items():
+        cached = cache.get(keys[domain])
+        if cached:
+            found[domain] = cached
+        else:
+            pending[domain] = excerpt
+
+    def run_batch(batch):
+        prompt = EXTRACT_EMAILS_PROMPT.format(excerpts='\n\n'.join(
+            f'Domain: {domain}\nExcerpt:\n{pending[domain]}' for domain in batch))
+        try:
+            answer, _ = contact_extraction_router.run(prompt, user=user, priority=priority)
+        except Exception as e:
+            # the domains of a failed batch are retried one by one
+            print(f"Batched contact extraction of {len(batch)} domains failed: {e}")
+            return {}
+        return answer['contacts'] if answer is not None else {}
+
+    batches = plan_extraction_batches(pending)
+    if batches:
+        with ThreadPoolExecutor(max_workers=min(len(batches), GDPR_LOOKUP_WORKERS)) as executor:
+            for batch, contacts in zip(batches, executor.map(run_batch, batches)):
+                for domain in batch:
+                    email = contacts.get(registrable_domain(domain) or domain.casefold())
+                    # the model may swap the answers of a batch; an address that is not in this company's own
+                    # excerpt is left to the single retry
+                    if email and email.casefold() in pending[domain].casefold():
+                        found[domain] = email
+                        cache.set(keys[domain], email)
+        print(f"Extracted {len(found)} of {len(excerpts)} contacts with {len(batches)} batched request(s)")
+    return found
+
+
+_gdpr_contacts = OrderedDict()
+_gdpr_contacts_lock = threading.Lock()
+
+
+def cached_gdpr_contact(domain):
     """
-    Extract company details from email interaction data and append it as a dictionary to a list.
+    Return the GDPR contact of a company looked up in the last `GDPR_CONTACT_TTL` seconds.
 
     Parameters:
-        classification_data (list): A list to store classification dictionaries with company details.
-        email_info (dict): Dictionary containing email interaction data, including a JSON-formatted "Interaction Type".
+        domain (str): The registrable domain of the company.
 
     Returns:
-        None
+        str or None: The email address or "No email available", or None if the domain was not looked up today.
     """
-    interaction_str = email_info.get("Interaction Type", "{}")
+    with _gdpr_contacts_lock:
+        entry = _gdpr_contacts.get(domain)
+        if entry is None or time.monotonic() - entry[0] >= GDPR_CONTACT_TTL:
+            return None
+        return entry[1]
 
-    # Parse the classification JSON string into a dictionary
-    interaction_dict = json.loads(interaction_str)
 
-    # Extract relevant fields (company name, category, website)
-    company_name = interaction_dict.get("company_name", "")
-    category = interaction_dict.get("category", "")
-    website = interaction_dict.get("website", "")
+def remember_gdpr_contact(domain, email):
+    """
+    Cache the GDPR contact of a company for `GDPR_CONTACT_TTL` seconds. Failed lookups are not cached.
+
+    Returns:
+        None
+    """
+    now = time.monotonic()
+    with _gdpr_contacts_lock:
+        _gdpr_contacts.pop(domain, None)
+        _gdpr_contacts[domain] = (now, email)
+        # entries are kept in lookup order, so the expired ones are at the front
+        while now - next(iter(_gdpr_contacts.values()))[0] >= GDPR_CONTACT_TTL:
+            _gdpr_contacts.popitem(last=False)
 
-    # Append the extracted data as a tuple (or list) to the classification_data list
-    classification_data.append({
-        "Company Name": company_name,
-        "Interaction Type": category,
-        "Website": website
-    })
 
-@st.cache_data
-def display_random_logos(image_urls):
+def find_gdpr_contacts(domains, user=None, priority=PRIORITY_BULK):
     """
-    Display a grid of random logos with varying sizes in Streamlit.
+    Look up the GDPR contact emails of many companies at once, for bulk sends.
 
     Parameters:
-        image_urls (list): A list of image URLs to display.
+        domains (iterable of str): Registrable domains of the companies.
+        user (str, optional): The requesting user's id, for fair queuing of the Gemini calls.
+        priority (int, optional): Scheduler priority of the Gemini calls.
 
     Returns:
-        None
+        dict: Domain -> email address, "No email available", or None if no working privacy page was found.
+
+    Description:
+        Companies looked up today, in bulk or by `find_gdpr_contact`, are served from the shared daily cache.
+        The privacy pages of the others are found and loaded concurrently. Their relevant excerpts are sent to
+        Gemini in batches sized by `GDPR_BATCH_TOKEN_BUDGET`, so a bulk send takes a few requests instead of one
+        per company. Companies a batch did not answer for are retried one by one with the whole page.
     """
-    num_columns = 7  # Number of columns to display
-    random.shuffle(image_urls)  # Shuffle the images to randomize their order
+    contacts = {}
+    for domain in dict.fromkeys(domains):
+        contacts[domain] = cached_gdpr_contact(domain)
+    domains = [domain for domain, email in contacts.items() if email is None]
+    if not domains:
+        return contacts
+
+    def load(domain):
+        try:
+            return load_privacy_page(return_privacy_url(f"https://{domain}"))
+        except Exception as e:
+            print(f"Could not load the privacy page of {domain}: {e}")
+            return None, None
 
-    # Generate random widths for each image (between 50px and 150px)
-    widths = [random.randint(30, 90) for _ in image_urls]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(domains), GDPR_LOOKUP_WORKERS))) as executor:
+        pages = dict(zip(domains, executor.map(load, domains)))
 
-    # Iterate over the images and display them in columns
-    for i in range(0, len(image_urls), num_columns):
-        cols = st.columns(num_columns)
-        for idx, img_url in enumerate(image_urls[i:i + num_columns]):
-            with cols[idx]:
-                width = widths[i + idx]
-                # Display the image with rounded corners and random width
-                html = f'''
-                    <img src="{img_url}" 
-                         style="border-radius:50%; 
-                                width:{width}px; 
-                                height:{width}px; 
-                                object-fit:contain;
-                                margin-bottom:10px;"
-                    />
-                '''
-                st.markdown(html, unsafe_allow_html=True)
+    loaded = {domain: page for domain, page in pages.items() if page[0] is not None}
+    found = extract_emails_batched({domain: privacy_excerpt(text) for domain, (_, text) in loaded.items()},
+                                   user=user, priority=priority)
 
+    for domain, (url, text) in loaded.items():
+        email = found.get(domain)
+        if email is None:
+            try:
+                email = extract_email_from_text(text, user=user, priority=priority)
+            except Exception as e:
+                print(f"Contact extraction for {domain} failed: {e}")
+                contacts[domain] = None
+                continue
+        contacts[domain] = email
+        remember_gdpr_contact(domain, email)
+        # live results feed the next build of the bundled contact index
+        record_lookup(domain, url, email)
+    return contacts
 
-@st.fragment
-def display_df(df):
+
+def find_gdpr_contact(domain, user=None, priority=PRIORITY_INTERACTIVE):
     """
-    Display an editable dataframe in Streamlit, allowing users to select and interact with company data.
+    Look up the GDPR contact email of a company, at most once per registrable domain per day.
 
     Parameters:
-        df (pd.DataFrame): The dataframe containing company information, including "Company Name", "Interaction Type", and "Website" columns.
+        domain (str): The registrable domain of the company, e.g. "adidas.com".
+        user (str, optional): The requesting user's id, for fair queuing of the Gemini call.
+        priority (int, optional): Scheduler priority of the Gemini call.
 
     Returns:
-        pd.DataFrame: A subset of the dataframe with only the selected rows.
+        str: The extracted email address, or "No email available".
+
+    Raises:
+        ValueError: If no working privacy page is found. Failures are not cached.
+    """
+    email = cached_gdpr_contact(domain)
+    if email is not None:
+        return email
+    url, text = load_privacy_page(return_privacy_url(f"https://{domain}"))
+    email = extract_email_from_text(text, user=user, priority=priority)
+    remember_gdpr_contact(domain, email)
+    # live results feed the next build of the bundled contact index
+    record_lookup(domain, url, email)
+    return email
+
+
+def compose_company_rows(records):
     """
-    # drop duplicate companies
-    df.drop_duplicates(subset=['Company Name'], inplace=True)
+    Resolve scanned emails to companies and build one table row per company.
 
-    # add columns to df_clean
-    df['Select Option'] = '-'
-    df['Select'] = False
+    Parameters:
+        records (iterable of dict): Flat scan result records, consumed in a single pass, e.g. from
+                                    `scan_results.iter_records` or `scan_results.iter_email_records`.
+
+    Returns:
+        tuple: The `EntityIndex` and a list of row dictionaries with "Company Name", "Interaction Type",
+               "Website", "Messages", "First Seen" and "Last Seen".
+    """
+    index = EntityIndex.from_records(records)
+    return index, index.rows()
 
-    # Create options for the dropdown
-    dropdown_options = ['Request Data', 'Modify Data', 'Erase Data']
 
-    column_config = {
-        'Select Option': st.column_config.SelectboxColumn(
-            options=dropdown_options),
-        'Website': st.column_config.LinkColumn(),
-        'Select': st.column_config.CheckboxColumn(),
-    }
+def display_random_logos(logo_data_uris):
+    """
+    Display a grid of random logos with varying sizes in Streamlit.
 
-    # Display editable dataframe with dropdowns
-    edited_df = st.data_editor(
-        df,
-        column_config=column_config,
-        hide_index=True,
-        use_container_width=True,
-        column_order=['Select', 'Company Name', 'Interaction Type', 'Website', 'Select Option']
-    )
+    The logos are inlined as data URIs and rendered in a single HTML block, so browsers do not fetch
+    them from logo.dev themselves and the API token never reaches the client.
 
-    # keep only selected rows
-    selected_rows = edited_df[edited_df['Select']]
-    st.session_state['selected_rows'] = selected_rows
-    return selected_rows
+    Parameters:
+        logo_data_uris (list): Logo data URIs from `fetch_logo_data_uris`.
+
+    Returns:
+        None
+    """
+    st.markdown(logo_grid_html(logo_data_uris), unsafe_allow_html=True)
 
 
 @st.dialog("Email Preview")
@@ -397,6 +733,35 @@ def google_authenticate():
     return authenticator
 
 
+def build_gmail_service_from_credentials(credentials_json):
+    """
+    Build an authenticated Gmail API service instance from serialized OAuth credentials.
+
+    Service instances are not thread-safe, so worker threads each build their own from the same credentials.
+
+    Parameters:
+        credentials_json (str): Authorized user credentials as returned by `Credentials.to_json`.
+
+    Returns:
+        tuple: The Gmail API service instance and the (possibly refreshed) credentials as JSON.
+    """
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
+    from googleapiclient.discovery import build
+
+    credentials_info = json.loads(credentials_json)
+    credentials = Credentials.from_authorized_user_info(credentials_info)
+
+    # Refresh the token if it's expired
+    if credentials.expired and credentials.refresh_token:
+        credentials.refresh(Request())
+        credentials_json = credentials.to_json()
+
+    # Build the Gmail service
+    gmail_service = build('gmail', 'v1', credentials=credentials)
+    return gmail_service, credentials_json
+
+
 def build_gmail_service():
     """
     Build and return an authenticated Gmail API service instance using stored credentials.
@@ -405,17 +770,9 @@ def build_gmail_service():
         googleapiclient.discovery.Resource: The Gmail API service instance.
     """
     if "credentials" in st.session_state:
-        credentials_info = json.loads(st.session_state["credentials"])
-        credentials = Credentials.from_authorized_user_info(credentials_info)
-
-        # Refresh the token if it's expired
-        if credentials.expired and credentials.refresh_token:
-            credentials.refresh(Request())
-            # Update the stored credentials
-            st.session_state["credentials"] = credentials.to_json()
-
-        # Build the Gmail service
-        gmail_service = build('gmail', 'v1', credentials=credentials)
+        gmail_service, credentials_json = build_gmail_service_from_credentials(st.session_state["credentials"])
+        # Update the stored credentials in case they were refreshed
+        st.session_state["credentials"] = credentials_json
         return gmail_service
 
 
@@ -463,63 +820,280 @@ def send_message(service, user_id, message):
         return None
 
 
-def fetch_emails_by_label(service, label_id, days, num_emails=10):
+# Gmail inbox categories as shown in the advanced options, mapped to their search operator values; the Personal
+# tab is the one Gmail calls "primary"
+GMAIL_CATEGORIES = {
+    'Personal': 'primary',
+    'Promotions': 'promotions',
+    'Social': 'social',
+    'Updates': 'updates',
+    'Forums': 'forums',
+}
+
+# emails a scan processes at most; the shards of a sharded scan share it, and the next scan resumes the rest
+GMAIL_MAX_MESSAGES = int(os.getenv('GMAIL_MAX_MESSAGES', '500'))
+GMAIL_PAGE_SIZE = 500  # the maximum page size accepted by messages().list
+
+
+def build_category_filter(ignored_categories=None):
+    """
+    Build the category part of a Gmail search query from the ignored categories.
+
+    Parameters:
+        ignored_categories (list of str, optional): Category names from `GMAIL_CATEGORIES` to leave out.
+
+    Returns:
+        str or None: The OR'd category operators, an empty string if nothing is ignored,
+                     or None if every category is ignored.
+    """
+    ignored_categories = set(ignored_categories or [])
+    selected = [label for name, label in GMAIL_CATEGORIES.items() if name not in ignored_categories]
+    if not selected:
+        return None
+
+    # OR the selected categories together so that a single listing covers all of them;
+    # no category filter is needed when nothing is ignored
+    if len(selected) == len(GMAIL_CATEGORIES):
+        return ''
+    return '(' + ' OR '.join(f'category:{label}' for label in selected) + ')'
+
+
+def build_gmail_query(days, ignored_categories=None, since=None):
     """
-    Fetch emails from a specified category within a given date range.
+    Plan a single Gmail search query covering the date range and all categories that are not ignored.
 
     Parameters:
-        service (googleapiclient.discovery.Resource): The Gmail API service instance.
-        label_id (str): The Gmail label ID to filter emails by category (e.g., 'CATEGORY_PROMOTIONS').
         days (int): The number of past days to include in the date range.
-        num_emails (int, optional): The maximum number of emails to fetch. Defaults to 10.
+        ignored_categories (list of str, optional): Category names from `GMAIL_CATEGORIES` to leave out.
+        since (int, optional): Unix timestamp; only messages received after it are included, for incremental scans.
 
     Returns:
-        list: A list of email messages that match the specified category and date range.
+        str or None: The search query, or None if every category is ignored and there is nothing to fetch.
     """
+    category_filter = build_category_filter(ignored_categories)
+    if category_filter is None:
+        return None
+
+    if since is not None:
+        # Gmail accepts seconds since the epoch in after:, which is exact where dates are not
+        return f'after:{int(since)} {category_filter}'.strip()
 
     # Calculate the start date (n days ago) and the end date (tomorrow)
     start_date = (datetime.now() - timedelta(days=days - 1)).strftime('%Y/%m/%d')
     tomorrow = (datetime.now() + timedelta(days=1)).strftime('%Y/%m/%d')
+    return f'after:{start_date} before:{tomorrow} {category_filter}'.strip()
+
+
+def iter_message_pages(service, query, max_messages=GMAIL_MAX_MESSAGES, page_size=GMAIL_PAGE_SIZE):
+    """
+    Page through the messages matching a query, yielding each page as soon as it arrives.
+
+    Parameters:
+        service (googleapiclient.discovery.Resource): The Gmail API service instance.
+        query (str): The Gmail search query, see `build_gmail_query`.
+        max_messages (int, optional): Cap on the total number of messages yielded.
+        page_size (int, optional): Number of messages requested per page.
+
+    Yields:
+        tuple: A list of message dicts (with "id" and "threadId") and Gmail's estimate of the total result size.
+    """
+    page_token = None
+    remaining = max_messages
+
+    while remaining > 0:
+        results = service.users().messages().list(
+            userId='me',
+            q=query,
+            maxResults=min(page_size, remaining),
+            pageToken=page_token
+        ).execute()
+
+        messages = results.get('messages', [])[:remaining]
+        if messages:
+            remaining -= len(messages)
+            yield messages, min(results.get('resultSizeEstimate', 0), max_messages)
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+
+EMAIL_MAX_BYTES = int(os.getenv('EMAIL_MAX_BYTES', str(32 * 1024)))
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    Convert HTML email bodies to plain text, dropping markup, scripts and styles.
+    """
+
+    SKIPPED_TAGS = {'script', 'style', 'head', 'title', 'noscript'}
+    BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'section'}
 
-    # Compose query and exclude emails from personal category
-    query = f'after:{start_date} before:{tomorrow} -label:CATEGORY_PERSONAL'
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skip_depth = 0
 
-    # Fetch emails from the specified label and date range
-    results = service.users().messages().list(
-        userId='me',
-        q=query,
-        maxResults=num_emails,
-        labelIds=[label_id]  # Fetch emails for a single category
-    ).execute()
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
 
-    messages = results.get('messages', [])
-    return messages
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self.skip_depth:
+            self.skip_depth -= 1
 
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.chunks.append(data)
 
+    def text(self):
+        lines = (' '.join(line.split()) for line in ''.join(self.chunks).splitlines())
+        return '\n'.join(line for line in lines if line)
 
-def fetch_emails(service, days, num_emails=10):
+
+def html_to_text(html):
     """
-    Fetch emails from multiple categories within a specified date range.
+    Convert an HTML document to readable plain text.
 
     Parameters:
-        service (googleapiclient.discovery.Resource): The Gmail API service instance.
-        days (int): The number of past days to include in the date range.
-        num_emails (int, optional): The maximum number of emails to fetch from each category. Defaults to 10.
+        html (str): The HTML content.
+
+    Returns:
+        str: The visible text, one line per block element.
+    """
+    parser = HTMLTextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.text()
+
+
+def is_attachment(part):
+    """
+    Check whether a Gmail message part is an attachment rather than a body part.
+
+    Parameters:
+        part (dict): A message part from the Gmail API "full" format.
 
     Returns:
-        list: A combined list of email messages from multiple categories within the specified date range.
+        bool: True if the part has a filename, an attachment id or an attachment disposition.
     """
-    # Categories to fetch from
-    categories = ['CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES']
+    if part.get('filename') or part.get('body', {}).get('attachmentId'):
+        return True
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-disposition' and header['value'].lower().startswith('attachment'):
+            return True
+    return False
 
-    # Fetch emails from each category separately and combine them
-    combined_emails = []
-    for category in categories:
-        print(f"Fetching emails from {category} for the last {days} day(s)...")
-        emails = fetch_emails_by_label(service, category, days=days, num_emails=num_emails)
-        combined_emails.extend(emails)
 
-    return combined_emails
+def find_best_text_part(part):
+    """
+    Walk a Gmail message part tree and pick the part holding the best text body.
+
+    Nested multiparts (e.g. multipart/alternative inside multipart/mixed) are searched recursively.
+    A text/plain body is preferred, and the first text/html body is used otherwise. Attachments are never descended into.
+
+    Parameters:
+        part (dict): The message payload or one of its parts.
+
+    Returns:
+        dict or None: The chosen part, or None if the message has no inline text body.
+    """
+    html_part = None
+    stack = [part]
+
+    while stack:
+        current = stack.pop()
+        if is_attachment(current):
+            continue
+
+        mime_type = current.get('mimeType', '')
+        if current.get('parts'):
+            # push in reverse so that parts are visited in document order
+            stack.extend(reversed(current['parts']))
+        elif current.get('body', {}).get('data'):
+            if mime_type == 'text/plain':
+                return current
+            if mime_type == 'text/html' and html_part is None:
+                html_part = current
+
+    return html_part
+
+
+def get_part_charset(part):
+    """
+    Read the charset declared in a part's Content-Type header.
+
+    Parameters:
+        part (dict): A message part from the Gmail API "full" format.
+
+    Returns:
+        str: The declared charset if Python knows it, otherwise "utf-8".
+    """
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = re.search(r'charset="?([\w.:-]+)"?', header['value'], re.IGNORECASE)
+            if match:
+                try:
+                    return codecs.lookup(match.group(1)).name
+                except LookupError:
+                    break
+    return 'utf-8'
+
+
+def decode_part_body(part, max_bytes=EMAIL_MAX_BYTES):
+    """
+    Decode the body of a text part, reading at most `max_bytes` of it.
+
+    Parameters:
+        part (dict): A text/plain or text/html part with inline base64url body data.
+        max_bytes (int, optional): Cap on the number of decoded bytes.
+
+    Returns:
+        str: The body as text, converted from HTML if necessary.
+    """
+    data = part['body']['data']
+
+    # every 4 base64 characters encode 3 bytes, so only the prefix covering the cap is decoded
+    encoded_length = -(-max_bytes // 3) * 4
+    data = data[:encoded_length]
+    data += '=' * (-len(data) % 4)
+    raw = base64.urlsafe_b64decode(data.encode('ASCII'))[:max_bytes]
+
+    # a multi-byte character cut by the cap is replaced rather than failing the whole message
+    text = raw.decode(get_part_charset(part), errors='replace')
+
+    if part.get('mimeType') == 'text/html':
+        text = html_to_text(text)
+    return text
+
+
+# nesting of multiparts covered by the response mask, e.g. mixed > related > alternative > text part
+GMAIL_PART_DEPTH = 5
+
+
+def message_fields_mask(depth=GMAIL_PART_DEPTH):
+    """
+    Build the `fields` mask of a message request that returns only what `get_email_content` reads.
+
+    The mask leaves out the id, labels, snippet, size estimate and history id, and keeps the headers, the part
+    tree and the part bodies. Masks cannot select single array elements or recurse, so the part tree is spelled
+    out to `depth` levels and every inline body of those levels is still returned.
+
+    Parameters:
+        depth (int, optional): Levels of nested parts below the payload to include.
+
+    Returns:
+        str: The mask, e.g. "payload(mimeType,filename,headers,body(data,attachmentId),parts(...))".
+    """
+    fields = 'mimeType,filename,headers,body(data,attachmentId)'
+    for _ in range(depth):
+        fields = f'mimeType,filename,headers,body(data,attachmentId),parts({fields})'
+    return f'payload({fields})'
+
+
+MESSAGE_FIELDS = message_fields_mask()
 
 
 def get_email_content(service, message_id):
@@ -535,16 +1109,16 @@ def get_email_content(service, message_id):
                 - subject (str or None): The subject of the email.
                 - sender (str or None): The sender's email address.
                 - date (str or None): The date the email was sent, formatted as "YYYY-MM-DD".
-                - email_content (str or None): The decoded plain text content of the email.
+                - email_content (str or None): The decoded text content of the email, capped at `EMAIL_MAX_BYTES`.
 
         Raises:
             ValueError: If no content is found in the email.
         """
     try:
-        message = service.users().messages().get(userId='me', id=message_id).execute()
+        message = service.users().messages().get(userId='me', id=message_id, format='full',
+                                                  fields=MESSAGE_FIELDS).execute()
         payload = message.get('payload', {})
         headers = payload.get('headers', [])
-        data = ''
 
         # Extract subject, sender, and date
         subject = None
@@ -568,18 +1142,10 @@ def get_email_content(service, message_id):
                     # Fallback to raw date string if parsing fails
                     date = date_str
 
-        # Extract content of the email (only plain text for simplicity)
-        if 'parts' in payload:
-            for part in payload['parts']:
-                if part['mimeType'] == 'text/plain':
-                    data = part['body']['data']
-                    break
-        elif 'body' in payload:
-            data = payload['body']['data']
-
-        # Decode email content
-        if data:
-            email_content = base64.urlsafe_b64decode(data.encode('ASCII')).decode('utf-8')
+        # Find the best text body (plain text, or HTML converted to text) and decode only that part
+        text_part = find_best_text_part(payload)
+        if text_part is not None:
+            email_content = decode_part_body(text_part)
             return subject, sender, date, email_content
         else:
             raise ValueError("No content found in the email.")
@@ -589,74 +1155,382 @@ def get_email_content(service, message_id):
         return None, None, None, None
 
 
-def classify_email_with_gemini(email_content):
+CLASSIFY_SYSTEM_INSTRUCTIONS = """
+    You are a helpful AI that helps classify emails and extract relevant information.
+
+    All emails are classified into one of the following categories: Interacted, Not Interacted.
+    Interacted emails are triggered directly by a user’s action. 
+    They are functional and usually contain important information, such as confirmations (order confirmations, 
+    password resets, account creation), notifications about transactions, or updates on user-initiated requests.
+
+    Not interacted emails are not triggered by any specific user action. They are often used to keep users engaged, 
+    provide updates, send offers, or remind users of products/services. Examples include newsletters, promotional emails, and other marketing content.
+    """
+
+CLASSIFY_PROMPT = """
+    Based on the following email content, identify the following:
+    1. The name of the company (if not mentioned explicitly, infer from the context).
+    2. Classify the email into one of the following categories: Interacted, Not Interacted.
+    3. Company website (if not mentioned explicitly, infer from the context).
+    4. Your confidence in the answer, from 0 (a guess) to 1 (certain).
+
+    Email content:
+    {email_content}
+    """
+
+CLASSIFY_CATEGORIES = ["Interacted", "Not Interacted"]
+
+CLASSIFY_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "company_name": {"type": "STRING"},
+        "category": {"type": "STRING", "enum": CLASSIFY_CATEGORIES},
+        "website": {"type": "STRING"},
+        "confidence": {"type": "NUMBER"}
+    },
+    "required": ["company_name", "category", "website", "confidence"],
+    "propertyOrdering": ["company_name", "category", "website", "confidence"]
+}
+
+
+def validate_classification(text):
+    """
+    Parse a classification answer, rejecting anything that does not match `CLASSIFY_RESPONSE_SCHEMA`.
+
+    Parameters:
+        text (str): The model's response text.
+
+    Returns:
+        dict or None: The classification, or None if it is mis-shaped.
+    """
+    return parse_json_object(text, required=["company_name", "category", "website"],
+                             enums={"category": CLASSIFY_CATEGORIES})
+
+
+# the answer is a few dozen tokens, so the limits only stop runaway or malformed generations
+classification_router = StructuredRouter(
+    'classify',
+    routes=[
+        Route('fast', GEMINI_MODEL_NAME, max_output_tokens=128),
+        Route('escalated', GEMINI_ESCALATION_MODEL_NAME, max_output_tokens=256, attempts=2),
+    ],
+    system_instruction=CLASSIFY_SYSTEM_INSTRUCTIONS,
+    response_schema=CLASSIFY_RESPONSE_SCHEMA,
+    validate=validate_classification,
+)
+
+# changes whenever the instructions, prompt, schema or routing change, which invalidates cached classifications
+CLASSIFY_PROMPT_VERSION = prompt_version(CLASSIFY_SYSTEM_INSTRUCTIONS, CLASSIFY_PROMPT, CLASSIFY_RESPONSE_SCHEMA,
+                                         classification_router.version_parts())
+
+
+def classify_email_with_gemini(email_content, cache_stats=None, user=None, priority=PRIORITY_BULK, deadline=None):
     """
     Classify an email into interacted or not interacted categories and extract relevant company information.
 
     Parameters:
         email_content (str): The text content of the email to classify.
+        cache_stats (collections.Counter, optional): Counter that records LLM cache "hits" and "misses" for the caller.
+        user (str, optional): The scanning user's id, for fair queuing of the Gemini call.
+        priority (int, optional): Scheduler priority, `PRIORITY_BULK` for inbox scans.
+        deadline (float, optional): `time.monotonic()` value after which no Gemini call is admitted.
 
     Returns:
-        dict: A JSON object containing:
+        str or None: A JSON object containing:
             - company_name (str): The name of the company inferred from the email content.
-            - interaction_type (str): The classification of the email as either 'interacted' or 'not interacted'.
+            - category (str): The classification of the email as either 'Interacted' or 'Not Interacted'.
             - website (str): The inferred website of the company, if available.
+            - confidence (float): The model's confidence in the answer, between 0 and 1.
+        None if no model produced a valid classification.
 
     Description:
         This function uses the Gemini AI model to classify emails based on user engagement and interaction.
-        Emails are categorized into 'interacted' (triggered by a user action) or 'not interacted' (not user-triggered, e.g., marketing).
+        Emails are categorized into 'Interacted' (triggered by a user action) or 'Not Interacted' (not user-triggered, e.g., marketing).
         Additionally, the function attempts to infer the company name and website from the email content, if they are not explicitly stated.
+        Every email goes to the fast model first, with a hard output-token limit. Answers that do not match the
+        schema, or whose confidence is below ROUTER_MIN_CONFIDENCE, are escalated to the stronger model.
+        Responses are cached by prompt version and normalized email content, so recurring newsletters
+        and templated confirmations are only sent to Gemini once. Cache misses go through the process-wide
+        scheduler, which shares the Vertex AI quota fairly between sessions.
 
     Raises:
-        Exception: If there is an issue with the classification or model response.
+        DeadlineExceededError: If the email could not be classified before `deadline`.
+        Exception: If there is an issue with the model call, e.g. rate limiting.
     """
 
-    SYSTEM_INSTRUCTIONS = """
-    You are a helpful AI that helps classify emails and extract relevant information.
+    def generate():
+        answer, _ = classification_router.run(CLASSIFY_PROMPT.format(email_content=email_content),
+                                              user=user, priority=priority, deadline=deadline)
+        return json.dumps(answer) if answer is not None else None
 
-    All emails are classified into one of the following categories: interacted, not interacted.
-    Interacted emails are triggered directly by a user’s action. 
-    They are functional and usually contain important information, such as confirmations (order confirmations, 
-    password resets, account creation), notifications about transactions, or updates on user-initiated requests.
+    cache = get_llm_cache()
+    cache_key = cache.make_key(GEMINI_MODEL_NAME, CLASSIFY_PROMPT_VERSION, email_content)
+    return cache.get_or_compute(cache_key, generate, stats=cache_stats)
 
-    Not interacted emails are not triggered by any specific user action. They are often used to keep users engaged, 
-    provide updates, send offers, or remind users of products/services. Examples include newsletters, promotional emails, and other marketing content.
+
+class QuotaExhaustedError(Exception):
+    """Raised when Gemini keeps answering 429 after the allowed number of rate-limit retries."""
+
+
+def process_message(service, message_id, cache_stats=None, max_rate_limit_retries=None, user=None,
+                    priority=PRIORITY_BULK, deadline=None):
     """
+    Fetch and classify a single email.
 
-    PROMPT = f"""
-    Based on the following email content, identify the following:
-    1. The name of the company (if not mentioned explicitly, infer from the context).
-    2. Classify the email into one of the following categories: interacted, not interacted. 
-    3. Company website (if not mentioned explicitly, infer from the context).
+    Parameters:
+        service (googleapiclient.discovery.Resource): The Gmail API service object for accessing the user's emails.
+        message_id (str): The ID of the email message to process.
+        cache_stats (collections.Counter, optional): Counter that records LLM cache "hits" and "misses",
+                                                     and emails classified by the "local" model.
+        max_rate_limit_retries (int, optional): Number of retries allowed on 429 responses before giving up.
+                                                Retries forever if None.
+        user (str, optional): The scanning user's id, for fair queuing of the Gemini call.
+        priority (int, optional): Scheduler priority of the Gemini call, `PRIORITY_BACKGROUND` for pre-scans.
+        deadline (float, optional): `time.monotonic()` value after which the Gemini call is given up.
 
-    Email content:
-    {email_content}
+    Returns:
+        dict or None: The "Subject", "Sender", "Date" and "Interaction Type" of the email,
+                      or None if it has no content or could not be classified.
+
+    Raises:
+        QuotaExhaustedError: If the rate limit persists after `max_rate_limit_retries` retries.
+        DeadlineExceededError: If the email could not be classified before `deadline`.
     """
+    subject, sender, date, email_content = get_email_content(service, message_id)
 
-    response_schema = {
-        "type": "OBJECT",
-        "properties": {
-            "company_name": {"type": "STRING"},
-            "interaction_type": {"type": "STRING", "enum": ["interacted", "not interacted"]},
-            "website": {"type": "STRING"}
-        }, "required": ["company_name", "category", "website"]
-    }
+    if email_content is None or sender is None:
+        # print(f"Skipping email {message_id} due to missing content or sender.")
+        return None
 
-    credentials, project_id = google.auth.load_credentials_from_file('service_acc.json')
+    # recurring senders are classified by the locally trained model; only uncertain emails go to Gemini
+    local_classifier = get_local_classifier()
+    if local_classifier is not None:
+        prediction = local_classifier.predict(subject, sender)
+        if prediction['confidence'] >= LOCAL_CLASSIFIER_MIN_CONFIDENCE:
+            if cache_stats is not None:
+                cache_stats['local'] += 1
+            return {
+                "Subject": subject,
+                "Sender": sender,
+                "Date": date,
+                "Interaction Type": json.dumps(prediction)
+            }
+
+    # Retry mechanism for the Gemini call in case of rate limiting (429 Resource Exhausted)
+    rate_limit_retries = 0
+    while True:
+        try:
+            # Use Gemini to classify and extract information
+            gemini_result = classify_email_with_gemini(email_content, cache_stats=cache_stats, user=user,
+                                                       priority=priority, deadline=deadline)
+        except DeadlineExceededError:
+            raise
+        except Exception as e:
+            if is_rate_limit_error(e):
+                if max_rate_limit_retries is not None and rate_limit_retries >= max_rate_limit_retries:
+                    raise QuotaExhaustedError(f"Quota exhausted while processing email {message_id}") from e
+                rate_limit_retries += 1
+                # the scheduler has paused all Gemini calls in the process, so the retry waits in its queue
+                print(f"Rate limit hit (429 Quota exceeded). Retrying once the scheduler resumes...")
+                continue
+            print(f"Skipping email {message_id} due to unexpected error: {e}")
+            return None
+
+        if not gemini_result:
+            print(f"Skipping email {message_id} due to failed Gemini classification.")
+            return None
+
+        print(f"Successfully processed email {message_id}.")
+        return {
+            "Subject": subject,
+            "Sender": sender,
+            "Date": date,
+            "Interaction Type": gemini_result
+        }
 
-    vertexai.init(project=project_id, location="us-central1", credentials=credentials)
-    model = GenerativeModel("gemini-1.5-flash-001",
-                            system_instruction=SYSTEM_INSTRUCTIONS)
 
-    response = model.generate_content(
-        [PROMPT],
-        generation_config=GenerationConfig(response_mime_type="application/json", response_schema=response_schema)
-    )
+# subjects of emails users trigger themselves; such emails prove the company holds the user's data
+INTERACTED_SUBJECT_PATTERN = re.compile(
+    r'\b(order|account|password|receipt|invoice|confirm\w*|verif\w*|welcome|booking|reservation|payment|'
+    r'subscription|shipped|shipping|delivery|sign[- ]?in|log[- ]?in|security|ticket|refund|purchase)\b',
+    re.IGNORECASE,
+)
+# Gmail allows 100 calls per batch request, but throttles large batches of the same user
+GMAIL_METADATA_BATCH_SIZE = 50
+# share of a time-budgeted scan that listing and prioritizing the messages may take
+ANYTIME_PLANNING_SHARE = 0.3
+
+
+def fetch_message_metadata(service, message_ids, deadline=None):
+    """
+    Fetch the From, Subject and Date headers of many messages with batched Gmail requests.
+
+    Parameters:
+        service (googleapiclient.discovery.Resource): The Gmail API service instance.
+        message_ids (list of str): The messages.
+        deadline (float, optional): `time.monotonic()` value after which no further batches are sent.
+
+    Returns:
+        dict: Message id -> dict of the headers that were found; messages that failed or were not reached
+              before the deadline are missing.
+    """
+    metadata = {}
+
+    def collect(request_id, response, exception):
+        if exception is None:
+            headers = response.get('payload', {}).get('headers', [])
+            metadata[response['id']] = {header['name']: header['value'] for header in headers}
+
+    for start in range(0, len(message_ids), GMAIL_METADATA_BATCH_SIZE):
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        batch = service.new_batch_http_request(callback=collect)
+        for message_id in message_ids[start:start + GMAIL_METADATA_BATCH_SIZE]:
+            batch.add(service.users().messages().get(userId='me', id=message_id, format='metadata',
+                                                     metadataHeaders=['From', 'Subject', 'Date']))
+        try:
+            batch.execute()
+        except Exception as e:
+            print(f"Could not fetch the metadata of {len(message_ids[start:start + GMAIL_METADATA_BATCH_SIZE])} "
+                  f"emails: {e}")
+    return metadata
+
+
+def prioritize_messages(message_ids, metadata):
+    """
+    Order messages so that the most informative ones are processed first.
+
+    Parameters:
+        message_ids (list of str): The messages, newest first as listed by Gmail.
+        metadata (dict): Headers per message id, see `fetch_message_metadata`.
+
+    Returns:
+        list: Message ids in this order: one email per sender domain (preferring one that looks user-triggered),
+              then the other user-triggered-looking emails, then the rest, and finally repeats of a subject
+              already seen from the same domain, each group newest first.
+    """
+    def sender_key(message_id):
+        sender = metadata.get(message_id, {}).get('From', '')
+        return sender_domain(sender) or sender.casefold()
+
+    def looks_interacted(message_id):
+        return bool(INTERACTED_SUBJECT_PATTERN.search(metadata.get(message_id, {}).get('Subject', '')))
+
+    def template_key(message_id):
+        # templated emails differ only in numbers, e.g. order ids
+        return sender_key(message_id), re.sub(r'\d+', '0', metadata[message_id].get('Subject', '').casefold())
+
+    representatives = {}
+    for message_id in message_ids:
+        if message_id not in metadata:
+            continue
+        domain = sender_key(message_id)
+        if domain not in representatives or (looks_interacted(message_id)
+                                             and not looks_interacted(representatives[domain])):
+            representatives[domain] = message_id
+    representative_ids = set(representatives.values())
+
+    seen_templates = set()
+    tiers = ([], [], [], [])
+    for message_id in message_ids:
+        if message_id in representative_ids:
+            tier = 0
+        elif message_id not in metadata:
+            # not reached by the metadata fetch; processed with the ordinary emails
+            tier = 2
+        elif template_key(message_id) in seen_templates:
+            tier = 3
+        else:
+            tier = 1 if looks_interacted(message_id) else 2
+        if message_id in metadata:
+            seen_templates.add(template_key(message_id))
+        tiers[tier].append(message_id)
+    return [message_id for tier in tiers for message_id in tier]
 
-    return response.text
 
+def process_emails_within_budget(service, query, budget_seconds, user=None, progress_bar=None):
+    """
+    Classify the most informative emails matching a query until a wall-clock budget runs out.
+
+    Parameters:
+        service (googleapiclient.discovery.Resource): The Gmail API service object for accessing the user's emails.
+        query (str): The Gmail search query, see `build_gmail_query`.
+        budget_seconds (float): Wall-clock budget of the whole scan.
+        user (str, optional): The scanning user's id, for fair queuing of Gemini calls.
+        progress_bar (streamlit.delta_generator.DeltaGenerator, optional): Progress bar to update.
+
+    Returns:
+        tuple: The `email_data` of the emails classified in time, the coverage estimate and the cache stats.
 
-def process_emails(service, days, ignored_categories):
+    Description:
+        Messages are listed and their headers fetched in batches within `ANYTIME_PLANNING_SHARE` of the budget,
+        then processed in the order of `prioritize_messages`. No new email is started after the deadline, an
+        email still queued for Gemini at the deadline is given up, and a 429 ends the scan instead of waiting
+        for the quota. The coverage estimate reports the share of
+        emails and of sender domains, a proxy for companies, that were processed.
+    """
+    started = time.monotonic()
+    deadline = started + budget_seconds
+    planning_deadline = started + budget_seconds * ANYTIME_PLANNING_SHARE
+
+    message_ids = []
+    for messages, _ in iter_message_pages(service, query):
+        # the same message is never listed twice, but a page boundary moving between requests could repeat one
+        message_ids.extend(msg['id'] for msg in messages)
+        if time.monotonic() >= planning_deadline:
+            break
+    message_ids = list(dict.fromkeys(message_ids))
+    metadata = fetch_message_metadata(service, message_ids, deadline=planning_deadline)
+    ordered = prioritize_messages(message_ids, metadata)
+
+    domains = {sender_domain(headers.get('From', '')) or headers.get('From', '') for headers in metadata.values()}
+    covered_domains = set()
+    email_data = {}
+    cache_stats = Counter()
+    processed = 0
+    stopped = None
+
+    for message_id in ordered:
+        if time.monotonic() >= deadline:
+            stopped = 'time budget'
+            break
+        if progress_bar is not None:
+            elapsed = time.monotonic() - started
+            progress_bar.progress(min(int(100 * elapsed / budget_seconds), 99),
+                                  text=f"Analyzing the most informative emails ({processed} of {len(ordered)})...")
+        try:
+            email_entry = process_message(service, message_id, cache_stats=cache_stats, max_rate_limit_retries=0,
+                                          user=user, deadline=deadline)
+        except DeadlineExceededError:
+            # the email was waiting for a Gemini slot when the budget ran out
+            stopped = 'time budget'
+            break
+        except QuotaExhaustedError:
+            stopped = 'quota'
+            break
+        processed += 1
+        if message_id in metadata:
+            headers = metadata[message_id]
+            covered_domains.add(sender_domain(headers.get('From', '')) or headers.get('From', ''))
+        if email_entry is not None:
+            email_data[message_id] = email_entry
+
+    coverage = {
+        'emails': len(ordered),
+        'processed': processed,
+        'classified': len(email_data),
+        'email_coverage': round(processed / len(ordered), 3) if ordered else 1.0,
+        'sender_domains': len(domains),
+        # domains whose emails were never prioritized cannot be counted, so this is an upper bound
+        'domain_coverage': round(len(covered_domains) / len(domains), 3) if domains else 1.0,
+        'complete': processed == len(ordered),
+        'stopped_by': stopped,
+        'seconds': round(time.monotonic() - started, 1),
+    }
+    return email_data, coverage, cache_stats
+
+
+def process_emails(service, days, ignored_categories, user=None, since=None, budget_seconds=None):
     """
     Process emails by fetching, analyzing, and classifying them into interacted or not interacted categories.
 
@@ -664,75 +1538,75 @@ def process_emails(service, days, ignored_categories):
         service (googleapiclient.discovery.Resource): The Gmail API service object for accessing the user's emails.
         days (int): The number of days from which to fetch and process emails.
         ignored_categories (list of str): A list of email categories to ignore during processing.
+        user (str, optional): The scanning user's id, for fair queuing of Gemini calls.
+        since (int, optional): Unix timestamp; only emails received after it are processed.
+        budget_seconds (float, optional): Return after about this many seconds with the most informative emails,
+                                          see `process_emails_within_budget`. Scans everything if None.
 
     Returns:
         dict: A dictionary where each key is an email's message ID, and each value is a dictionary containing:
             - "Subject" (str): The email's subject line.
             - "Sender" (str): The sender's email address.
             - "Date" (str): The date of the email.
-            - "Classification" (dict): The classification result from Gemini, including company name, interaction type, and website.
+            - "Interaction Type" (str): The JSON classification result from Gemini, including company name, interaction type, and website.
 
     Description:
-        This function retrieves emails for a specified time range, extracts content, and uses Gemini AI to classify each email.
+        This function retrieves emails for a specified time range with a single paginated Gmail query, extracts content,
+        and uses Gemini AI to classify each email as soon as its page of results arrives.
         It updates the UI with a progress bar during processing and implements retry logic for rate limiting.
         Emails with missing content or sender information are skipped, and any ignored categories are not processed.
+        A scan summary with the LLM response cache hit ratio is shown once all emails are classified.
 
     Raises:
-        Exception: For rate-limit errors (429), the function pauses and retries after 60 seconds.
+        Exception: For rate-limit errors (429), the scheduler pauses all Gemini calls and the email is retried.
                    Other exceptions are logged, and processing for the email in question is skipped.
     """
 
-    st.session_state['progress_bar'] = st.progress(0, text="Fetching emails...")
-    messages = fetch_emails(service, days)
+    progress_bar = st.progress(0, text="Fetching emails...")
 
-    if not messages:
-        # print("No emails found.")
+    query = build_gmail_query(days, ignored_categories, since=since)
+    if query is None:
+        progress_bar.empty()
         return {}
 
-    email_data = {}
-
-    # print(f"Processing {len(messages)} emails...")
-    st.session_state['progress_bar'].progress(25, text="Analyzing email content...")
-
-    for msg in messages:
-        message_id = msg['id']
-        subject, sender, date, email_content = get_email_content(service, message_id)
+    if budget_seconds is not None:
+        email_data, coverage, cache_stats = process_emails_within_budget(service, query, budget_seconds, user=user,
+                                                                         progress_bar=progress_bar)
+        progress_bar.empty()
+        summary = (f"Quick scan: {coverage['processed']} of {coverage['emails']} emails and "
+                   f"~{coverage['domain_coverage']:.0%} of senders covered in {coverage['seconds']}s, "
+                   f"{len(email_data)} classified · LLM cache hit ratio {hit_ratio(cache_stats):.0%}")
+        print(f"{summary} {coverage}")
+        st.caption(summary)
+        return email_data
 
-        if email_content is None or sender is None:
-            # print(f"Skipping email {message_id} due to missing content or sender.")
-            continue
+    email_data = {}
+    cache_stats = Counter()
+    processed = 0
 
-        # Retry mechanism for the Gemini call in case of rate limiting (429 Resource Exhausted)
-        while True:
-            try:
-                # Use Gemini to classify and extract information
-                gemini_result = classify_email_with_gemini(email_content)
-
-                if gemini_result:
-                    email_data[message_id] = {
-                        "Subject": subject,
-                        "Sender": sender,
-                        "Date": date,
-                        "Classification": gemini_result
-                    }
-                    print(f"Successfully processed email {message_id}.")
-                else:
-                    print(f"Skipping email {message_id} due to failed Gemini classification.")
-                break  # Exit the while loop if processing succeeds
+    # each page is classified as soon as it arrives, and the next one is only requested afterwards: the Gmail
+    # service is not thread-safe, and with GMAIL_MAX_MESSAGES at or below GMAIL_PAGE_SIZE a scan is one page
+    for messages, estimate in iter_message_pages(service, query):
+        for msg in messages:
+            message_id = msg['id']
+            processed += 1
+            progress = 25 + int(74 * min(processed / max(estimate, processed), 1))
+            progress_bar.progress(progress, text=f"Analyzing email content ({processed})...")
 
-            except Exception as e:
-                if '429' in str(e) or 'Quota exceeded' in str(e):
-                    print(f"Rate limit hit (429 Quota exceeded). Waiting for 60 seconds...")
-                    time.sleep(60)  # Wait for 60 seconds before retrying
-                else:
-                    print(f"Skipping email {message_id} due to unexpected error: {e}")
-                    break  # Exit the while loop if another exception occurs
+            email_entry = process_message(service, message_id, cache_stats=cache_stats, user=user)
+            if email_entry is not None:
+                email_data[message_id] = email_entry
 
-    st.session_state['progress_bar'].progress(99, text="Finishing...")
+    progress_bar.progress(99, text="Finishing...")
 
     # get rid of progress bar
-    st.session_state['progress_bar'].empty()
-
-    st.write(email_data)
+    progress_bar.empty()
+
+    # scan summary
+    summary = (f"Classified {len(email_data)} of {processed} emails, {cache_stats['local']} locally · "
+               f"LLM cache hit ratio {hit_ratio(cache_stats):.0%} "
+               f"({cache_stats['hits']} hits, {cache_stats['misses']} misses)")
+    print(summary)
+    st.caption(summary)
 
     return email_data